@@ -1,11 +1,9 @@
-import boto3
 import json
 
+from bedrock_client import get_client
+
 # Set up the Amazon Bedrock client
-bedrock_client = boto3.client(
-    service_name="bedrock-runtime",
-    region_name="us-east-1"
-)
+bedrock_client = get_client(region="us-east-1")
 
 # Define the model ID
 model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
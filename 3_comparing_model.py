@@ -1,78 +1,372 @@
-import boto3
+import argparse
+import asyncio
 import json
+import sys
 import time
-
-def invoke_bedrock_model(client, model_id, prompt):
-    """Invoke an Amazon Bedrock model and return the response and latency."""
-    if "anthropic" in model_id:
-        # Payload format for Anthropic Claude models
-        payload = {
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 100,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [{"type": "text", "text": prompt}]
-                }
-            ]
-        }
-    else:
-        # Payload format for Amazon models (Nova Lite)
-        payload = {
-            "inferenceConfig": {"max_new_tokens": 100},
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [{"text": prompt}]
-                }
-            ]
-        }
-
-    start_time = time.time()
-    response = client.invoke_model(
-        modelId=model_id,
-        body=json.dumps(payload)
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from bedrock_async import aprewarm, async_client, get_async_invoke_function
+from bedrock_client import DEFAULT_MAX_POOL_CONNECTIONS, DEFAULT_REGION, get_client, prewarm
+from bedrock_invoke import get_invoke_function
+from evaluation import Evaluator, KeywordScorer
+from latency import LatencyRecorder
+from model_router import ModelRouter
+from pipeline import PromptPipeline, read_prompt_sources
+from region_router import RegionRouter
+from resilience import ResilientInvoker
+from result_sink import ResultSink
+from usage import UsageTotals
+
+# Running more workers than the client has pooled connections just queues
+# them on the connection pool.
+DEFAULT_MAX_WORKERS = DEFAULT_MAX_POOL_CONNECTIONS
+
+def compare_models(client, model_ids, prompt, concurrent=True, max_workers=None, stream=False, cache=None,
+                   recorder=None, router=None, usage=None, backend="invoke_model", resilience=None, sink=None,
+                   evaluator=None, max_tokens=100):
+    """Send the same prompt to every model and return the results in model order.
+
+    Each result carries the response, latency, token counts, stop reason and
+    cost. With stream=True each call uses the response-stream API, and the
+    results also carry time-to-first-token and inter-token gaps. With a
+    ResponseCache, cached results are marked "cached" and have no latency. A
+    LatencyRecorder collects the per-phase timings of every call that reached
+    a model, and a UsageTotals adds up tokens and cost. With a RegionRouter,
+    client is ignored, each call goes to the region the router picks, and the
+    results name that region. backend picks the API: "invoke_model" or
+    "converse". A ResilientInvoker adds retries, a deadline, a circuit
+    breaker and hedging to each call, around the router if there is one.
+    A model whose call fails gets {"error": ...} and the others still report.
+    A ResultSink gets each result, with the model, prompt and backend, as
+    soon as its call completes. With an Evaluator, each response is scored
+    on the evaluator's workers and reaches the sink with its scores; call
+    evaluator.join() before reading "scores" and "quality" from the results.
+    max_tokens caps each response.
+    """
+    fields = {"prompt": prompt, "backend": backend}
+    invoke = partial(get_invoke_function(backend, stream), cache=cache, recorder=recorder, max_tokens=max_tokens)
+    if router is not None:
+        invoke = partial(_invoke_routed, router, invoke)
+    if resilience is not None:
+        invoke = resilience.wrap(invoke)
+    if not concurrent:
+        return {model_id: _outcome(model_id, partial(invoke, client, model_id, prompt), usage, sink, fields,
+                                   evaluator)
+                for model_id in model_ids}
+
+    # boto3 clients are thread-safe, so all workers share the one client. Each
+    # call is still timed on its own inside invoke_bedrock_model.
+    max_workers = max_workers or min(len(model_ids), DEFAULT_MAX_WORKERS)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_outcome, model_id, partial(invoke, client, model_id, prompt), usage, sink, fields,
+                                   evaluator)
+                   for model_id in model_ids]
+        # Collect in submission order rather than completion order so the
+        # output is deterministic.
+        return {model_id: future.result() for model_id, future in zip(model_ids, futures)}
+
+def compare_backends(client, model_ids, prompt, backends=("invoke_model", "converse"), **kwargs):
+    """Run compare_models once per backend and return {backend: results}.
+
+    The backends run one after the other so they do not compete for
+    connections. Each result carries the server-reported latency and the
+    client overhead on top of it.
+    """
+    return {backend: compare_models(client, model_ids, prompt, backend=backend, **kwargs) for backend in backends}
+
+async def acompare_models(client, model_ids, prompt, stream=False, cache=None, recorder=None, usage=None,
+                          backend="invoke_model", timeout=None, sink=None, evaluator=None, max_tokens=100):
+    """Send the same prompt to every model at once on the event loop and return the results in model order.
+
+    client is an aiobotocore client. Results are as for compare_models,
+    except that a model whose call fails or misses the timeout (in seconds)
+    gets {"error": ...} and the other models still report.
+    """
+    fields = {"prompt": prompt, "backend": backend}
+    invoke = get_async_invoke_function(backend, stream)
+    outcomes = await asyncio.gather(
+        *(_aoutcome(model_id, invoke(client, model_id, prompt, cache=cache, recorder=recorder, timeout=timeout,
+                                     max_tokens=max_tokens),
+                    usage, sink, fields, evaluator)
+          for model_id in model_ids)
     )
-    latency = time.time() - start_time
-
-    result = json.loads(response["body"].read())
-
-    if "anthropic" in model_id:
-        generated_text = "".join([output["text"] for output in result.get("content", [])])
+    return dict(zip(model_ids, outcomes))
+
+async def acompare_backends(client, model_ids, prompt, backends=("invoke_model", "converse"), **kwargs):
+    """Run acompare_models once per backend and return {backend: results}, like compare_backends."""
+    return {backend: await acompare_models(client, model_ids, prompt, backend=backend, **kwargs)
+            for backend in backends}
+
+def _invoke_routed(router, invoke, client, model_id, prompt):
+    invocation, region = router.invoke(model_id, prompt, invoke=invoke)
+    invocation.region = region
+    return invocation
+
+def _outcome(model_id, call, usage, sink=None, fields=None, evaluator=None):
+    try:
+        invocation = call()
+    except Exception as e:
+        return _finish(model_id, None, e, usage, sink, fields, evaluator)
+    return _finish(model_id, invocation, None, usage, sink, fields, evaluator)
+
+async def _aoutcome(model_id, call, usage, sink, fields, evaluator=None):
+    try:
+        invocation = await call
+    except Exception as e:
+        return _finish(model_id, None, e, usage, sink, fields, evaluator)
+    return _finish(model_id, invocation, None, usage, sink, fields, evaluator)
+
+def _finish(model_id, invocation, error, usage, sink, fields, evaluator=None):
+    if error is not None:
+        result = {"error": f"{type(error).__name__}: {error}"}
     else:
-        generated_text = "".join([output["text"] for output in result["output"]["message"]["content"]])
-
-    return generated_text, latency
-
-def main():
-    # Set up the Amazon Bedrock client
-    bedrock_client = boto3.client(
-        service_name="bedrock-runtime",
-        region_name="us-east-1"
-    )
-
-    # Take user input for the prompt
-    user_prompt = input("Enter your prompt: ")
-    
-    models = ["amazon.nova-lite-v1:0", "anthropic.claude-3-sonnet-20240229-v1:0"]
+        result = _to_result(model_id, invocation, usage)
+    record = {"model_id": model_id, **fields, **result}
+    if evaluator is not None and error is None:
+        evaluator.submit(record, partial(_scored, result, sink))
+    elif sink is not None:
+        sink.write(record)
+    return result
+
+def _scored(result, sink, record):
+    result.update(scores=record["scores"], quality=record["quality"])
+    if sink is not None:
+        sink.write(record)
+
+def _to_result(model_id, invocation, usage):
+    if usage is not None:
+        usage.add(model_id, invocation)
+    return invocation.to_dict()
+
+# Regions to spread calls over, and the model IDs to use where they differ.
+# Outside us-east-1, Nova Lite is reached through its US inference profile.
+REGIONS = ["us-east-1", "us-west-2"]
+REGION_MODEL_IDS = {"us-west-2": {"amazon.nova-lite-v1:0": "us.amazon.nova-lite-v1:0"}}
+MODELS = ["amazon.nova-lite-v1:0", "anthropic.claude-3-sonnet-20240229-v1:0"]
+# Seconds each call may take, stream and retries included.
+CALL_TIMEOUT = 120
+# Every run's results are appended here; see result_sink.py for reports.
+RESULTS_DIR = "results"
+# Claims about Amazon Bedrock that the sample outputs at the end of this file
+# got wrong. A response to a prompt about Bedrock that makes one scores 0.
+BEDROCK_MISCONCEPTIONS = [r"\bRTOS\b", r"real-time operating system", r"on[- ]premises", r"code ?name"]
+# With --route, the prompt goes to the cheapest model whose p95 latency, over
+# the runs stored in RESULTS_DIR, is within this many seconds.
+ROUTE_SLO = 5.0
+
+def quality_evaluator():
+    """Return the Evaluator the scripts score responses with: known Bedrock misconceptions score 0."""
+    return Evaluator([KeywordScorer(forbidden=BEDROCK_MISCONCEPTIONS, when=r"(?i)\bbedrock\b")])
+
+def main(models=MODELS, backends=("invoke_model",), max_tokens=100, results_dir=RESULTS_DIR):
+    # Set up a client per region and open their connections while the user is
+    # still typing. The resilience layer does the retrying, so botocore does not.
+    clients = {region: get_client(region=region, max_attempts=1) for region in REGIONS}
+    router = RegionRouter(REGIONS, REGION_MODEL_IDS, clients)
+    resilience = ResilientInvoker(deadline=CALL_TIMEOUT, hedge_percentile=95)
+    with ThreadPoolExecutor(max_workers=len(REGIONS)) as executor:
+        for client in router.clients.values():
+            executor.submit(prewarm, client, len(models))
+
+        # Take user input for the prompt
+        user_prompt = input("Enter your prompt: ")
     
-    results = {}
     print("\nProcessing your prompt...\n")
-    for model_id in models:
-        response_text, response_latency = invoke_bedrock_model(bedrock_client, model_id, user_prompt)
-        results[model_id] = {
-            "response": response_text,
-            "latency": response_latency
-        }
-        print(f"Model: {model_id}")
-        print(f"Response: {response_text}")
-        print(f"Latency: {response_latency:.4f} seconds\n")
+    recorder = LatencyRecorder()
+    usage = UsageTotals()
+    start_time = time.perf_counter()
+    with ResultSink(results_dir) as sink, quality_evaluator() as evaluator:
+        results = compare_backends(None, models, user_prompt, backends, stream=True, recorder=recorder,
+                                   router=router, usage=usage, resilience=resilience, sink=sink, evaluator=evaluator,
+                                   max_tokens=max_tokens)
+    wall_time = time.perf_counter() - start_time
+    _print_report(results, recorder, usage, wall_time)
+    print("\nRetries and hedging:")
+    print(resilience.report())
+
+def route_main(models=MODELS, max_tokens=100, results_dir=RESULTS_DIR):
+    """Send the prompt to the one model a ModelRouter picks from the stored runs, and store the result."""
+    router = ModelRouter.from_results(results_dir, models, slo=ROUTE_SLO)
+    clients = {region: get_client(region=region, max_attempts=1) for region in REGIONS}
+    region_router = RegionRouter(REGIONS, REGION_MODEL_IDS, clients)
+    resilience = ResilientInvoker(deadline=CALL_TIMEOUT)
+    with ThreadPoolExecutor(max_workers=len(REGIONS)) as executor:
+        for client in region_router.clients.values():
+            executor.submit(prewarm, client)
+        user_prompt = input("Enter your prompt: ")
+
+    model_id, reason = router.choose()
+    print(f"\nRouting to {model_id} ({reason})...\n")
+    invoke = partial(_invoke_routed, region_router,
+                     partial(get_invoke_function("invoke_model", stream=True), max_tokens=max_tokens))
+    usage = UsageTotals()
+    with ResultSink(results_dir) as sink, quality_evaluator() as evaluator:
+        result = _outcome(model_id, partial(resilience.wrap(invoke), None, model_id, user_prompt), usage, sink,
+                          {"prompt": user_prompt, "backend": "invoke_model"}, evaluator)
+    router.observe(model_id, result)
+    _print_result(model_id, "invoke_model", result)
+    print("Model statistics (seconds):")
+    print(router.report())
+
+async def amain(models=MODELS, backends=("invoke_model",), max_tokens=100, results_dir=RESULTS_DIR):
+    """main() on an asyncio event loop, with one aiobotocore client and a deadline on every call."""
+    async with async_client() as client:
+        # Open the connections while the user is still typing
+        prewarming = asyncio.create_task(aprewarm(client, len(models)))
+        user_prompt = await asyncio.get_running_loop().run_in_executor(None, input, "Enter your prompt: ")
+        await prewarming
+
+        print("\nProcessing your prompt...\n")
+        recorder = LatencyRecorder()
+        usage = UsageTotals()
+        start_time = time.perf_counter()
+        with ResultSink(results_dir) as sink, quality_evaluator() as evaluator:
+            results = await acompare_backends(client, models, user_prompt, backends, stream=True, recorder=recorder,
+                                              usage=usage, timeout=CALL_TIMEOUT, sink=sink, evaluator=evaluator,
+                                              max_tokens=max_tokens)
+        wall_time = time.perf_counter() - start_time
+    _print_report(results, recorder, usage, wall_time)
+
+def run_prompts(sources, models=MODELS, max_tokens=100, concurrency=DEFAULT_MAX_WORKERS, backend="invoke_model",
+                region=DEFAULT_REGION, queue_size=None, output=sys.stdout, results_dir=RESULTS_DIR):
+    """Run every prompt from sources through every model in a PromptPipeline and return its counts.
+
+    sources are files, globs or "-" for stdin, read lazily. Each record is
+    written to output as a JSON line and stored in results_dir as it
+    completes. The reports go to stderr.
+    """
+    # As in main(), the resilience layer does the retrying, so botocore does not.
+    client = get_client(region=region, max_pool_connections=concurrency, max_attempts=1)
+    # Enough threads for every call in flight, so none waits out its deadline in the executor's queue.
+    resilience = ResilientInvoker(deadline=CALL_TIMEOUT, max_workers=concurrency * 2)
+    recorder = LatencyRecorder()
+    usage = UsageTotals()
+
+    def write(record):
+        output.write(json.dumps(record) + "\n")
+        output.flush()
+        sink.write(record)
+
+    start_time = time.perf_counter()
+    with ResultSink(results_dir) as sink, quality_evaluator() as evaluator:
+        pipeline = PromptPipeline(client, models, write, max_tokens=max_tokens, backend=backend,
+                                  concurrency=concurrency, queue_size=queue_size, recorder=recorder, usage=usage,
+                                  evaluator=evaluator, resilience=resilience)
+        counts = pipeline.run(read_prompt_sources(sources))
+    wall_time = time.perf_counter() - start_time
+    print("Pipeline stages (seconds):", file=sys.stderr)
+    print(pipeline.report(), file=sys.stderr)
+    print("\nLatency by phase (seconds):", file=sys.stderr)
+    print(recorder.report(), file=sys.stderr)
+    print("\nPrice-performance:", file=sys.stderr)
+    print(usage.report(), file=sys.stderr)
+    print(f"Total wall time: {wall_time:.4f} seconds", file=sys.stderr)
+    print("\nRetries:", file=sys.stderr)
+    print(resilience.report(), file=sys.stderr)
+    return counts
+
+def _print_report(results, recorder, usage, wall_time):
+    for backend, backend_results in results.items():
+        for model_id, result in backend_results.items():
+            _print_result(model_id, backend, result)
+    results = {backend: {model_id: result for model_id, result in backend_results.items() if "error" not in result}
+               for backend, backend_results in results.items()}
+    print("Latency by phase (seconds):")
+    print(recorder.report())
+    print("\nBackends (seconds):")
+    print(f"{'model':<45}{'backend':<14}{'latency':>9}{'server':>9}{'overhead':>10}")
+    for backend, backend_results in results.items():
+        for model_id, result in backend_results.items():
+            server = f"{result['server_latency']:.4f}" if result["server_latency"] is not None else "-"
+            overhead = f"{result['client_overhead']:.4f}" if result["client_overhead"] is not None else "-"
+            latency = f"{result['latency']:.4f}" if result["latency"] is not None else "cached"
+            print(f"{model_id:<45}{backend:<14}{latency:>9}{server:>9}{overhead:>10}")
+    print("\nPrice-performance:")
+    print(usage.report())
+    print(f"Total wall time: {wall_time:.4f} seconds")
+
+def _print_result(model_id, backend, result):
+    if "error" in result:
+        print(f"Model: {model_id} via {backend}")
+        print(f"Error: {result['error']}\n")
         print("-" * 80)
+        return
+    served = "the cache" if result.get("cached") else result.get("region", "n/a")
+    print(f"Model: {model_id} via {backend} (served from {served})")
+    print(f"Response: {result['response']}")
+    print(f"Time to first token: {_seconds(result.get('time_to_first_token'))}")
+    print(f"Inter-token gap: {_seconds(result.get('mean_gap'))} mean, {_seconds(result.get('max_gap'))} max")
+    print(f"Tokens: {result['input_tokens']} in, {result['output_tokens']} out (stop reason: {result['stop_reason']})")
+    cost = f"${result['cost']:.6f}" if result["cost"] is not None else "unknown"
+    print(f"Cost: {cost}")
+    quality = f"{result['quality']:.2f}" if result.get("quality") is not None else "not scored"
+    print(f"Quality: {quality}\n")
+    print("-" * 80)
+
+def _seconds(value):
+    # Cached and non-streamed results have no stream timings.
+    return f"{value:.4f} seconds" if value is not None else "n/a"
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+        description="Compare Bedrock models on one prompt typed in, or on every prompt in files or on stdin."
+    )
+    parser.add_argument("prompts", nargs="*",
+                        help="prompt files or globs, one prompt per line or JSONL/CSV as for batch_runner.py; "
+                             "- reads stdin, which is also read when it is not a terminal")
+    parser.add_argument("--models", nargs="+", default=MODELS)
+    parser.add_argument("--max-tokens", type=int, default=100, help="output token limit for every call")
+    parser.add_argument("--concurrency", type=int,
+                        help=f"calls in flight at once for prompts from files; {DEFAULT_MAX_WORKERS}")
+    parser.add_argument("--backend", choices=["invoke_model", "converse"], default="invoke_model")
+    parser.add_argument("--backends", nargs="+", choices=["invoke_model", "converse"],
+                        help="compare the typed-in prompt across these backends; each one repeats every call")
+    parser.add_argument("--region", help=f"region for prompts from files; {DEFAULT_REGION}")
+    parser.add_argument("--queue-size", type=int, help="items waiting between pipeline stages; twice the concurrency")
+    parser.add_argument("--output", help="JSONL file the records of prompts from files are appended to; stdout")
+    parser.add_argument("--results", default=RESULTS_DIR, help="results directory every record is stored in")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="run the comparison on an asyncio event loop (needs aiobotocore)")
+    parser.add_argument("--route", action="store_true",
+                        help="send the prompt only to the cheapest model meeting the latency SLO, going by past runs")
+    args = parser.parse_args()
+    from_files = bool(args.prompts) or not sys.stdin.isatty()
+    if from_files:
+        # These pick how the one typed-in prompt is compared; prompts from files
+        # and pipes always run through the pipeline with --backend.
+        for flag, given in (("--async", args.use_async), ("--route", args.route), ("--backends", args.backends)):
+            if given:
+                parser.error(f"{flag} applies only to a prompt typed in, not to prompt files or stdin")
+    else:
+        # The other way round: these size and direct the pipeline, which a typed-in prompt does not use.
+        for flag, value in (("--concurrency", args.concurrency), ("--region", args.region),
+                            ("--queue-size", args.queue_size), ("--output", args.output)):
+            if value is not None:
+                parser.error(f"{flag} applies only to prompt files or stdin, not to a prompt typed in")
+        if args.route and (args.use_async or args.backends):
+            parser.error("--route sends the prompt to one model through invoke_model; drop --async and --backends")
+    if from_files:
+        output = sys.stdout if args.output in (None, "-") else open(args.output, "a", encoding="utf-8")
+        try:
+            counts = run_prompts(args.prompts or ["-"], args.models, args.max_tokens,
+                                 args.concurrency or DEFAULT_MAX_WORKERS, args.backend, args.region or DEFAULT_REGION,
+                                 args.queue_size, output, args.results)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        print(json.dumps(counts), file=sys.stderr)
+    elif args.route:
+        route_main(args.models, args.max_tokens, args.results)
+    elif args.use_async:
+        asyncio.run(amain(args.models, args.backends or [args.backend], args.max_tokens, args.results))
+    else:
+        main(args.models, args.backends or [args.backend], args.max_tokens, args.results)
 
 
+# To run this prompt x model matrix over a prompt file, pass the file, or use
+# batch_runner.py for rate limits, resuming and deduplication.
+# Runs are stored in RESULTS_DIR; `python result_sink.py report results/` sums them up.
 # Define the models and prompts
     # models = ["amazon.nova-lite-v1:0", "anthropic.claude-3-sonnet-20240229-v1:0"]
     # prompts = [
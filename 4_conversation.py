@@ -0,0 +1,26 @@
+from bedrock_client import get_client, prewarm
+from conversation import ConversationSession
+
+# Set up the Amazon Bedrock client
+bedrock_client = get_client(region="us-east-1")
+prewarm(bedrock_client, 1)
+
+# Nova Lite supports prompt caching, so later turns read the history from the cache
+session = ConversationSession(
+    bedrock_client,
+    "amazon.nova-lite-v1:0",
+    system="You are a helpful assistant. Keep your answers short.",
+    max_tokens=500,
+    max_history_tokens=8000
+)
+
+# Chat until an empty line
+while True:
+    prompt = input("You: ")
+    if not prompt:
+        break
+    result = session.send(prompt)
+    print(f"Assistant: {result.text}\n")
+
+# Show what each turn sent and how much input the cache and the budget saved
+print(session.report())
@@ -0,0 +1,347 @@
+"""Run large prompt sets through Bedrock batch inference jobs instead of on-demand calls.
+
+Example:
+    python batch_inference.py prompts.jsonl --output results.jsonl --bucket my-bucket \\
+        --role-arn arn:aws:iam::123456789012:role/BedrockBatchInference
+    python batch_inference.py prompts.jsonl --output results.jsonl --offline
+
+Each model gets one job. Its input is a JSONL file of
+{"recordId": prompt_id, "modelInput": body} records, where body is the
+serialized request invoke_bedrock_model would send. The files are written in
+one pass over the prompts and uploaded to S3, the jobs are submitted and
+polled until they finish, and their output is streamed back from S3 a line at
+a time. Every output record becomes a line in the output file with the same
+fields batch_runner.py writes, and pairs already in that file are skipped.
+Batch records cost BATCH_RATE times the on-demand price and have no latency.
+
+A BatchState file next to the output holds the submitted jobs and each
+prompt's text, so neither is kept in memory. If the run stops while the
+jobs are running, running it again polls the same jobs instead of
+submitting and paying for them again.
+
+--offline runs the same pipeline against the stand-ins in fake_batch.py.
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import time
+
+from batch_runner import DEFAULT_MODELS, load_completed
+from bedrock_client import DEFAULT_REGION
+from bedrock_invoke import InvocationResult
+from model_adapters import get_adapter
+from pipeline import read_prompts
+from result_sink import ResultSink
+from usage import DEFAULT_PRICE_TABLE, PriceTable, UsageTotals
+
+# Bedrock rejects a job with fewer records than this; use batch_runner.py for small sets.
+MIN_RECORDS = 100
+RUNNING_STATES = {"Submitted", "Validating", "Scheduled", "InProgress", "Stopping"}
+SUCCEEDED_STATES = {"Completed", "PartiallyCompleted"}
+
+def split_s3_uri(uri):
+    """Return (bucket, key) for an s3://bucket/key URI."""
+    if not uri.startswith("s3://"):
+        raise ValueError(f"Not an S3 URI: {uri!r}")
+    bucket, _, key = uri[len("s3://"):].partition("/")
+    return bucket, key
+
+def job_name(run_name, model_id):
+    """Return a job name Bedrock accepts: letters, digits, dots and hyphens, at most 63 characters."""
+    return re.sub(r"[^a-zA-Z0-9.-]+", "-", f"{run_name}-{model_id}")[:63].strip("-.")
+
+class BatchState:
+    """A run's submitted jobs and its prompt texts, in a SQLite file, so a restarted run resumes its jobs.
+
+    Prompts are looked up one at a time as output records come back, so a
+    large prompt set is never held in memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS prompts (record_id TEXT PRIMARY KEY, prompt TEXT NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs (job_arn TEXT PRIMARY KEY, model_id TEXT NOT NULL, "
+                        "records INTEGER NOT NULL)")
+        self.db.commit()
+
+    def add_prompt(self, prompt_id, prompt):
+        self.db.execute("INSERT OR REPLACE INTO prompts (record_id, prompt) VALUES (?, ?)",
+                        (json.dumps(prompt_id), prompt))
+
+    def get(self, prompt_id, default=None):
+        """Return the text of prompt_id, or default; a stand-in for a {prompt_id: prompt} dict."""
+        row = self.db.execute("SELECT prompt FROM prompts WHERE record_id = ?", (json.dumps(prompt_id),)).fetchone()
+        return row[0] if row is not None else default
+
+    def add_job(self, job_arn, model_id, records):
+        """Record a submitted job at once, so a crash straight after does not lose it."""
+        self.db.execute("INSERT OR REPLACE INTO jobs (job_arn, model_id, records) VALUES (?, ?, ?)",
+                        (job_arn, model_id, records))
+        self.db.commit()
+
+    def jobs(self):
+        """Return {job_arn: (model_id, records)} for the jobs whose output has not been written yet."""
+        return {job_arn: (model_id, records)
+                for job_arn, model_id, records in self.db.execute("SELECT job_arn, model_id, records FROM jobs")}
+
+    def finish_job(self, job_arn):
+        self.db.execute("DELETE FROM jobs WHERE job_arn = ?", (job_arn,))
+        self.db.commit()
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self, remove=False):
+        """Close the file, and delete it when remove is true and no job is left."""
+        remove = remove and not self.jobs()
+        self.db.close()
+        if remove:
+            os.remove(self.path)
+
+def write_batch_inputs(prompts, outs, completed=(), max_tokens=100, state=None):
+    """Write a batch input record for each prompt to each model's file.
+
+    outs maps a model ID to an open text file. prompts is an iterable of
+    (prompt_id, prompt) pairs and is read once for all the models. Pairs in
+    completed are left out. A BatchState stores each prompt's text. Returns
+    ({model_id: records written}, pairs skipped).
+    """
+    adapters = {model_id: get_adapter(model_id) for model_id in outs}
+    counts = dict.fromkeys(outs, 0)
+    skipped = 0
+    for prompt_id, prompt in prompts:
+        record_id = json.dumps(prompt_id)
+        written = False
+        for model_id, out in outs.items():
+            if (prompt_id, model_id) in completed:
+                skipped += 1
+                continue
+            # The body is spliced in already serialized, as invoke_bedrock_model sends it.
+            body = adapters[model_id].build_body(prompt, max_tokens)
+            out.write(f'{{"recordId": {record_id}, "modelInput": {body}}}\n')
+            counts[model_id] += 1
+            written = True
+        if written and state is not None:
+            state.add_prompt(prompt_id, prompt)
+    if state is not None:
+        state.commit()
+    return counts, skipped
+
+def submit_job(bedrock, s3, model_id, input_path, bucket, prefix, role_arn, name):
+    """Upload input_path and start a model invocation job on it. Returns the job ARN."""
+    key = f"{prefix}/input/{name}.jsonl"
+    s3.upload_file(input_path, bucket, key)
+    response = bedrock.create_model_invocation_job(
+        jobName=name,
+        roleArn=role_arn,
+        modelId=model_id,
+        inputDataConfig={"s3InputDataConfig": {"s3Uri": f"s3://{bucket}/{key}", "s3InputFormat": "JSONL"}},
+        outputDataConfig={"s3OutputDataConfig": {"s3Uri": f"s3://{bucket}/{prefix}/output/"}}
+    )
+    return response["jobArn"]
+
+def wait_for_jobs(bedrock, job_arns, poll_interval=60.0, timeout=None):
+    """Poll every job until none is running and return {job_arn: job description}.
+
+    Raises TimeoutError if jobs are still running after timeout seconds.
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    jobs = {}
+    running = list(job_arns)
+    while True:
+        for job_arn in running:
+            jobs[job_arn] = bedrock.get_model_invocation_job(jobIdentifier=job_arn)
+        running = [job_arn for job_arn in running if jobs[job_arn]["status"] in RUNNING_STATES]
+        if not running:
+            return jobs
+        if deadline is not None and time.monotonic() + poll_interval > deadline:
+            raise TimeoutError(f"{len(running)} batch jobs still running after {timeout} seconds")
+        time.sleep(poll_interval)
+
+def read_batch_output(s3, job, prompts=None, prices=DEFAULT_PRICE_TABLE):
+    """Yield (record, InvocationResult) for each output record of a finished job, streamed from S3.
+
+    Records have the fields of batch_runner.py's records. Failed ones carry
+    "error" and come with None for the result. prompts, a {prompt_id: prompt}
+    mapping or a BatchState, fills in "prompt".
+    """
+    model_id = job["modelId"]
+    adapter = get_adapter(model_id)
+    bucket, prefix = split_s3_uri(job["outputDataConfig"]["s3OutputDataConfig"]["s3Uri"])
+    # Bedrock writes <input name>.out and a manifest under a folder named for the job ID.
+    prefix = prefix.rstrip("/") + "/" + job["jobArn"].rpartition("/")[2] + "/"
+    for key in _list_keys(s3, bucket, prefix):
+        if not key.endswith(".jsonl.out"):
+            continue
+        body = s3.get_object(Bucket=bucket, Key=key)["Body"]
+        try:
+            for line in body.iter_lines():
+                if line.strip():
+                    yield _result_record(model_id, adapter, json.loads(line), prompts, prices, job["jobArn"])
+        finally:
+            body.close()
+
+def _list_keys(s3, bucket, prefix):
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    while True:
+        response = s3.list_objects_v2(**kwargs)
+        for entry in response.get("Contents", []):
+            yield entry["Key"]
+        if not response.get("IsTruncated"):
+            return
+        kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+def _result_record(model_id, adapter, output, prompts, prices, job_arn):
+    prompt_id = output.get("recordId")
+    record = {"prompt_id": prompt_id, "model_id": model_id}
+    if prompts is not None:
+        record["prompt"] = prompts.get(prompt_id)
+    record["job_arn"] = job_arn
+    error = output.get("error")
+    if error is not None or "modelOutput" not in output:
+        error = error or {}
+        record["error"] = f"{error.get('errorCode', 'NoOutput')}: {error.get('errorMessage', 'no model output')}"
+        return record, None
+    parsed = adapter.parse_response(output["modelOutput"])
+    result = InvocationResult(
+        model_id,
+        parsed.text,
+        None,
+        parsed.input_tokens,
+        parsed.output_tokens,
+        parsed.stop_reason,
+        prices.cost(model_id, parsed.input_tokens, parsed.output_tokens, parsed.cache_read_tokens,
+                    parsed.cache_write_tokens, batch=True),
+        backend="batch",
+        cache_read_tokens=parsed.cache_read_tokens,
+        cache_write_tokens=parsed.cache_write_tokens
+    )
+    record.update(result.to_dict())
+    return record, result
+
+def run_batch(bedrock, s3, prompts, model_ids, output_path, bucket, role_arn, prefix="bedrock-batch",
+              run_name=None, poll_interval=60.0, timeout=None, max_tokens=100, prices=DEFAULT_PRICE_TABLE, usage=None,
+              sink=None, state_path=None):
+    """Run every prompt against every model as batch jobs, appending one JSON line per record to output_path.
+
+    bedrock is a boto3 "bedrock" client and s3 an "s3" client. prompts is an
+    iterable of (prompt_id, prompt) pairs, read once. The jobs and prompt
+    texts are kept in a BatchState at state_path, output_path + ".jobs" by
+    default. When it still holds jobs from a run that stopped early, those
+    jobs are polled again and prompts and model_ids are not read; a model
+    whose job was never submitted runs the next time. A job's
+    records are written once it finishes, and the file is removed when every
+    job's are. A UsageTotals adds up tokens and cost, and a ResultSink gets a
+    copy of every record. Returns a dict of counts and the jobs' final states.
+    """
+    run_name = run_name or time.strftime("batch-%Y%m%d-%H%M%S")
+    completed = load_completed(output_path)
+    counts = {"skipped": 0, "succeeded": 0, "failed": 0, "jobs": {}}
+    state = BatchState(state_path or output_path + ".jobs")
+    try:
+        job_arns = state.jobs()
+        if job_arns:
+            counts["resumed"] = len(job_arns)
+        else:
+            job_arns = _submit_jobs(bedrock, s3, prompts, model_ids, bucket, role_arn, prefix, run_name, max_tokens,
+                                    completed, state, counts)
+
+        jobs = wait_for_jobs(bedrock, job_arns, poll_interval, timeout)
+        with open(output_path, "a", encoding="utf-8") as out:
+            for job_arn, job in jobs.items():
+                model_id, records = job_arns[job_arn]
+                counts["jobs"][model_id] = {"job_arn": job_arn, "status": job["status"], "records": records}
+                if job["status"] not in SUCCEEDED_STATES:
+                    counts["jobs"][model_id]["message"] = job.get("message")
+                else:
+                    for record, result in read_batch_output(s3, job, state, prices):
+                        # Written already by a run that stopped part-way through this job.
+                        if (record["prompt_id"], model_id) in completed:
+                            counts["skipped"] += 1
+                            continue
+                        out.write(json.dumps(record) + "\n")
+                        if sink is not None:
+                            sink.write(record)
+                        counts["failed" if result is None else "succeeded"] += 1
+                        if usage is not None and result is not None:
+                            usage.add(model_id, result)
+                    out.flush()
+                state.finish_job(job_arn)
+    finally:
+        state.close(remove=True)
+    return counts
+
+def _submit_jobs(bedrock, s3, prompts, model_ids, bucket, role_arn, prefix, run_name, max_tokens, completed, state,
+                 counts):
+    """Write the input files, submit a job per model that has records, and return {job_arn: (model_id, records)}."""
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {model_id: os.path.join(directory, f"{job_name(run_name, model_id)}.jsonl") for model_id in model_ids}
+        outs = {model_id: open(path, "w", encoding="utf-8") for model_id, path in paths.items()}
+        try:
+            records, counts["skipped"] = write_batch_inputs(prompts, outs, completed, max_tokens, state)
+        finally:
+            for out in outs.values():
+                out.close()
+
+        for model_id, count in records.items():
+            if 0 < count < MIN_RECORDS:
+                raise ValueError(f"{model_id!r} has {count} records to run; batch jobs need at least "
+                                 f"{MIN_RECORDS}. Use batch_runner.py for small sets.")
+        job_arns = {}
+        for model_id, path in paths.items():
+            if records[model_id]:
+                name = job_name(run_name, model_id)
+                job_arn = submit_job(bedrock, s3, model_id, path, bucket, prefix, role_arn, name)
+                state.add_job(job_arn, model_id, records[model_id])
+                job_arns[job_arn] = (model_id, records[model_id])
+    return job_arns
+
+def main():
+    parser = argparse.ArgumentParser(description="Run every prompt in a file against every model as batch jobs.")
+    parser.add_argument("prompts", help="JSONL file of {\"id\", \"prompt\"} records, or CSV with id,prompt columns")
+    parser.add_argument("--output", required=True, help="JSONL results file; pairs already in it are skipped")
+    parser.add_argument("--models", nargs="+", default=DEFAULT_MODELS)
+    parser.add_argument("--bucket", help="S3 bucket for the job input and output")
+    parser.add_argument("--prefix", default="bedrock-batch", help="S3 key prefix for the job input and output")
+    parser.add_argument("--role-arn", help="IAM service role Bedrock assumes to read and write the bucket")
+    parser.add_argument("--region", default=DEFAULT_REGION)
+    parser.add_argument("--poll-interval", type=float, default=60.0, help="seconds between job status checks")
+    parser.add_argument("--timeout", type=float, help="seconds to wait for the jobs before giving up")
+    parser.add_argument("--max-tokens", type=int, default=100)
+    parser.add_argument("--prices", metavar="PATH", help="JSON price table in USD per 1,000 tokens")
+    parser.add_argument("--sink", metavar="DIR", help="also store the records in a results directory, for reports")
+    parser.add_argument("--offline", action="store_true", help="run against local stand-ins for S3 and Bedrock")
+    args = parser.parse_args()
+
+    if args.offline:
+        from fake_batch import FakeBedrockBatchClient, FakeS3Client
+        s3 = FakeS3Client()
+        bedrock = FakeBedrockBatchClient(s3, job_seconds=1.0, region_name=args.region)
+        bucket, role_arn, poll_interval = args.bucket or "offline", args.role_arn or "offline", 0.5
+    else:
+        if not args.bucket or not args.role_arn:
+            parser.error("--bucket and --role-arn are required unless --offline is given")
+        import boto3
+        s3 = boto3.client("s3", region_name=args.region)
+        bedrock = boto3.client("bedrock", region_name=args.region)
+        bucket, role_arn, poll_interval = args.bucket, args.role_arn, args.poll_interval
+
+    usage = UsageTotals()
+    prices = PriceTable.from_file(args.prices) if args.prices else DEFAULT_PRICE_TABLE
+    sink = ResultSink(args.sink) if args.sink else None
+    try:
+        counts = run_batch(bedrock, s3, read_prompts(args.prompts), args.models, args.output, bucket, role_arn,
+                           prefix=args.prefix, poll_interval=poll_interval, timeout=args.timeout,
+                           max_tokens=args.max_tokens, prices=prices, usage=usage, sink=sink)
+    finally:
+        if sink is not None:
+            sink.close()
+    counts["usage"] = usage.summary()
+    print(json.dumps(counts))
+
+if __name__ == "__main__":
+    main()
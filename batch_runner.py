@@ -0,0 +1,336 @@
+"""Run a prompt x model matrix against Amazon Bedrock.
+
+Example:
+    python batch_runner.py prompts.jsonl --output results.jsonl \\
+        --models amazon.nova-lite-v1:0 anthropic.claude-3-sonnet-20240229-v1:0 \\
+        --concurrency 8 --tps amazon.nova-lite-v1:0=5 --tps anthropic.claude-3-sonnet-20240229-v1:0=2
+
+Each result is appended to the output file as soon as its call completes.
+Running the same command again skips every (prompt, model) pair that is
+already in the output file, so a crash part-way through does not re-bill the
+calls that had finished.
+"""
+import argparse
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from bedrock_client import get_client, prewarm
+from bedrock_invoke import BACKENDS, get_invoke_function
+from embeddings import hashed_embedding, local_embedder
+from evaluation import EmbeddingScorer, Evaluator, JudgeScorer, KeywordScorer, ReferenceScorer, read_references
+from invoke_chain import compose_invoke
+from latency import LatencyRecorder
+from pipeline import read_prompts
+from region_router import RegionRouter
+from resilience import ResilientInvoker
+from response_cache import ResponseCache
+from result_sink import ResultSink
+from semantic_cache import SemanticCache, bedrock_embedder
+from single_flight import dedupe_prompts
+from telemetry import JsonlSpanExporter, Telemetry, serve_metrics
+from usage import DEFAULT_PRICE_TABLE, PriceTable, UsageTotals
+
+DEFAULT_MODELS = ["amazon.nova-lite-v1:0", "anthropic.claude-3-sonnet-20240229-v1:0"]
+
+def load_completed(output_path):
+    """Return the (prompt_id, model_id) pairs that already have a result in the output file."""
+    completed = set()
+    try:
+        with open(output_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn final line from a crash; that call gets re-run.
+                    continue
+                if "error" not in record:
+                    completed.add((record["prompt_id"], record["model_id"]))
+    except FileNotFoundError:
+        pass
+    return completed
+
+def run_matrix(client, prompts, model_ids, output_path, concurrency=8, rate_limits=None, burst=None, cache=None,
+               recorder=None, router=None, prices=DEFAULT_PRICE_TABLE, usage=None, backend="invoke_model",
+               resilience=None, sink=None, single_flight=None, duplicates=None, evaluator=None, telemetry=None,
+               semantic_cache=None):
+    """Invoke every model for every prompt, appending one JSON line per call to output_path.
+
+    prompts is an iterable of (prompt_id, prompt) pairs and is consumed lazily.
+    rate_limits maps a model ID to its calls-per-second quota. Calls answered
+    by the optional ResponseCache skip the rate limit and are written with
+    "cached": true and no latency. A LatencyRecorder collects the per-phase
+    timings of the other calls. With a RegionRouter, client is ignored and
+    each record names the region that served it. Every record carries token
+    counts, stop reason and a cost from prices, and a UsageTotals adds them up
+    for the run. backend picks the API, "invoke_model" or "converse". A
+    ResilientInvoker applies its retries, deadline, circuit breaker and
+    hedging to every call. A ResultSink gets a copy of every record. A
+    SingleFlight makes identical calls in flight at once share one call.
+    duplicates, from dedupe_prompts(), names prompts that repeat an earlier
+    one; they are not sent, and get a copy of the earlier prompt's records
+    once the calls are done. Use one or the other: after the pre-pass no
+    two calls are identical, so a SingleFlight has nothing to share. An
+    Evaluator scores each response on its own workers before the record is
+    written. A Telemetry traces and measures
+    every attempt. A SemanticCache answers a prompt close enough to one
+    already answered by the same model, with "similarity" and
+    "matched_prompt" in its record. Returns a dict of counts for the run.
+    """
+    invoke_model = compose_invoke(backend, cache, recorder, router, prices, resilience, single_flight, telemetry,
+                                  semantic_cache, rate_limits, burst)
+    duplicates = duplicates or {}
+    completed = load_completed(output_path)
+    counts = {"submitted": 0, "skipped": 0, "succeeded": 0, "failed": 0}
+    write_lock = threading.Lock()
+    # Bounds the calls that are queued or running so a huge prompt file is
+    # never expanded into futures all at once.
+    in_flight = threading.BoundedSemaphore(concurrency * 2)
+
+    def call(prompt_id, prompt, model_id):
+        record = {"prompt_id": prompt_id, "model_id": model_id, "prompt": prompt}
+        try:
+            result = invoke_model(client, model_id, prompt)
+            if usage is not None:
+                usage.add(model_id, result)
+            record.update(result.to_dict())
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+        return record
+
+    def write(record, out):
+        with write_lock:
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            if sink is not None:
+                sink.write(record)
+            counts["failed" if "error" in record else "succeeded"] += 1
+
+    def write_scored(record, out):
+        try:
+            write(record, out)
+        finally:
+            in_flight.release()
+
+    def done(future, out):
+        # The call's permit goes back here, unless the evaluator has taken the
+        # record, in which case write_scored() returns it.
+        scoring = False
+        try:
+            record = future.result()
+            if evaluator is not None and "error" not in record:
+                # Scoring runs on the evaluator's workers; the record is written once scored.
+                try:
+                    evaluator.submit(record, lambda record: write_scored(record, out))
+                    scoring = True
+                except Exception as e:
+                    # The call was made and billed, so its record is written unscored.
+                    record["score_errors"] = {"evaluator": f"{type(e).__name__}: {e}"}
+            if not scoring:
+                write(record, out)
+        finally:
+            if not scoring:
+                in_flight.release()
+
+    with open(output_path, "a", encoding="utf-8") as out:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for prompt_id, prompt in prompts:
+                for model_id in model_ids:
+                    if (prompt_id, model_id) in completed:
+                        counts["skipped"] += 1
+                        continue
+                    if prompt_id in duplicates:
+                        continue
+                    in_flight.acquire()
+                    counts["submitted"] += 1
+                    executor.submit(call, prompt_id, prompt, model_id).add_done_callback(lambda f: done(f, out))
+        if evaluator is not None:
+            evaluator.join()
+    if duplicates:
+        counts["deduplicated"] = copy_duplicates(output_path, duplicates, model_ids, completed, sink)
+    return counts
+
+def copy_duplicates(output_path, duplicates, model_ids, completed=(), sink=None):
+    """Append a copy of the first prompt's record for every duplicate prompt and model that has none yet.
+
+    Copies carry "duplicate_of" with the first prompt's ID. Returns the
+    records written and the tokens and cost they saved.
+    """
+    wanted = set(duplicates.values())
+    originals = {}
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record["prompt_id"] in wanted and "error" not in record and "duplicate_of" not in record:
+                originals[(record["prompt_id"], record["model_id"])] = record
+
+    saved = {"records": 0, "saved_input_tokens": 0, "saved_output_tokens": 0, "saved_cost": 0.0}
+    with open(output_path, "a", encoding="utf-8") as out:
+        for prompt_id, first_id in duplicates.items():
+            for model_id in model_ids:
+                original = originals.get((first_id, model_id))
+                if original is None or (prompt_id, model_id) in completed:
+                    continue
+                record = {**original, "prompt_id": prompt_id, "duplicate_of": first_id}
+                out.write(json.dumps(record) + "\n")
+                if sink is not None:
+                    sink.write(record)
+                saved["records"] += 1
+                if not record.get("cached"):
+                    saved["saved_input_tokens"] += record.get("input_tokens") or 0
+                    saved["saved_output_tokens"] += record.get("output_tokens") or 0
+                    saved["saved_cost"] += record.get("cost") or 0.0
+    return saved
+
+def _parse_rate(value):
+    model_id, _, rate = value.rpartition("=")
+    if not model_id:
+        raise argparse.ArgumentTypeError(f"expected MODEL_ID=RATE, got {value!r}")
+    try:
+        rate = float(rate)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a number of calls per second, got {rate!r}") from None
+    if rate <= 0:
+        raise argparse.ArgumentTypeError(f"calls per second must be positive, got {value!r}")
+    return model_id, rate
+
+def main():
+    parser = argparse.ArgumentParser(description="Run every prompt in a file against every model.")
+    parser.add_argument("prompts", help="JSONL file of {\"id\", \"prompt\"} records, or CSV with id,prompt columns")
+    parser.add_argument("--output", required=True, help="JSONL results file; also used to resume")
+    parser.add_argument("--models", nargs="+", default=DEFAULT_MODELS)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--tps", type=_parse_rate, action="append", default=[],
+                        help="per-model rate limit as MODEL_ID=CALLS_PER_SECOND; may be repeated")
+    parser.add_argument("--burst", type=float, help="token bucket capacity (defaults to the rate)")
+    parser.add_argument("--regions", nargs="+", default=["us-east-1"],
+                        help="regions to spread calls over; more than one turns on routing and failover")
+    parser.add_argument("--region-models", metavar="PATH",
+                        help="JSON file mapping a region to {model_id: regional_model_id}")
+    parser.add_argument("--hedge-after", type=float, help="seconds before a slow call is duplicated in another region")
+    parser.add_argument("--max-attempts", type=int, default=4, help="attempts per call, throttling retries included")
+    parser.add_argument("--deadline", type=float, help="seconds a call may take, retries included")
+    parser.add_argument("--hedge-percentile", type=float,
+                        help="duplicate a call still running past this percentile of the model's latency, such as 95")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="invoke_model",
+                        help="Bedrock API to call: per-family invoke_model bodies or the uniform Converse API")
+    parser.add_argument("--prices", metavar="PATH", help="JSON price table in USD per 1,000 tokens")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="send each distinct prompt once and copy its records to the repeats")
+    parser.add_argument("--sink", metavar="DIR", help="also store the records in a results directory, for reports")
+    parser.add_argument("--references", metavar="PATH",
+                        help="JSONL or CSV of {\"id\", \"reference\"} answers to score responses against")
+    parser.add_argument("--require", action="append", default=[], metavar="PATTERN",
+                        help="regular expression a good response contains; may be repeated")
+    parser.add_argument("--forbid", action="append", default=[], metavar="PATTERN",
+                        help="regular expression that makes a response score 0; may be repeated")
+    parser.add_argument("--embedding", metavar="MODEL",
+                        help="score similarity to the references with a sentence-transformers model, or \"hashed\"")
+    parser.add_argument("--judge", metavar="MODEL_ID", help="have this model grade every response")
+    parser.add_argument("--score-workers", type=int, default=4, help="threads scoring responses")
+    parser.add_argument("--cache", metavar="PATH", help="SQLite response cache shared across runs")
+    parser.add_argument("--cache-ttl", type=float, help="seconds a cached response stays valid")
+    parser.add_argument("--semantic-threshold", type=float,
+                        help="reuse the answer to an earlier prompt at least this similar, such as 0.9; needs numpy")
+    parser.add_argument("--semantic-embedder", default="hashed", metavar="MODEL",
+                        help="embeds prompts for --semantic-threshold: \"hashed\", \"bedrock\" for Titan Text "
+                             "Embeddings, or a sentence-transformers model")
+    parser.add_argument("--semantic-max-entries", type=int, default=10000, help="prompts remembered per model")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics at http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--trace", metavar="PATH", help="append a JSON span for every call to this file")
+    parser.add_argument("--trace-sample", type=float, default=1.0, help="share of calls whose spans are written")
+    parser.add_argument("--profile-rate", type=float, default=0.0, help="share of calls to profile, such as 0.01")
+    parser.add_argument("--profile-dir", default="profiles", help="directory the call profiles are written to")
+    parser.add_argument("--profiler", choices=["cprofile", "pyinstrument"], default="cprofile")
+    args = parser.parse_args()
+
+    # The resilience layer does the retrying, so botocore makes one attempt per call.
+    clients = {region: get_client(region=region, max_pool_connections=args.concurrency, max_attempts=1)
+               for region in args.regions}
+    for client in clients.values():
+        prewarm(client, args.concurrency)
+    bedrock_client = clients[args.regions[0]]
+    router = None
+    if len(args.regions) > 1 or args.region_models:
+        region_models = None
+        if args.region_models:
+            with open(args.region_models, encoding="utf-8") as f:
+                region_models = json.load(f)
+        router = RegionRouter(args.regions, region_models, clients, hedge_after=args.hedge_after,
+                              max_workers=args.concurrency * len(args.regions))
+    resilience = ResilientInvoker(max_attempts=args.max_attempts, deadline=args.deadline,
+                                  hedge_percentile=args.hedge_percentile, max_workers=args.concurrency * 2)
+    cache = ResponseCache(ttl=args.cache_ttl, path=args.cache) if args.cache else None
+    recorder = LatencyRecorder()
+    usage = UsageTotals()
+    prices = PriceTable.from_file(args.prices) if args.prices else DEFAULT_PRICE_TABLE
+    sink = ResultSink(args.sink) if args.sink else None
+    duplicates = dedupe_prompts(read_prompts(args.prompts)) if args.dedupe else None
+    span_exporter = JsonlSpanExporter(args.trace) if args.trace else None
+    telemetry = None
+    if args.metrics_port is not None or span_exporter is not None or args.profile_rate:
+        telemetry = Telemetry(exporters=[span_exporter] if span_exporter else [], sample_rate=args.trace_sample,
+                              profile_rate=args.profile_rate, profile_dir=args.profile_dir, profiler=args.profiler)
+    semantic_cache = None
+    if args.semantic_threshold is not None:
+        if args.semantic_embedder == "hashed":
+            embed = hashed_embedding
+        elif args.semantic_embedder == "bedrock":
+            embed = bedrock_embedder(bedrock_client)
+        else:
+            embed = local_embedder(args.semantic_embedder)
+        semantic_cache = SemanticCache(embed, threshold=args.semantic_threshold,
+                                       max_entries=args.semantic_max_entries, ttl=args.cache_ttl)
+    references = read_references(args.references) if args.references else None
+    scorers = []
+    if references:
+        scorers.append(ReferenceScorer(references))
+        if args.embedding:
+            embed = hashed_embedding if args.embedding == "hashed" else local_embedder(args.embedding)
+            scorers.append(EmbeddingScorer(references, embed))
+    if args.require or args.forbid:
+        scorers.append(KeywordScorer(args.require, args.forbid))
+    if args.judge:
+        judge_invoke = get_invoke_function(args.backend)
+        if telemetry is not None:
+            judge_invoke = telemetry.wrap(judge_invoke)
+        judge_invoke = resilience.wrap(judge_invoke)
+        scorers.append(JudgeScorer(bedrock_client, args.judge, invoke=judge_invoke, references=references, cache=cache,
+                                   prices=prices))
+    evaluator = Evaluator(scorers, max_workers=args.score_workers) if scorers else None
+    metrics_server = serve_metrics(telemetry, args.metrics_port) if args.metrics_port is not None else None
+    try:
+        counts = run_matrix(bedrock_client, read_prompts(args.prompts), args.models, args.output,
+                            concurrency=args.concurrency, rate_limits=dict(args.tps), burst=args.burst, cache=cache,
+                            recorder=recorder, router=router, prices=prices, usage=usage, backend=args.backend,
+                            resilience=resilience, sink=sink, duplicates=duplicates,
+                            evaluator=evaluator, telemetry=telemetry, semantic_cache=semantic_cache)
+    finally:
+        if evaluator is not None:
+            evaluator.close()
+        if sink is not None:
+            sink.close()
+        if span_exporter is not None:
+            span_exporter.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+    if evaluator is not None:
+        counts["quality"] = evaluator.summary()
+    if cache is not None:
+        counts["cache"] = cache.stats()
+    if semantic_cache is not None:
+        counts["semantic_cache"] = semantic_cache.summary()
+    if router is not None:
+        counts["routing"] = router.report()
+    if telemetry is not None:
+        counts["telemetry"] = telemetry.summary()
+    counts["resilience"] = resilience.summary()
+    counts["latency"] = recorder.summary()
+    counts["usage"] = usage.summary()
+    print(json.dumps(counts))
+
+if __name__ == "__main__":
+    main()
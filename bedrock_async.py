@@ -0,0 +1,259 @@
+"""Asyncio versions of the Bedrock invoke and streaming functions.
+
+They take an aiobotocore bedrock-runtime client, so a call in flight holds a
+coroutine and a pooled connection rather than a thread, and one event loop on
+one core keeps thousands of calls going. Each mirrors its counterpart in
+bedrock_invoke and returns the same InvocationResult.
+
+Every call takes a timeout: a deadline in seconds for the whole call,
+including reading the stream. When it passes, the call is cancelled, its
+connection is closed and asyncio.TimeoutError is raised. Cancelling the task
+that awaits a call does the same.
+
+    async with async_client() as client:
+        result = await ainvoke_bedrock_model(client, "amazon.nova-lite-v1:0", "Hello", timeout=30)
+"""
+import asyncio
+import time
+
+from bedrock_client import DEFAULT_REGION, client_config
+from bedrock_invoke import (StreamTimings, _converse_cache_key, _converse_event_text, _converse_request,
+                            _converse_result, _invoke_result, _lookup, _store, _stream_event_text, _stream_finished,
+                            _stream_result, _token_arrived, cache_key)
+from latency import end_call, start_call
+from model_adapters import get_adapter
+from usage import DEFAULT_PRICE_TABLE
+
+# A socket per call in flight costs an event loop little, so the pool is
+# sized for thousands of concurrent calls rather than for a thread pool.
+DEFAULT_ASYNC_POOL_CONNECTIONS = 2000
+
+def async_client(region=DEFAULT_REGION, profile=None, endpoint_url=None, **config):
+    """Return an aiobotocore bedrock-runtime client, to be entered with async with.
+
+    config takes the keyword arguments of client_config(). max_pool_connections
+    caps the calls in flight and defaults to DEFAULT_ASYNC_POOL_CONNECTIONS.
+    Needs aiobotocore.
+    """
+    from aiobotocore.session import AioSession
+    config.setdefault("max_pool_connections", DEFAULT_ASYNC_POOL_CONNECTIONS)
+    return AioSession(profile=profile).create_client(
+        "bedrock-runtime",
+        region_name=region,
+        endpoint_url=endpoint_url,
+        config=client_config(**config)
+    )
+
+async def aprewarm(client, connections=1):
+    """Open up to `connections` pooled connections before the first real call, like bedrock_client.prewarm."""
+    start_time = time.perf_counter()
+
+    async def ping():
+        try:
+            await client.list_async_invokes(maxResults=1)
+        except Exception:
+            pass
+
+    await asyncio.gather(*(ping() for _ in range(connections)))
+    return time.perf_counter() - start_time
+
+async def _deadline(call, timeout):
+    if timeout is None:
+        return await call
+    return await asyncio.wait_for(call, timeout)
+
+async def ainvoke_bedrock_model(client, model_id, prompt, cache=None, recorder=None, prices=DEFAULT_PRICE_TABLE,
+                                timeout=None, max_tokens=100):
+    """Invoke a model and return an InvocationResult, like invoke_bedrock_model."""
+    return await _deadline(_invoke(client, model_id, prompt, cache, recorder, prices, max_tokens), timeout)
+
+async def _invoke(client, model_id, prompt, cache, recorder, prices, max_tokens):
+    timer = start_call(client)
+    try:
+        adapter = get_adapter(model_id)
+        body = adapter.build_body(prompt, max_tokens)
+        timer.mark("serialize")
+        if cache is not None:
+            key = cache.key(model_id, body)
+            hit = _lookup(cache, key, model_id)
+            if hit is not None:
+                return hit
+            timer.mark("cache")
+
+        response = await client.invoke_model(
+            modelId=model_id,
+            body=body
+        )
+        timer.mark("first_byte")
+        async with response["body"] as stream:
+            raw_body = await stream.read()
+        timer.mark("read")
+        parsed = adapter.decode_response(raw_body)
+        timer.mark("parse")
+    finally:
+        end_call()
+
+    result = _invoke_result(client, model_id, parsed, response, timer, prices)
+    if recorder is not None:
+        recorder.record(model_id, timer)
+    if cache is not None:
+        _store(cache, key, result)
+    return result
+
+async def astream_bedrock_model(client, model_id, prompt, timings=None, recorder=None, info=None, max_tokens=100):
+    """Invoke a model with response streaming and yield text chunks as they arrive, like stream_bedrock_model.
+
+    Closing the generator early, or cancelling the task reading it, closes
+    the stream's connection.
+    """
+    timings = timings if timings is not None else StreamTimings()
+    info = info if info is not None else {}
+    timer = start_call(client)
+    try:
+        adapter = get_adapter(model_id)
+        body = adapter.build_body(prompt, max_tokens)
+        timer.mark("serialize")
+
+        start_time = time.perf_counter()
+        response = await client.invoke_model_with_response_stream(
+            modelId=model_id,
+            body=body
+        )
+        timer.mark("first_byte")
+    finally:
+        end_call()
+
+    texts = _timed_texts(response["body"], lambda event: _stream_event_text(adapter, event, info), timings, timer,
+                         start_time)
+    try:
+        async for text in texts:
+            yield text
+    finally:
+        # Reached early when the caller stops reading; the stream still gets closed.
+        await texts.aclose()
+    if recorder is not None:
+        recorder.record(model_id, timer)
+
+async def _timed_texts(stream, text_of, timings, timer, start_time):
+    """Yield the text of each event in stream, filling in timings, and close the stream however it ends."""
+    try:
+        last_token_time = None
+        async for event in stream:
+            text = text_of(event)
+            if text:
+                last_token_time = _token_arrived(timings, timer, start_time, last_token_time)
+                yield text
+        _stream_finished(timings, timer, start_time)
+    finally:
+        stream.close()
+
+async def ainvoke_bedrock_model_streaming(client, model_id, prompt, cache=None, recorder=None,
+                                          prices=DEFAULT_PRICE_TABLE, timeout=None, max_tokens=100):
+    """Stream a response to completion and return an InvocationResult, like invoke_bedrock_model_streaming."""
+    return await _deadline(_invoke_streaming(client, model_id, prompt, cache, recorder, prices, max_tokens), timeout)
+
+async def _invoke_streaming(client, model_id, prompt, cache, recorder, prices, max_tokens):
+    if cache is not None:
+        key = cache_key(cache, model_id, prompt, max_tokens=max_tokens)
+        hit = _lookup(cache, key, model_id, stream=True)
+        if hit is not None:
+            return hit
+
+    timings = StreamTimings()
+    info = {}
+    texts = [text async for text in astream_bedrock_model(client, model_id, prompt, timings, recorder, info,
+                                                          max_tokens)]
+    result = _stream_result(client, model_id, "".join(texts), timings, info, prices)
+    if cache is not None:
+        _store(cache, key, result)
+    return result
+
+async def aconverse_bedrock_model(client, model_id, prompt, cache=None, recorder=None, prices=DEFAULT_PRICE_TABLE,
+                                  timeout=None, max_tokens=100):
+    """Call a model through the Converse API and return an InvocationResult, like converse_bedrock_model."""
+    return await _deadline(_converse(client, model_id, prompt, cache, recorder, prices, max_tokens), timeout)
+
+async def _converse(client, model_id, prompt, cache, recorder, prices, max_tokens):
+    timer = start_call(client)
+    try:
+        request = _converse_request(prompt, max_tokens)
+        timer.mark("serialize")
+        if cache is not None:
+            key = _converse_cache_key(cache, model_id, request)
+            hit = _lookup(cache, key, model_id, backend="converse")
+            if hit is not None:
+                return hit
+            timer.mark("cache")
+
+        response = await client.converse(modelId=model_id, **request)
+        timer.mark("first_byte")
+    finally:
+        end_call()
+
+    result = _converse_result(client, model_id, response, timer, prices)
+    if recorder is not None:
+        recorder.record(model_id, timer)
+    if cache is not None:
+        _store(cache, key, result)
+    return result
+
+async def astream_converse_model(client, model_id, prompt, timings=None, recorder=None, info=None, max_tokens=100):
+    """Call a model through the ConverseStream API and yield text chunks as they arrive, like stream_converse_model."""
+    timings = timings if timings is not None else StreamTimings()
+    info = info if info is not None else {}
+    timer = start_call(client)
+    try:
+        request = _converse_request(prompt, max_tokens)
+        timer.mark("serialize")
+
+        start_time = time.perf_counter()
+        response = await client.converse_stream(modelId=model_id, **request)
+        timer.mark("first_byte")
+    finally:
+        end_call()
+
+    texts = _timed_texts(response["stream"], lambda event: _converse_event_text(event, info), timings, timer,
+                         start_time)
+    try:
+        async for text in texts:
+            yield text
+    finally:
+        # Reached early when the caller stops reading; the stream still gets closed.
+        await texts.aclose()
+    if recorder is not None:
+        recorder.record(model_id, timer)
+
+async def aconverse_bedrock_model_streaming(client, model_id, prompt, cache=None, recorder=None,
+                                            prices=DEFAULT_PRICE_TABLE, timeout=None, max_tokens=100):
+    """Stream a Converse response to completion and return an InvocationResult."""
+    return await _deadline(_converse_streaming(client, model_id, prompt, cache, recorder, prices, max_tokens),
+                           timeout)
+
+async def _converse_streaming(client, model_id, prompt, cache, recorder, prices, max_tokens):
+    if cache is not None:
+        key = cache_key(cache, model_id, prompt, "converse", max_tokens)
+        hit = _lookup(cache, key, model_id, backend="converse", stream=True)
+        if hit is not None:
+            return hit
+
+    timings = StreamTimings()
+    info = {}
+    texts = [text async for text in astream_converse_model(client, model_id, prompt, timings, recorder, info,
+                                                           max_tokens)]
+    result = _stream_result(client, model_id, "".join(texts), timings, info, prices, backend="converse")
+    if cache is not None:
+        _store(cache, key, result)
+    return result
+
+ASYNC_BACKENDS = {
+    "invoke_model": (ainvoke_bedrock_model, ainvoke_bedrock_model_streaming),
+    "converse": (aconverse_bedrock_model, aconverse_bedrock_model_streaming),
+}
+
+def get_async_invoke_function(backend="invoke_model", stream=False):
+    """Return the async invoke function for a backend name, streaming or not."""
+    try:
+        plain, streaming = ASYNC_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown backend {backend!r}; expected one of {sorted(ASYNC_BACKENDS)}") from None
+    return streaming if stream else plain
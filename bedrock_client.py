@@ -0,0 +1,87 @@
+"""Shared, tuned bedrock-runtime clients.
+
+Building a boto3 client loads the service model and resolves credentials,
+which takes tens of milliseconds. get_client() pays that once per (region,
+profile, settings) and hands every caller the same thread-safe client.
+
+The defaults differ from botocore's where they matter under concurrent load:
+    max_pool_connections  50 rather than 10, so threads do not queue for a socket
+    tcp_keepalive         on, so idle pooled connections survive NAT timeouts
+    connect/read timeout  5 s / 120 s, so a dead endpoint fails fast but a long
+                          generation does not time out
+    retry mode            adaptive, which adds client-side rate limiting on
+                          throttles to the standard exponential backoff
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_REGION = "us-east-1"
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+
+_clients = {}
+_sessions = {}
+_lock = threading.Lock()
+construction_times = {}
+
+def client_config(max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS, connect_timeout=5, read_timeout=120,
+                  tcp_keepalive=True, retry_mode="adaptive", max_attempts=4):
+    """Return a botocore Config with the tuned defaults."""
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=max_pool_connections,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        tcp_keepalive=tcp_keepalive,
+        retries={"mode": retry_mode, "max_attempts": max_attempts}
+    )
+
+def get_client(region=DEFAULT_REGION, profile=None, **config):
+    """Return the cached bedrock-runtime client for region, profile and config.
+
+    config takes the keyword arguments of client_config(). The first call for
+    a combination builds the client and records how long that took in
+    construction_times.
+    """
+    key = (region, profile, tuple(sorted(config.items())))
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    import boto3
+    # boto3 sessions are not thread-safe, so clients are built under the lock.
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            start_time = time.perf_counter()
+            session = _sessions.get(profile)
+            if session is None:
+                session = _sessions[profile] = boto3.Session(profile_name=profile)
+            client = session.client(
+                service_name="bedrock-runtime",
+                region_name=region,
+                config=client_config(**config)
+            )
+            construction_times[key] = time.perf_counter() - start_time
+            _clients[key] = client
+    return client
+
+def prewarm(client, connections=1):
+    """Open up to `connections` pooled connections and resolve credentials before the first real call.
+
+    Sends that many concurrent ListAsyncInvokes requests, which are free and
+    read-only. An access-denied answer still leaves the connection in the
+    pool, so errors are ignored. Returns the seconds spent.
+    """
+    start_time = time.perf_counter()
+
+    def ping():
+        try:
+            client.list_async_invokes(maxResults=1)
+        except Exception:
+            pass
+
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        for _ in range(connections):
+            executor.submit(ping)
+    return time.perf_counter() - start_time
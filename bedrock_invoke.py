@@ -0,0 +1,479 @@
+import json
+import time
+
+import fast_json
+from latency import end_call, start_call
+from model_adapters import get_adapter
+from response_cache import CacheHit
+from usage import DEFAULT_PRICE_TABLE
+
+def build_payload(model_id, prompt, max_tokens=100):
+    """Build the request payload for a single-turn prompt."""
+    return get_adapter(model_id).build_payload(prompt, max_tokens)
+
+class InvocationResult:
+    """The outcome of one call: the text plus its latency, token usage and cost.
+
+    latency is in seconds and covers the whole call. server_latency is the
+    time Bedrock reports spending on it, when it does. For a cached result
+    latency is None and cache_hit holds the CacheHit. For a streamed call,
+    stream_timings holds the StreamTimings. cost is in USD, or None when the
+    price table does not know the model. backend names the API used:
+    "invoke_model", "converse", or "batch" for a record of a batch inference
+    job, which has no latency of its own. cache_read_tokens and cache_write_tokens
+    count the input served from and written to Bedrock's prompt cache, and
+    are None when the model does not report them. coalesced marks a copy of
+    another caller's result, handed out by a SingleFlight; its latency is the
+    time spent waiting for it.
+    """
+
+    def __init__(self, model_id, text, latency, input_tokens=None, output_tokens=None, stop_reason=None, cost=None,
+                 stream_timings=None, cache_hit=None, region=None, server_latency=None, backend="invoke_model",
+                 cache_read_tokens=None, cache_write_tokens=None):
+        self.model_id = model_id
+        self.text = text
+        self.latency = latency
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.stop_reason = stop_reason
+        self.cost = cost
+        self.stream_timings = stream_timings
+        self.cache_hit = cache_hit
+        self.region = region
+        self.server_latency = server_latency
+        self.backend = backend
+        self.cache_read_tokens = cache_read_tokens
+        self.cache_write_tokens = cache_write_tokens
+        self.coalesced = False
+
+    @property
+    def client_overhead(self):
+        """Seconds of the latency spent outside Bedrock: client work plus the network."""
+        if self.latency is None or self.server_latency is None:
+            return None
+        return self.latency - self.server_latency
+
+    @property
+    def tokens_per_second(self):
+        if not self.output_tokens or not self.latency:
+            return None
+        return self.output_tokens / self.latency
+
+    def to_dict(self):
+        """Return the result as a flat, JSON-serializable dict."""
+        result = {
+            "response": self.text,
+            "latency": self.latency,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "stop_reason": self.stop_reason,
+            "cost": self.cost,
+            "tokens_per_second": self.tokens_per_second,
+            "server_latency": self.server_latency,
+            "client_overhead": self.client_overhead,
+            "backend": self.backend
+        }
+        if self.cache_hit is not None:
+            result.update(cached=True, lookup_time=self.cache_hit.lookup_time)
+            if self.cache_hit.similarity is not None:
+                result.update(similarity=self.cache_hit.similarity, matched_prompt=self.cache_hit.matched_prompt)
+        if self.stream_timings is not None:
+            result.update(
+                time_to_first_token=self.stream_timings.time_to_first_token,
+                mean_gap=self.stream_timings.mean_gap,
+                max_gap=self.stream_timings.max_gap
+            )
+        if self.region is not None:
+            result["region"] = self.region
+        if self.coalesced:
+            result["coalesced"] = True
+        if self.cache_read_tokens is not None or self.cache_write_tokens is not None:
+            result.update(cache_read_tokens=self.cache_read_tokens, cache_write_tokens=self.cache_write_tokens)
+        return result
+
+def invoke_bedrock_model(client, model_id, prompt, cache=None, recorder=None, prices=DEFAULT_PRICE_TABLE,
+                         max_tokens=100):
+    """Invoke an Amazon Bedrock model and return an InvocationResult.
+
+    The latency covers the whole call, from building the body to parsing the
+    response. Pass a LatencyRecorder to also record the time spent in each
+    phase. The cost comes from prices, a PriceTable. With a ResponseCache, a
+    cached response is returned without calling the model and is not
+    recorded, and a fresh response is stored in the cache. max_tokens caps
+    the output.
+    """
+    timer = start_call(client)
+    try:
+        adapter = get_adapter(model_id)
+        body = adapter.build_body(prompt, max_tokens)
+        timer.mark("serialize")
+        return _invoke_body(client, model_id, adapter, body, timer, cache, recorder, prices)
+    finally:
+        end_call()
+
+def invoke_bedrock_body(client, model_id, body, cache=None, recorder=None, prices=DEFAULT_PRICE_TABLE):
+    """Invoke a model with a request body that is already serialized, such as a chat history.
+
+    Otherwise works like invoke_bedrock_model. The "serialize" phase is left
+    to the caller that built the body.
+    """
+    timer = start_call(client)
+    try:
+        adapter = get_adapter(model_id)
+        timer.mark("serialize")
+        return _invoke_body(client, model_id, adapter, body, timer, cache, recorder, prices)
+    finally:
+        end_call()
+
+def _invoke_body(client, model_id, adapter, body, timer, cache, recorder, prices):
+    if cache is not None:
+        key = cache.key(model_id, body)
+        hit = _lookup(cache, key, model_id)
+        if hit is not None:
+            return hit
+        timer.mark("cache")
+
+    response = client.invoke_model(
+        modelId=model_id,
+        body=body
+    )
+    # botocore returns once the headers are in and leaves the body unread.
+    timer.mark("first_byte")
+    raw_body = response["body"].read()
+    timer.mark("read")
+    parsed = adapter.decode_response(raw_body)
+    timer.mark("parse")
+
+    result = _invoke_result(client, model_id, parsed, response, timer, prices)
+    if recorder is not None:
+        recorder.record(model_id, timer)
+    if cache is not None:
+        _store(cache, key, result)
+    return result
+
+def _invoke_result(client, model_id, parsed, response, timer, prices):
+    input_tokens, output_tokens = parsed.input_tokens, parsed.output_tokens
+    headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    if input_tokens is None or output_tokens is None:
+        # Some families leave usage out of the body; Bedrock always sends it as headers.
+        input_tokens = _header_count(headers, "x-amzn-bedrock-input-token-count", input_tokens)
+        output_tokens = _header_count(headers, "x-amzn-bedrock-output-token-count", output_tokens)
+    server_latency_ms = _header_count(headers, "x-amzn-bedrock-invocation-latency", None)
+
+    cache_read_tokens, cache_write_tokens = parsed.cache_read_tokens, parsed.cache_write_tokens
+    return InvocationResult(
+        model_id, parsed.text, timer.total, input_tokens, output_tokens, parsed.stop_reason,
+        prices.cost(model_id, input_tokens, output_tokens, cache_read_tokens, cache_write_tokens), region=_region(client),
+        server_latency=server_latency_ms / 1000 if server_latency_ms is not None else None,
+        cache_read_tokens=cache_read_tokens, cache_write_tokens=cache_write_tokens
+    )
+
+def _header_count(headers, name, default):
+    value = headers.get(name)
+    return int(value) if value is not None and value.isdigit() else default
+
+def _region(client):
+    return getattr(getattr(client, "meta", None), "region_name", None)
+
+def _store(cache, key, result):
+    cache.put(key, {
+        "text": result.text,
+        "latency": result.latency,
+        "input_tokens": result.input_tokens,
+        "output_tokens": result.output_tokens,
+        "stop_reason": result.stop_reason,
+        "cost": result.cost
+    })
+
+def _lookup(cache, key, model_id, backend="invoke_model", stream=False):
+    start_time = time.perf_counter()
+    value = cache.get(key)
+    if value is None:
+        return None
+    hit = CacheHit(time.perf_counter() - start_time, value["latency"], value.get("cost"))
+    # Nothing is billed for a cached answer. A streaming call's hit carries
+    # empty StreamTimings, so its record has the same fields as a streamed one.
+    return InvocationResult(
+        model_id, value["text"], None, value.get("input_tokens"), value.get("output_tokens"),
+        value.get("stop_reason"), 0.0, stream_timings=StreamTimings() if stream else None, cache_hit=hit,
+        backend=backend
+    )
+
+class StreamTimings:
+    """Timings for one streamed call, in seconds from when the request was sent.
+
+    Every timing is None for a call that never streamed, such as a cache hit.
+    """
+
+    def __init__(self):
+        self.time_to_first_token = None
+        self.inter_token_gaps = []
+        self.total = None
+
+    @property
+    def mean_gap(self):
+        if self.total is None:
+            return None
+        return sum(self.inter_token_gaps) / len(self.inter_token_gaps) if self.inter_token_gaps else 0.0
+
+    @property
+    def max_gap(self):
+        if self.total is None:
+            return None
+        return max(self.inter_token_gaps, default=0.0)
+
+def decode_stream_chunk(model_id, chunk):
+    """Return the text carried by one response-stream chunk, or None if it carries none."""
+    return get_adapter(model_id).stream_text(fast_json.loads(chunk["bytes"]))
+
+def stream_bedrock_model(client, model_id, prompt, timings=None, recorder=None, info=None, max_tokens=100):
+    """Invoke an Amazon Bedrock model with response streaming and yield text chunks as they arrive.
+
+    If a StreamTimings is passed, it is filled in as the stream is consumed.
+    If a LatencyRecorder is passed, the phases of the call are recorded once
+    the stream is exhausted. If a dict is passed as info, the token usage and
+    stop reason from the stream are stored in it. max_tokens caps the output.
+    """
+    timings = timings if timings is not None else StreamTimings()
+    info = info if info is not None else {}
+    timer = start_call(client)
+    try:
+        adapter = get_adapter(model_id)
+        body = adapter.build_body(prompt, max_tokens)
+        timer.mark("serialize")
+
+        start_time = time.perf_counter()
+        response = client.invoke_model_with_response_stream(
+            modelId=model_id,
+            body=body
+        )
+        timer.mark("first_byte")
+    finally:
+        end_call()
+
+    def texts():
+        for event in response["body"]:
+            text = _stream_event_text(adapter, event, info)
+            if text:
+                yield text
+
+    yield from _timed_tokens(texts(), timings, timer, start_time)
+    if recorder is not None:
+        recorder.record(model_id, timer)
+
+def _stream_event_text(adapter, event, info):
+    """Return the text of one invoke_model stream event, copying any usage or stop reason into info."""
+    if "chunk" not in event:
+        return None
+    decoded = fast_json.loads(event["chunk"]["bytes"])
+    text = adapter.stream_text(decoded)
+    if not text:
+        adapter.stream_info(decoded, info)
+    return text
+
+def _timed_tokens(texts, timings, timer, start_time):
+    """Pass texts through, filling in timings as each one arrives."""
+    last_token_time = None
+    for text in texts:
+        last_token_time = _token_arrived(timings, timer, start_time, last_token_time)
+        yield text
+    _stream_finished(timings, timer, start_time)
+
+def _token_arrived(timings, timer, start_time, last_token_time):
+    now = time.perf_counter()
+    if last_token_time is None:
+        timer.mark("first_token")
+        timings.time_to_first_token = now - start_time
+    else:
+        timings.inter_token_gaps.append(now - last_token_time)
+    return now
+
+def _stream_finished(timings, timer, start_time):
+    timings.total = time.perf_counter() - start_time
+    timer.mark("stream")
+    if timings.time_to_first_token is None:
+        # No text came back at all, so the first token is as late as the end.
+        timings.time_to_first_token = timings.total
+
+def invoke_bedrock_model_streaming(client, model_id, prompt, cache=None, recorder=None, prices=DEFAULT_PRICE_TABLE,
+                                   max_tokens=100):
+    """Stream a response to completion and return an InvocationResult with its StreamTimings.
+
+    With a ResponseCache, a cached response is returned without calling the
+    model. Streamed and non-streamed calls with the same max_tokens share
+    entries.
+    """
+    if cache is not None:
+        key = cache_key(cache, model_id, prompt, max_tokens=max_tokens)
+        hit = _lookup(cache, key, model_id, stream=True)
+        if hit is not None:
+            return hit
+
+    timings = StreamTimings()
+    info = {}
+    generated_text = "".join(stream_bedrock_model(client, model_id, prompt, timings, recorder, info, max_tokens))
+    result = _stream_result(client, model_id, generated_text, timings, info, prices)
+    if cache is not None:
+        _store(cache, key, result)
+    return result
+
+def _stream_result(client, model_id, text, timings, info, prices, backend="invoke_model"):
+    input_tokens, output_tokens = info.get("input_tokens"), info.get("output_tokens")
+    return InvocationResult(
+        model_id, text, timings.total, input_tokens, output_tokens, info.get("stop_reason"),
+        prices.cost(model_id, input_tokens, output_tokens), stream_timings=timings, region=_region(client),
+        server_latency=info.get("server_latency"), backend=backend
+    )
+
+# The Converse API takes the same request shape for every model family.
+# maxTokens matches the limit the invoke_model payloads use.
+CONVERSE_INFERENCE_CONFIG = {"maxTokens": 100}
+
+def _converse_request(prompt, max_tokens=100):
+    return {
+        "messages": [{"role": "user", "content": [{"text": prompt}]}],
+        "inferenceConfig": dict(CONVERSE_INFERENCE_CONFIG, maxTokens=max_tokens)
+    }
+
+def _converse_cache_key(cache, model_id, request):
+    # Prefixed so a Converse request never collides with an invoke_model body.
+    return cache.key(model_id, "converse\n" + json.dumps(request, sort_keys=True))
+
+def converse_bedrock_model(client, model_id, prompt, cache=None, recorder=None, prices=DEFAULT_PRICE_TABLE,
+                           max_tokens=100):
+    """Call a model through the Converse API and return an InvocationResult.
+
+    Takes the same arguments as invoke_bedrock_model. Converse uses one
+    request shape for every model family and reports token usage and its own
+    latency (metrics.latencyMs) in the response. botocore reads and parses
+    the response before returning, so body reading is part of "first_byte".
+    """
+    timer = start_call(client)
+    try:
+        request = _converse_request(prompt, max_tokens)
+        timer.mark("serialize")
+        return _converse(client, model_id, request, timer, cache, recorder, prices)
+    finally:
+        end_call()
+
+def converse_bedrock_request(client, model_id, request, cache=None, recorder=None, prices=DEFAULT_PRICE_TABLE):
+    """Call the Converse API with a full request: messages, and optionally system and inferenceConfig.
+
+    Otherwise works like converse_bedrock_model.
+    """
+    timer = start_call(client)
+    try:
+        timer.mark("serialize")
+        return _converse(client, model_id, request, timer, cache, recorder, prices)
+    finally:
+        end_call()
+
+def _converse(client, model_id, request, timer, cache, recorder, prices):
+    if cache is not None:
+        key = _converse_cache_key(cache, model_id, request)
+        hit = _lookup(cache, key, model_id, backend="converse")
+        if hit is not None:
+            return hit
+        timer.mark("cache")
+
+    response = client.converse(modelId=model_id, **request)
+    timer.mark("first_byte")
+    result = _converse_result(client, model_id, response, timer, prices)
+    if recorder is not None:
+        recorder.record(model_id, timer)
+    if cache is not None:
+        _store(cache, key, result)
+    return result
+
+def _converse_result(client, model_id, response, timer, prices):
+    generated_text = "".join(block["text"] for block in response["output"]["message"]["content"] if "text" in block)
+    timer.mark("parse")
+    usage = response.get("usage", {})
+    input_tokens, output_tokens = usage.get("inputTokens"), usage.get("outputTokens")
+    cache_read_tokens, cache_write_tokens = usage.get("cacheReadInputTokens"), usage.get("cacheWriteInputTokens")
+    latency_ms = response.get("metrics", {}).get("latencyMs")
+    return InvocationResult(
+        model_id, generated_text, timer.total, input_tokens, output_tokens, response.get("stopReason"),
+        prices.cost(model_id, input_tokens, output_tokens, cache_read_tokens, cache_write_tokens), region=_region(client),
+        server_latency=latency_ms / 1000 if latency_ms is not None else None, backend="converse",
+        cache_read_tokens=cache_read_tokens, cache_write_tokens=cache_write_tokens
+    )
+
+def stream_converse_model(client, model_id, prompt, timings=None, recorder=None, info=None, max_tokens=100):
+    """Call a model through the ConverseStream API and yield text chunks as they arrive.
+
+    timings, recorder, info and max_tokens work as they do for stream_bedrock_model.
+    """
+    timings = timings if timings is not None else StreamTimings()
+    info = info if info is not None else {}
+    timer = start_call(client)
+    try:
+        request = _converse_request(prompt, max_tokens)
+        timer.mark("serialize")
+
+        start_time = time.perf_counter()
+        response = client.converse_stream(modelId=model_id, **request)
+        timer.mark("first_byte")
+    finally:
+        end_call()
+
+    def texts():
+        for event in response["stream"]:
+            text = _converse_event_text(event, info)
+            if text:
+                yield text
+
+    yield from _timed_tokens(texts(), timings, timer, start_time)
+    if recorder is not None:
+        recorder.record(model_id, timer)
+
+def _converse_event_text(event, info):
+    """Return the text of one ConverseStream event, copying any usage or stop reason into info."""
+    if "contentBlockDelta" in event:
+        return event["contentBlockDelta"]["delta"].get("text")
+    if "messageStop" in event:
+        info["stop_reason"] = event["messageStop"].get("stopReason")
+    elif "metadata" in event:
+        usage = event["metadata"].get("usage", {})
+        info["input_tokens"] = usage.get("inputTokens")
+        info["output_tokens"] = usage.get("outputTokens")
+        latency_ms = event["metadata"].get("metrics", {}).get("latencyMs")
+        if latency_ms is not None:
+            info["server_latency"] = latency_ms / 1000
+    return None
+
+def converse_bedrock_model_streaming(client, model_id, prompt, cache=None, recorder=None, prices=DEFAULT_PRICE_TABLE,
+                                     max_tokens=100):
+    """Stream a Converse response to completion and return an InvocationResult with its StreamTimings."""
+    if cache is not None:
+        key = cache_key(cache, model_id, prompt, "converse", max_tokens)
+        hit = _lookup(cache, key, model_id, backend="converse", stream=True)
+        if hit is not None:
+            return hit
+
+    timings = StreamTimings()
+    info = {}
+    generated_text = "".join(stream_converse_model(client, model_id, prompt, timings, recorder, info, max_tokens))
+    result = _stream_result(client, model_id, generated_text, timings, info, prices, backend="converse")
+    if cache is not None:
+        _store(cache, key, result)
+    return result
+
+BACKENDS = {
+    "invoke_model": (invoke_bedrock_model, invoke_bedrock_model_streaming),
+    "converse": (converse_bedrock_model, converse_bedrock_model_streaming),
+}
+
+def cache_key(cache, model_id, prompt, backend="invoke_model", max_tokens=100):
+    """Return the cache key a backend's call for prompt would be stored under."""
+    if backend == "converse":
+        return _converse_cache_key(cache, model_id, _converse_request(prompt, max_tokens))
+    return cache.key(model_id, get_adapter(model_id).build_body(prompt, max_tokens))
+
+def get_invoke_function(backend="invoke_model", stream=False):
+    """Return the invoke function for a backend name, streaming or not."""
+    try:
+        plain, streaming = BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown backend {backend!r}; expected one of {sorted(BACKENDS)}") from None
+    return streaming if stream else plain
@@ -0,0 +1,293 @@
+"""Benchmark the client-side cost of invoking Bedrock models, against a local stand-in.
+
+Example:
+    python benchmark.py --iterations 500 --concurrency 1 4 16 --output bench.json
+    python benchmark.py --transport http --latency 0.05 --jitter 0.02 --baseline bench.json
+
+Three suites run for every model:
+    payload   building the request body, against the old build-dict-then-json.dumps path,
+              and filling a prompt template: str.format and build_body
+              (template_format_ns) against the compiled template's bytes
+              (template_compiled_ns)
+    parse     decoding a realistic response body and extracting the text,
+              with json.loads and parse_response (parse_ns) against
+              decode_response on the fast_json backend (decode_ns), and the
+              same for one response-stream chunk
+    invoke    invoke_bedrock_model end to end, once per concurrency level and
+              backend (--backends invoke_model converse)
+
+With the default zero simulated latency, invoke times are pure client
+overhead. --async runs the invoke suite on one asyncio event loop, through
+aiobotocore over http, with the concurrency level as the number of calls in
+flight, so levels in the thousands are practical:
+
+    python benchmark.py --async --transport http --latency 0.2 --concurrency 100 1000 4000 --iterations 8000
+
+Each invoke run also reports the mean server-side latency the stand-in
+claims and the client overhead on top of it. --transport http goes through a
+real boto3 client and the local HTTP stand-in, so botocore's signing and
+connection handling are included. The fast_json backend in use is recorded
+in the metadata.
+Results are written as JSON. --baseline compares them with an earlier file
+and exits non-zero on a regression.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fast_json
+from bedrock_async import get_async_invoke_function
+from bedrock_client import client_config
+from bedrock_invoke import BACKENDS, build_payload, get_invoke_function
+from fake_bedrock import (AsyncFakeBedrockClient, FakeBedrockClient, LatencyModel, response_body, serve, serve_async,
+                          stream_events)
+from latency import LatencyRecorder
+from model_adapters import get_adapter
+from templates import PromptTemplate
+
+DEFAULT_MODELS = ["amazon.nova-lite-v1:0", "anthropic.claude-3-sonnet-20240229-v1:0"]
+PROMPT = "Hello, What is Amazon Bedrock?"
+TEMPLATE = "You are a support agent for {product}. Answer {customer} in {language}, in at most {words} words: {question}"
+TEMPLATE_VARIABLES = {"product": "Amazon Bedrock", "customer": "Ana", "language": "English", "words": 80,
+                      "question": "How is on-demand pricing calculated?"}
+
+def time_per_op(fn, iterations, warmup):
+    """Return the mean nanoseconds per call of fn over iterations, after warmup calls."""
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter_ns()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter_ns() - start) / iterations
+
+def bench_payload(model_id, iterations, warmup):
+    adapter = get_adapter(model_id)
+    template = PromptTemplate(TEMPLATE)
+    return {
+        "build_body_ns": time_per_op(lambda: adapter.build_body(PROMPT), iterations, warmup),
+        "dict_and_dumps_ns": time_per_op(lambda: json.dumps(build_payload(model_id, PROMPT)), iterations, warmup),
+        "template_format_ns": time_per_op(lambda: adapter.build_body(TEMPLATE.format(**TEMPLATE_VARIABLES)),
+                                          iterations, warmup),
+        "template_compiled_ns": time_per_op(lambda: template.body(model_id, TEMPLATE_VARIABLES), iterations, warmup)
+    }
+
+def bench_parse(model_id, iterations, warmup):
+    adapter = get_adapter(model_id)
+    request = json.loads(adapter.build_body(PROMPT))
+    raw = json.dumps(response_body(model_id, request)).encode("utf-8")
+    chunk = next(json.dumps(event).encode("utf-8") for event in stream_events(model_id, request)
+                 if adapter.stream_text(event))
+    return {
+        "parse_ns": time_per_op(lambda: adapter.parse_response(json.loads(raw)), iterations, warmup),
+        "decode_ns": time_per_op(lambda: adapter.decode_response(raw), iterations, warmup),
+        "chunk_parse_ns": time_per_op(lambda: adapter.stream_text(json.loads(chunk)), iterations, warmup),
+        "chunk_decode_ns": time_per_op(lambda: adapter.stream_text(fast_json.loads(chunk)), iterations, warmup)
+    }
+
+def bench_invoke(client, model_id, iterations, warmup, concurrency, backend="invoke_model"):
+    """Run iterations calls spread over concurrency threads and return throughput and percentiles."""
+    invoke = get_invoke_function(backend)
+    for _ in range(warmup):
+        invoke(client, model_id, PROMPT)
+    recorder = LatencyRecorder()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = [future.result() for future in [executor.submit(invoke, client, model_id, PROMPT, recorder=recorder)
+                                                  for _ in range(iterations)]]
+    return _invoke_report(model_id, backend, concurrency, iterations, time.perf_counter() - start, results, recorder)
+
+async def bench_invoke_async(client, model_id, iterations, warmup, concurrency, backend="invoke_model"):
+    """Like bench_invoke, but with up to concurrency calls in flight on this thread's event loop."""
+    invoke = get_async_invoke_function(backend)
+    for _ in range(warmup):
+        await invoke(client, model_id, PROMPT)
+    recorder = LatencyRecorder()
+    slots = asyncio.Semaphore(concurrency)
+
+    async def call():
+        async with slots:
+            return await invoke(client, model_id, PROMPT, recorder=recorder)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(call() for _ in range(iterations)))
+    return _invoke_report(model_id, backend, concurrency, iterations, time.perf_counter() - start, results, recorder)
+
+def _invoke_report(model_id, backend, concurrency, iterations, elapsed, results, recorder):
+    server_latencies = [result.server_latency for result in results if result.server_latency is not None]
+    overheads = [result.client_overhead for result in results if result.client_overhead is not None]
+    return {
+        "backend": backend,
+        "concurrency": concurrency,
+        "calls_per_second": iterations / elapsed,
+        "server_latency_mean": sum(server_latencies) / len(server_latencies) if server_latencies else None,
+        "client_overhead_mean": sum(overheads) / len(overheads) if overheads else None,
+        "phases": recorder.summary()[model_id]
+    }
+
+def make_fake(args, fake_type=FakeBedrockClient):
+    return fake_type(
+        latency=LatencyModel(args.latency, args.jitter, args.distribution, args.seed),
+        seed=args.seed
+    )
+
+def make_client(args):
+    fake = make_fake(args)
+    if args.transport == "inprocess":
+        return fake, None
+
+    import boto3
+    server = serve(fake=fake)
+    start_time = time.perf_counter()
+    client = boto3.client(
+        service_name="bedrock-runtime",
+        region_name="us-east-1",
+        endpoint_url=f"http://127.0.0.1:{server.server_port}",
+        aws_access_key_id="benchmark",
+        aws_secret_access_key="benchmark",
+        config=client_config(max_pool_connections=max(args.concurrency))
+    )
+    args.client_construction = time.perf_counter() - start_time
+    return client, server
+
+def run(args):
+    if args.use_async:
+        results = asyncio.run(_run_async(args))
+        return {"meta": _metadata(args), "results": results}
+
+    client, server = make_client(args)
+    results = {}
+    try:
+        for model_id in args.models:
+            results[model_id] = {
+                "payload": bench_payload(model_id, args.iterations * 10, args.warmup),
+                "parse": bench_parse(model_id, args.iterations * 10, args.warmup),
+                "invoke": [bench_invoke(client, model_id, args.iterations, args.warmup, concurrency, backend)
+                           for backend in args.backends for concurrency in args.concurrency]
+            }
+    finally:
+        if server is not None:
+            server.shutdown()
+    return {"meta": _metadata(args), "results": results}
+
+async def _run_async(args):
+    if args.transport == "inprocess":
+        return await _bench_models_async(args, make_fake(args, AsyncFakeBedrockClient))
+
+    from aiobotocore.session import AioSession
+    # The stand-in shares the event loop, and so the core, with the client.
+    server = await serve_async(fake=make_fake(args))
+    try:
+        start_time = time.perf_counter()
+        async with AioSession().create_client(
+            "bedrock-runtime",
+            region_name="us-east-1",
+            endpoint_url=f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}",
+            aws_access_key_id="benchmark",
+            aws_secret_access_key="benchmark",
+            config=client_config(max_pool_connections=max(args.concurrency))
+        ) as client:
+            args.client_construction = time.perf_counter() - start_time
+            return await _bench_models_async(args, client)
+    finally:
+        server.close()
+
+async def _bench_models_async(args, client):
+    results = {}
+    for model_id in args.models:
+        results[model_id] = {
+            "payload": bench_payload(model_id, args.iterations * 10, args.warmup),
+            "parse": bench_parse(model_id, args.iterations * 10, args.warmup),
+            "invoke": [await bench_invoke_async(client, model_id, args.iterations, args.warmup, concurrency, backend)
+                       for backend in args.backends for concurrency in args.concurrency]
+        }
+    return results
+
+def _metadata(args):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "transport": args.transport,
+        "async": args.use_async,
+        "json_backend": fast_json.BACKEND,
+        "backends": args.backends,
+        "iterations": args.iterations,
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "distribution": args.distribution,
+        # Paid once per process; get_client() caches the client after that.
+        "client_construction_s": getattr(args, "client_construction", None)
+    }
+
+def _flatten(report):
+    """Yield (name, value) for each metric where a higher value is worse."""
+    for model_id, suites in report["results"].items():
+        for name, value in suites["payload"].items():
+            yield f"{model_id} payload {name}", value
+        for name, value in suites["parse"].items():
+            yield f"{model_id} parse {name}", value
+        for run in suites["invoke"]:
+            # invoke_model keeps the plain "invoke" name so older baselines still match.
+            backend = run.get("backend", "invoke_model")
+            suite = "invoke" if backend == "invoke_model" else backend
+            if report["meta"].get("async"):
+                suite = f"async {suite}"
+            yield f"{model_id} {suite} c={run['concurrency']} p50", run["phases"]["total"]["p50"]
+            yield f"{model_id} {suite} c={run['concurrency']} p99", run["phases"]["total"]["p99"]
+
+def compare(report, baseline, threshold):
+    """Return a line for every metric that is more than threshold (a fraction) worse than baseline."""
+    old = dict(_flatten(baseline))
+    regressions = []
+    for name, value in _flatten(report):
+        if old.get(name) and value > old[name] * (1 + threshold):
+            regressions.append(f"{name}: {old[name]:.6g} -> {value:.6g} (+{value / old[name] - 1:.1%})")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark invoke_bedrock_model against a local Bedrock stand-in.")
+    parser.add_argument("--models", nargs="+", default=DEFAULT_MODELS)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--backends", nargs="+", choices=sorted(BACKENDS), default=["invoke_model"])
+    parser.add_argument("--transport", choices=["inprocess", "http"], default="inprocess")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="run the invoke suite on an asyncio event loop (http needs aiobotocore)")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated mean service latency, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--distribution", default="lognormal", choices=["fixed", "uniform", "normal", "lognormal"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="earlier results file to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""Multi-turn conversations with Amazon Bedrock models.
+
+A ConversationSession holds the history of one chat and sends it with every
+turn. Each message is serialized once, when it joins the history, and a turn's
+body is those cached pieces spliced into a template. The encoding work per
+turn therefore stays flat as the history grows.
+
+Two things keep the input tokens down. A token budget drops the oldest turns
+once the history outgrows it, optionally folding them into a running summary.
+On models with Bedrock prompt caching, checkpoints mark the stable prefix of
+the history, so the next turn reads it from the cache instead of having the
+model process it again.
+"""
+import json
+import time
+
+from bedrock_invoke import converse_bedrock_request, invoke_bedrock_body, invoke_bedrock_model
+from model_adapters import base_model_id, get_adapter
+from usage import DEFAULT_PRICE_TABLE
+
+# Foundation models that accept prompt-cache checkpoints on Bedrock.
+PROMPT_CACHING_MODELS = {
+    "anthropic.claude-3-5-haiku-20241022-v1:0",
+    "anthropic.claude-3-7-sonnet-20250219-v1:0",
+    "anthropic.claude-sonnet-4-20250514-v1:0",
+    "anthropic.claude-opus-4-20250514-v1:0",
+    "amazon.nova-micro-v1:0",
+    "amazon.nova-lite-v1:0",
+    "amazon.nova-pro-v1:0",
+}
+# Bedrock does not cache a prefix shorter than this.
+MIN_CACHE_TOKENS = 1024
+# The checkpoint the last turn wrote, which this turn reads, and the one this
+# turn writes. Bedrock allows more, but older ones are never read again.
+CACHE_CHECKPOINTS = 2
+# Dropping turns changes the prefix and so empties the prompt cache. Cutting
+# well below the budget means that happens every few turns, not every turn.
+TRUNCATE_TO = 0.75
+# For sizing text before the model has counted it.
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+class _Message:
+    """One message in the history, kept with its serialized form."""
+
+    def __init__(self, role, text, tokens):
+        self.role = role
+        self.text = text
+        self.tokens = tokens
+        self.checkpoint = False
+        self.fragment = None
+
+class ConversationSession:
+    """One chat with one model, sent a turn at a time.
+
+    backend is "invoke_model", for the families whose bodies take a message
+    list (Anthropic and Nova), or "converse", for any model.
+    max_history_tokens is the input budget for system prompt plus history;
+    None keeps every turn. summarize, if given, is called as
+    summarize(summary, dropped) with the current summary (or None) and the
+    dropped (role, text) pairs, and returns the new summary, which goes out
+    in the system prompt. prompt_caching defaults to whether the model
+    supports it. cache, recorder and prices are passed on to every call.
+    """
+
+    def __init__(self, client, model_id, system=None, max_tokens=100, backend="invoke_model", max_history_tokens=None,
+                 summarize=None, prompt_caching=None, cache=None, recorder=None, prices=DEFAULT_PRICE_TABLE):
+        if backend not in ("invoke_model", "converse"):
+            raise ValueError(f"Unknown backend {backend!r}; expected 'invoke_model' or 'converse'")
+        self.client = client
+        self.model_id = model_id
+        self.system = system
+        self.max_tokens = max_tokens
+        self.backend = backend
+        self.max_history_tokens = max_history_tokens
+        self.summarize = summarize
+        self.prompt_caching = base_model_id(model_id) in PROMPT_CACHING_MODELS if prompt_caching is None else prompt_caching
+        self.cache = cache
+        self.recorder = recorder
+        self.prices = prices
+        self.adapter = get_adapter(model_id) if backend == "invoke_model" else None
+        self.messages = []
+        self.summary = None
+        self.turns = []
+        self.truncated_tokens = 0
+        self._template = None
+        self._template_system = None
+        self._encoded_bytes = 0
+        if self.adapter is not None:
+            try:
+                self._chat_template(self._system())
+            except NotImplementedError:
+                raise ValueError(f"{model_id!r} takes no message history through invoke_model; "
+                                 f"use backend='converse'") from None
+
+    def _system(self):
+        if self.summary is None:
+            return self.system
+        summary = f"Summary of the earlier conversation: {self.summary}"
+        return f"{self.system}\n\n{summary}" if self.system else summary
+
+    def _chat_template(self, system):
+        if self._template is None or self._template_system != system:
+            self._template = self.adapter.chat_template(self.max_tokens, system)
+            self._template_system = system
+        return self._template
+
+    def history_tokens(self):
+        """Return the input tokens the next turn would send, before its new message."""
+        system = self._system()
+        return sum(message.tokens for message in self.messages) + (estimate_tokens(system) if system else 0)
+
+    def send(self, text):
+        """Send one user message and return the reply as an InvocationResult.
+
+        The message and the reply join the history. If the call fails, the
+        history is put back as it was, dropped turns, summary and checkpoints
+        included, so the turn can be retried.
+        """
+        snapshot = self._snapshot()
+        user = _Message("user", text, estimate_tokens(text))
+        self.messages.append(user)
+        try:
+            dropped_tokens = self._fit_budget()
+            self._place_checkpoints()
+            start_time = time.perf_counter()
+            request = self._request()
+            serialize_time = time.perf_counter() - start_time
+            if self.adapter is not None:
+                result = invoke_bedrock_body(self.client, self.model_id, request, self.cache, self.recorder,
+                                             self.prices)
+            else:
+                result = converse_bedrock_request(self.client, self.model_id, request, self.cache, self.recorder,
+                                                  self.prices)
+        except Exception:
+            self._restore(snapshot)
+            raise
+
+        cache_read, cache_write = result.cache_read_tokens or 0, result.cache_write_tokens or 0
+        if result.input_tokens is not None:
+            # The model counted the whole input; whatever the estimates missed
+            # is put down to the new message.
+            prompt_tokens = result.input_tokens + cache_read + cache_write
+            user.tokens = max(1, prompt_tokens - (self.history_tokens() - user.tokens))
+        reply = _Message("assistant", result.text, result.output_tokens or estimate_tokens(result.text))
+        self.messages.append(reply)
+        self._encode(reply)
+        self.turns.append({
+            "turn": len(self.turns) + 1,
+            "messages": len(self.messages) - 1,
+            "input_tokens": result.input_tokens,
+            "cache_read_tokens": result.cache_read_tokens,
+            "cache_write_tokens": result.cache_write_tokens,
+            "output_tokens": result.output_tokens,
+            "dropped_tokens": dropped_tokens,
+            # Input this turn did not have the model process in full: the
+            # prefix read from the prompt cache, plus every turn truncated so far.
+            "saved_input_tokens": cache_read + self.truncated_tokens,
+            # botocore serializes Converse requests itself, so only invoke_model bodies are measured.
+            "encoded_bytes": self._encoded_bytes if self.adapter is not None else None,
+            "body_bytes": len(request) if self.adapter is not None else None,
+            "serialize_time": serialize_time,
+            "latency": result.latency,
+            "cost": result.cost
+        })
+        self._encoded_bytes = 0
+        return result
+
+    def _snapshot(self):
+        return (list(self.messages), [(message.checkpoint, message.fragment) for message in self.messages],
+                self.summary, self.truncated_tokens, self._encoded_bytes)
+
+    def _restore(self, snapshot):
+        self.messages, marks, self.summary, self.truncated_tokens, self._encoded_bytes = snapshot
+        for message, (checkpoint, fragment) in zip(self.messages, marks):
+            message.checkpoint = checkpoint
+            message.fragment = fragment
+
+    def _fit_budget(self):
+        """Drop the oldest turns while the history is over budget and return the tokens dropped."""
+        if self.max_history_tokens is None or self.history_tokens() <= self.max_history_tokens:
+            return 0
+        target = self.max_history_tokens * TRUNCATE_TO
+        dropped = []
+        # Whole turns go, so the history still opens with a user message, and
+        # the new message always stays.
+        while len(self.messages) > 2 and self.history_tokens() > target:
+            dropped.extend(self.messages[:2])
+            del self.messages[:2]
+        if not dropped:
+            return 0
+        dropped_tokens = sum(message.tokens for message in dropped)
+        self.truncated_tokens += dropped_tokens
+        if self.summarize is not None:
+            self.summary = self.summarize(self.summary, [(message.role, message.text) for message in dropped])
+        return dropped_tokens
+
+    def _place_checkpoints(self):
+        """Put a checkpoint on the new message and keep only the newest CACHE_CHECKPOINTS."""
+        if not self.prompt_caching or self.history_tokens() < MIN_CACHE_TOKENS:
+            for message in self.messages:
+                self._encode(message)
+            return
+        newest = self.messages[-1]
+        newest.checkpoint = True
+        kept = 0
+        for message in reversed(self.messages):
+            if message.checkpoint:
+                kept += 1
+                if kept > CACHE_CHECKPOINTS:
+                    message.checkpoint = False
+                    message.fragment = None
+            self._encode(message)
+
+    def _encode(self, message):
+        """Serialize message unless it already is; only new or changed messages cost anything."""
+        if message.fragment is not None:
+            return
+        if self.adapter is None:
+            content = [{"text": message.text}]
+            if message.checkpoint:
+                content.append({"cachePoint": {"type": "default"}})
+            message.fragment = {"role": message.role, "content": content}
+        else:
+            message.fragment = json.dumps(self.adapter.message(message.role, message.text, message.checkpoint))
+            self._encoded_bytes += len(message.fragment)
+
+    def _request(self):
+        system = self._system()
+        if self.adapter is None:
+            request = {"messages": [message.fragment for message in self.messages],
+                       "inferenceConfig": {"maxTokens": self.max_tokens}}
+            if system is not None:
+                request["system"] = [{"text": system}]
+            return request
+        prefix, suffix = self._chat_template(system)
+        return prefix + "[" + ",".join(message.fragment for message in self.messages) + "]" + suffix
+
+    def report(self):
+        """Return the per-turn token usage as a text table, with the input tokens saved."""
+        lines = [f"{'turn':>4}{'msgs':>6}{'in tok':>9}{'cache rd':>10}{'cache wr':>10}{'out tok':>9}{'saved':>8}"
+                 f"{'encoded':>9}{'body':>9}{'latency':>9}"]
+        for turn in self.turns:
+            cells = [turn["input_tokens"], turn["cache_read_tokens"], turn["cache_write_tokens"], turn["output_tokens"]]
+            in_tok, cache_read, cache_write, out_tok = ("-" if value is None else value for value in cells)
+            encoded, body = ("-" if value is None else value for value in (turn["encoded_bytes"], turn["body_bytes"]))
+            latency = f"{turn['latency']:.4f}" if turn["latency"] is not None else "cached"
+            lines.append(
+                f"{turn['turn']:>4}{turn['messages']:>6}{in_tok:>9}{cache_read:>10}{cache_write:>10}{out_tok:>9}"
+                f"{turn['saved_input_tokens']:>8}{encoded:>9}{body:>9}{latency:>9}"
+            )
+        return "\n".join(lines)
+
+def model_summarizer(client, model_id):
+    """Return a summarize function for ConversationSession that has model_id write the summary."""
+
+    def summarize(summary, dropped):
+        lines = [f"Summary so far: {summary}"] if summary else []
+        lines.extend(f"{role}: {text}" for role, text in dropped)
+        prompt = ("Summarize this conversation in a few sentences. Keep names, facts and decisions.\n\n"
+                  + "\n".join(lines))
+        return invoke_bedrock_model(client, model_id, prompt).text
+
+    return summarize
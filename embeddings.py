@@ -0,0 +1,40 @@
+"""Text embeddings shared by the scorers, the semantic cache and the local stand-in.
+
+hashed_embedding needs no model and no call: a bag of words, each hashed to
+a dimension. It rewards shared words rather than shared meaning, which is
+enough for tests and offline runs. local_embedder loads a
+sentence-transformers model for real similarity.
+"""
+import hashlib
+import math
+import re
+import threading
+
+_WORD = re.compile(r"\w+")
+
+def tokens(text):
+    return _WORD.findall(text.lower())
+
+def hashed_embedding(text, dimensions=256):
+    """Return a unit bag-of-words vector for text, with each word hashed to a dimension.
+
+    A stand-in for a real embedding model: it rewards shared words, not
+    shared meaning.
+    """
+    vector = [0.0] * dimensions
+    for token in tokens(text):
+        digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+        vector[int.from_bytes(digest, "little") % dimensions] += 1.0
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector] if norm else vector
+
+def local_embedder(model_name="all-MiniLM-L6-v2"):
+    """Return an embed function backed by a local sentence-transformers model. Needs sentence-transformers."""
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(model_name)
+    lock = threading.Lock()
+
+    def embed(text):
+        with lock:
+            return model.encode(text, normalize_embeddings=True).tolist()
+    return embed
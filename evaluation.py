@@ -0,0 +1,251 @@
+"""Score model responses for quality while the calls are still going.
+
+An Evaluator runs a list of scorers over each result record on its own worker
+pool, so scoring never holds up the calls. Each scorer returns a score from
+0 to 1, or None when it does not apply to the record. The record gets
+"scores", {scorer name: score}, and "quality", the mean of the scores that
+apply, and is then written wherever the caller's callback sends it, so the
+scores are stored next to the latency and cost.
+
+The scorers:
+    ReferenceScorer  token F1 overlap with a reference answer
+    KeywordScorer    words or regular expressions that must, or must not,
+                     appear; a forbidden match scores 0
+    EmbeddingScorer  cosine similarity to a reference answer, with a local
+                     sentence-transformers model or a hashed bag-of-words
+                     stand-in
+    JudgeScorer      another model grades the response, called through the
+                     same invoke functions as the comparison itself
+"""
+import csv
+import json
+import re
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from bedrock_invoke import invoke_bedrock_model
+from embeddings import hashed_embedding, local_embedder, tokens
+
+def read_references(path):
+    """Return {prompt_id: reference} from a JSONL or CSV file with "id" and "reference" fields.
+
+    A prompt file whose records carry a "reference" works too; records
+    without one are left out.
+    """
+    references = {}
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for line_number, row in enumerate(rows, start=1):
+            if isinstance(row, dict) and row.get("reference"):
+                references[str(row.get("id") or line_number)] = row["reference"]
+    return references
+
+class Scorer:
+    """Base class for a scorer. when, a regular expression, limits it to prompts that match."""
+
+    name = None
+
+    def __init__(self, when=None):
+        self.when = re.compile(when) if when else None
+
+    def applies(self, record):
+        return self.when is None or self.when.search(record.get("prompt") or "") is not None
+
+    def score(self, record):
+        """Return a score from 0 to 1 for record's "response", or None if it does not apply."""
+        raise NotImplementedError
+
+class ReferenceScorer(Scorer):
+    """Token F1 between the response and the reference for the record's prompt ID or prompt text."""
+
+    name = "reference"
+
+    def __init__(self, references, when=None):
+        super().__init__(when)
+        self.references = references
+
+    def reference(self, record):
+        return self.references.get(record.get("prompt_id")) or self.references.get(record.get("prompt"))
+
+    def score(self, record):
+        reference = self.reference(record)
+        if reference is None or not self.applies(record):
+            return None
+        expected = Counter(tokens(reference))
+        actual = Counter(tokens(record["response"]))
+        overlap = sum((expected & actual).values())
+        if not overlap:
+            return 0.0
+        precision = overlap / sum(actual.values())
+        recall = overlap / sum(expected.values())
+        return 2 * precision * recall / (precision + recall)
+
+class KeywordScorer(Scorer):
+    """The share of required patterns the response matches, or 0 if it matches any forbidden one.
+
+    Patterns are case-insensitive regular expressions; plain words work as is.
+    """
+
+    name = "keywords"
+
+    def __init__(self, required=(), forbidden=(), when=None):
+        super().__init__(when)
+        self.required = [re.compile(pattern, re.IGNORECASE) for pattern in required]
+        self.forbidden = [re.compile(pattern, re.IGNORECASE) for pattern in forbidden]
+
+    def score(self, record):
+        if not self.applies(record) or not (self.required or self.forbidden):
+            return None
+        response = record["response"]
+        if any(pattern.search(response) for pattern in self.forbidden):
+            return 0.0
+        if not self.required:
+            return 1.0
+        return sum(1 for pattern in self.required if pattern.search(response)) / len(self.required)
+
+class EmbeddingScorer(ReferenceScorer):
+    """Cosine similarity between the response and the reference, floored at 0.
+
+    embed turns a text into a unit vector; the default is hashed_embedding.
+    Reference vectors are computed once.
+    """
+
+    name = "embedding"
+
+    def __init__(self, references, embed=hashed_embedding, when=None):
+        super().__init__(references, when)
+        self.embed = embed
+        self.reference_vectors = {}
+
+    def score(self, record):
+        reference = self.reference(record)
+        if reference is None or not self.applies(record):
+            return None
+        expected = self.reference_vectors.get(reference)
+        if expected is None:
+            expected = self.reference_vectors[reference] = self.embed(reference)
+        actual = self.embed(record["response"])
+        return max(0.0, sum(a * b for a, b in zip(expected, actual)))
+
+JUDGE_PROMPT = """You are grading an AI assistant's answer for factual accuracy and helpfulness.
+
+Question:
+{prompt}
+
+Answer:
+{response}
+{reference}
+Reply with a single integer from 1 (wrong or made up) to 10 (accurate and complete), and nothing else."""
+
+class JudgeScorer(ReferenceScorer):
+    """Asks a judge model to grade the response from 1 to 10, scaled to 0.1-1.
+
+    The judge is called with invoke(client, model_id, prompt, **kwargs), so a
+    cache, recorder or resilience wrapper can be used as for any other call.
+    A reply without a grade scores None. A reference answer, when there is
+    one, is shown to the judge.
+    """
+
+    name = "judge"
+
+    def __init__(self, client, model_id, invoke=invoke_bedrock_model, references=None, when=None, **kwargs):
+        super().__init__(references or {}, when)
+        self.client = client
+        self.model_id = model_id
+        self.invoke = invoke
+        self.kwargs = kwargs
+
+    def score(self, record):
+        if not self.applies(record):
+            return None
+        reference = self.reference(record)
+        prompt = JUDGE_PROMPT.format(prompt=record.get("prompt") or "", response=record["response"],
+                                     reference=f"\nReference answer:\n{reference}\n" if reference else "")
+        result = self.invoke(self.client, self.model_id, prompt, **self.kwargs)
+        grade = re.search(r"\b(10|[1-9])\b", result.text)
+        return int(grade.group(1)) / 10 if grade else None
+
+class Evaluator:
+    """Scores result records on a worker pool. Safe to share between threads.
+
+    submit() returns at once; the record is scored in place and then handed
+    to on_scored. join() waits for everything submitted so far.
+    """
+
+    def __init__(self, scorers, max_workers=4):
+        self.scorers = list(scorers)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="evaluator")
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.models = {}
+
+    def submit(self, record, on_scored=None):
+        """Queue record, a dict with "response" and "prompt", for scoring and return a Future of it.
+
+        Records without a response, such as failed calls, pass straight
+        through unscored.
+        """
+        future = self.executor.submit(self._score, record, on_scored)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    def _score(self, record, on_scored):
+        if record.get("response") is not None:
+            self.score(record)
+        if on_scored is not None:
+            on_scored(record)
+        return record
+
+    def score(self, record):
+        """Add "scores" and "quality" to record now, on the calling thread, and return it."""
+        scores = {}
+        for scorer in self.scorers:
+            try:
+                scores[scorer.name] = scorer.score(record)
+            except Exception as e:
+                scores[scorer.name] = None
+                record.setdefault("score_errors", {})[scorer.name] = f"{type(e).__name__}: {e}"
+        applied = [score for score in scores.values() if score is not None]
+        record["scores"] = scores
+        record["quality"] = sum(applied) / len(applied) if applied else None
+        if record["quality"] is not None:
+            with self.lock:
+                totals = self.models.setdefault(record.get("model_id"), {"scored": 0, "quality": 0.0})
+                totals["scored"] += 1
+                totals["quality"] += record["quality"]
+        return record
+
+    def join(self):
+        """Wait until every record submitted so far is scored."""
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending)
+        for future in pending:
+            # Raises any error from an on_scored callback.
+            future.result()
+
+    def close(self):
+        self.join()
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def summary(self):
+        """Return {model_id: {"scored", "quality"}} with the mean quality of each model's scored records."""
+        with self.lock:
+            return {model_id: {"scored": totals["scored"], "quality": totals["quality"] / totals["scored"]}
+                    for model_id, totals in self.models.items()}
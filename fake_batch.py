@@ -0,0 +1,166 @@
+"""Local stand-ins for S3 and Bedrock batch inference jobs, for offline runs.
+
+FakeS3Client keeps objects in memory and has the few S3 methods the batch
+pipeline uses. FakeBedrockBatchClient has the model-invocation-job methods
+of a boto3 "bedrock" client. A job reads its input records from the fake S3,
+answers each with the body fake_bedrock would return for it, and writes the
+output records and manifest where Bedrock puts them. It stays InProgress for
+job_seconds after it is created.
+"""
+import io
+import json
+import threading
+import time
+import uuid
+
+from batch_inference import split_s3_uri
+from fake_bedrock import ClientError, response_body
+
+class _Body:
+    """The parts of botocore's StreamingBody the pipeline reads through."""
+
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    def read(self, amt=None):
+        return self._stream.read(amt)
+
+    def iter_lines(self, chunk_size=1024, keepends=False):
+        for line in self._stream:
+            yield line if keepends else line.rstrip(b"\r\n")
+
+    def close(self):
+        self._stream.close()
+
+class FakeS3Client:
+    """An in-memory S3 with upload_file, put_object, get_object and list_objects_v2."""
+
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        with open(Filename, "rb") as f:
+            self.put_object(Bucket=Bucket, Key=Key, Body=f.read())
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        data = Body.encode("utf-8") if isinstance(Body, str) else bytes(Body)
+        with self.lock:
+            self.objects[(Bucket, Key)] = data
+        return {"ETag": f'"{uuid.uuid5(uuid.NAMESPACE_URL, Key).hex}"'}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        with self.lock:
+            data = self.objects.get((Bucket, Key))
+        if data is None:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": "The specified key does not exist."}},
+                              "GetObject")
+        return {"Body": _Body(data), "ContentLength": len(data)}
+
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None, MaxKeys=1000, **kwargs):
+        with self.lock:
+            keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        if ContinuationToken is not None:
+            keys = [key for key in keys if key > ContinuationToken]
+        page = keys[:MaxKeys]
+        response = {
+            "Contents": [{"Key": key, "Size": len(self.objects[(Bucket, key)])} for key in page],
+            "KeyCount": len(page),
+            "IsTruncated": len(keys) > MaxKeys
+        }
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = page[-1]
+        return response
+
+class FakeBedrockBatchClient:
+    """create_model_invocation_job, get_model_invocation_job and stop_model_invocation_job against a FakeS3Client."""
+
+    def __init__(self, s3, job_seconds=0.0, region_name="us-east-1"):
+        self.s3 = s3
+        self.job_seconds = job_seconds
+        self.region_name = region_name
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def create_model_invocation_job(self, jobName, roleArn, modelId, inputDataConfig, outputDataConfig, **kwargs):
+        job_id = uuid.uuid4().hex[:12]
+        job_arn = f"arn:aws:bedrock:{self.region_name}:123456789012:model-invocation-job/{job_id}"
+        now = time.time()
+        with self.lock:
+            self.jobs[job_arn] = {
+                "jobArn": job_arn,
+                "jobName": jobName,
+                "modelId": modelId,
+                "roleArn": roleArn,
+                "status": "Submitted",
+                "submitTime": now,
+                "lastModifiedTime": now,
+                "inputDataConfig": inputDataConfig,
+                "outputDataConfig": outputDataConfig
+            }
+        return {"jobArn": job_arn}
+
+    def get_model_invocation_job(self, jobIdentifier):
+        with self.lock:
+            job = self.jobs.get(jobIdentifier)
+            if job is None:
+                raise ClientError({"Error": {"Code": "ResourceNotFoundException",
+                                             "Message": f"Job {jobIdentifier} not found"}},
+                                  "GetModelInvocationJob")
+            if job["status"] in ("Submitted", "InProgress"):
+                if time.time() - job["submitTime"] < self.job_seconds:
+                    job["status"] = "InProgress"
+                else:
+                    self._run(job)
+            return dict(job)
+
+    def stop_model_invocation_job(self, jobIdentifier):
+        with self.lock:
+            job = self.jobs[jobIdentifier]
+            if job["status"] in ("Submitted", "InProgress"):
+                job.update(status="Stopped", lastModifiedTime=time.time())
+        return {}
+
+    def _run(self, job):
+        input_uri = job["inputDataConfig"]["s3InputDataConfig"]["s3Uri"]
+        input_bucket, input_key = split_s3_uri(input_uri)
+        output_bucket, output_prefix = split_s3_uri(job["outputDataConfig"]["s3OutputDataConfig"]["s3Uri"])
+        # Bedrock writes under a folder named for the job ID, next to the input file's name.
+        folder = output_prefix.rstrip("/") + "/" + job["jobArn"].rpartition("/")[2] + "/"
+        input_name = input_key.rpartition("/")[2]
+        try:
+            lines = self.s3.get_object(Bucket=input_bucket, Key=input_key)["Body"].iter_lines()
+        except ClientError:
+            job.update(status="Failed", message=f"Input file {input_uri} not found", lastModifiedTime=time.time())
+            return
+
+        output = io.StringIO()
+        processed = succeeded = input_tokens = output_tokens = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            processed += 1
+            record = json.loads(line)
+            try:
+                model_output = response_body(job["modelId"], record["modelInput"])
+            except Exception as e:
+                record["error"] = {"errorCode": 400, "errorMessage": f"Malformed input request: {e}"}
+            else:
+                record["modelOutput"] = model_output
+                succeeded += 1
+                usage = model_output.get("usage", {})
+                input_tokens += usage.get("input_tokens", usage.get("inputTokens", 0))
+                output_tokens += usage.get("output_tokens", usage.get("outputTokens", 0))
+            output.write(json.dumps(record) + "\n")
+        self.s3.put_object(Bucket=output_bucket, Key=folder + input_name + ".out", Body=output.getvalue())
+        self.s3.put_object(Bucket=output_bucket, Key=folder + "manifest.json.out", Body=json.dumps({
+            "totalRecordCount": processed,
+            "processedRecordCount": processed,
+            "successRecordCount": succeeded,
+            "errorRecordCount": processed - succeeded,
+            "inputTokenCount": input_tokens,
+            "outputTokenCount": output_tokens
+        }))
+        now = time.time()
+        job.update(status="Completed" if succeeded == processed else "PartiallyCompleted", endTime=now,
+                   lastModifiedTime=now)
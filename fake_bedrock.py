@@ -0,0 +1,667 @@
+"""A local stand-in for the bedrock-runtime service, for benchmarks and offline runs.
+
+FakeBedrockClient has the same invoke_model,
+invoke_model_with_response_stream, converse and converse_stream methods as a
+boto3 client. It answers in-process with Anthropic- or Nova-shaped bodies,
+or Converse-shaped ones, after a simulated delay. Titan Text Embeddings
+model IDs get a hashed bag-of-words vector, which is close for prompts that
+share words, in place of a learned embedding. Server-side latency
+metrics report that delay. Input tokens are the words of the whole request,
+and prompt-cache checkpoints are honoured: a prefix seen before at a
+checkpoint is reported as read from the cache.
+
+AsyncFakeBedrockClient has the same methods as coroutines, the way an
+aiobotocore client has them.
+
+serve() puts the same responses behind a local HTTP endpoint. A real boto3
+client pointed at it with endpoint_url goes through botocore's full request
+path: parameter validation, SigV4 signing, the connection pool and
+event-stream decoding. serve_async() does the same from an asyncio event
+loop, for thousands of concurrent connections.
+
+    python fake_bedrock.py --port 8765 --latency 0.2 --jitter 0.05
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import math
+import random
+import re
+import socket
+import struct
+import threading
+import time
+import zlib
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+from embeddings import hashed_embedding
+from model_adapters import get_adapter
+
+try:
+    from botocore.exceptions import ClientError
+except ImportError:
+    class ClientError(Exception):
+        """Stands in for botocore's ClientError when botocore is not installed."""
+
+        def __init__(self, error_response, operation_name):
+            super().__init__(f"An error occurred ({error_response['Error']['Code']}) when calling "
+                             f"the {operation_name} operation: {error_response['Error']['Message']}")
+            self.response = error_response
+            self.operation_name = operation_name
+
+_WORDS = (
+    "Amazon Bedrock is a fully managed service that offers a choice of high performing foundation models "
+    "from leading AI companies through a single API along with a broad set of capabilities you need to "
+    "build generative AI applications with security privacy and responsible AI"
+).split()
+
+class LatencyModel:
+    """Draws simulated delays, in seconds.
+
+    distribution is "fixed", "uniform" (mean +/- jitter), "normal" (jitter is
+    the standard deviation) or "lognormal" (jitter is the standard deviation,
+    with the long right tail real services show).
+    """
+
+    def __init__(self, mean=0.0, jitter=0.0, distribution="lognormal", seed=None):
+        if distribution not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Unknown latency distribution {distribution!r}")
+        self.mean = mean
+        self.jitter = jitter
+        self.distribution = distribution
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample(self):
+        if self.mean <= 0 or self.jitter <= 0 or self.distribution == "fixed":
+            return max(0.0, self.mean)
+        with self.lock:
+            if self.distribution == "uniform":
+                value = self.random.uniform(self.mean - self.jitter, self.mean + self.jitter)
+            elif self.distribution == "normal":
+                value = self.random.gauss(self.mean, self.jitter)
+            else:
+                # Pick mu and sigma so the delay has the requested mean and deviation.
+                sigma2 = math.log(1 + (self.jitter / self.mean) ** 2)
+                value = self.random.lognormvariate(math.log(self.mean) - sigma2 / 2, math.sqrt(sigma2))
+        return max(0.0, value)
+
+def generate_text(prompt, max_tokens):
+    """Return deterministic filler text of max_tokens words for prompt."""
+    offset = zlib.crc32(prompt.encode("utf-8")) % len(_WORDS)
+    return " ".join(_WORDS[(offset + i) % len(_WORDS)] for i in range(max_tokens)) + "."
+
+def _prompt_and_max_tokens(request):
+    """Pull the prompt text and token limit out of an Anthropic or Nova request."""
+    if "anthropic_version" in request:
+        max_tokens = request.get("max_tokens", 100)
+    else:
+        max_tokens = request.get("inferenceConfig", {}).get("max_new_tokens", 100)
+    content = request["messages"][-1]["content"]
+    return "".join(block.get("text", "") for block in content), max_tokens
+
+def _input_tokens(request, prompt_cache=None):
+    """Return (processed, cache read, cache write) input token counts for request.
+
+    Tokens are words. The cache counts are None when the request has no
+    checkpoints. prompt_cache is a set shared across one model's calls that remembers
+    the prefix ending at each checkpoint.
+    """
+    system = request.get("system") or []
+    blocks = [("system", {"text": system})] if isinstance(system, str) else [("system", block) for block in system]
+    for message in request["messages"]:
+        blocks.extend((message["role"], block) for block in message["content"])
+    digest = hashlib.sha256()
+    tokens = 0
+    checkpoints = []
+    for role, block in blocks:
+        if "text" in block:
+            tokens += len(block["text"].split())
+            digest.update(f"{role}\0{block['text']}\0".encode("utf-8"))
+        if "cache_control" in block or "cachePoint" in block:
+            checkpoints.append((digest.hexdigest(), tokens))
+    if not checkpoints:
+        return tokens, None, None
+    if prompt_cache is None:
+        return tokens, 0, 0
+    read = max((prefix_tokens for key, prefix_tokens in checkpoints if key in prompt_cache), default=0)
+    write = max(0, checkpoints[-1][1] - read)
+    prompt_cache.update(key for key, _ in checkpoints)
+    return tokens - read - write, read, write
+
+def embedding_body(request):
+    """Return the body a Titan Text Embeddings model would send for request, with a unit vector."""
+    text = request["inputText"]
+    return {"embedding": hashed_embedding(text, request.get("dimensions", 1024)),
+            "inputTextTokenCount": len(text.split())}
+
+def response_body(model_id, request, prompt_cache=None):
+    """Return the decoded response body the model family would send for request."""
+    if "titan-embed" in model_id:
+        return embedding_body(request)
+    prompt, max_tokens = _prompt_and_max_tokens(request)
+    text = generate_text(prompt, max_tokens)
+    input_tokens, cache_read, cache_write = _input_tokens(request, prompt_cache)
+    output_tokens = max_tokens
+    if get_adapter(model_id).family == "anthropic":
+        usage = {"input_tokens": input_tokens, "output_tokens": output_tokens}
+        if cache_read is not None:
+            usage.update(cache_read_input_tokens=cache_read, cache_creation_input_tokens=cache_write)
+        return {
+            "id": f"msg_bdrk_{zlib.crc32(prompt.encode('utf-8')):08x}",
+            "type": "message",
+            "role": "assistant",
+            "model": model_id.split(".", 1)[-1],
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "max_tokens",
+            "stop_sequence": None,
+            "usage": usage
+        }
+    usage = {"inputTokens": input_tokens, "outputTokens": output_tokens, "totalTokens": input_tokens + output_tokens}
+    if cache_read is not None:
+        usage.update(cacheReadInputTokenCount=cache_read, cacheWriteInputTokenCount=cache_write)
+        usage["totalTokens"] += cache_read + cache_write
+    return {
+        "output": {"message": {"role": "assistant", "content": [{"text": text}]}},
+        "stopReason": "max_tokens",
+        "usage": usage
+    }
+
+def _chunks(text, words_per_chunk=4):
+    words = text.split(" ")
+    chunks = [" ".join(words[i:i + words_per_chunk]) for i in range(0, len(words), words_per_chunk)]
+    return [chunk + " " for chunk in chunks[:-1]] + chunks[-1:]
+
+def stream_events(model_id, request, latency_ms=0, prompt_cache=None):
+    """Return the decoded response-stream events the model family would send for request."""
+    body = response_body(model_id, request, prompt_cache)
+    chunks = _chunks(get_adapter(model_id).parse_response(body).text)
+    if get_adapter(model_id).family == "anthropic":
+        return [
+            {"type": "message_start", "message": {**body, "content": [], "stop_reason": None}},
+            {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+            *({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": chunk}}
+              for chunk in chunks),
+            {"type": "content_block_stop", "index": 0},
+            {"type": "message_delta", "delta": {"stop_reason": body["stop_reason"]},
+             "usage": {"output_tokens": body["usage"]["output_tokens"]}},
+            {"type": "message_stop", "amazon-bedrock-invocationMetrics": _invocation_metrics(
+                body["usage"]["input_tokens"], body["usage"]["output_tokens"], latency_ms
+            )}
+        ]
+    return [
+        {"messageStart": {"role": "assistant"}},
+        *({"contentBlockDelta": {"delta": {"text": chunk}, "contentBlockIndex": 0}} for chunk in chunks),
+        {"contentBlockStop": {"contentBlockIndex": 0}},
+        {"messageStop": {"stopReason": body["stopReason"]}},
+        {"metadata": {"usage": body["usage"]}, "amazon-bedrock-invocationMetrics": _invocation_metrics(
+            body["usage"]["inputTokens"], body["usage"]["outputTokens"], latency_ms
+        )}
+    ]
+
+def _invocation_metrics(input_tokens, output_tokens, latency_ms):
+    # Bedrock appends these to the last event of every stream.
+    return {"inputTokenCount": input_tokens, "outputTokenCount": output_tokens,
+            "invocationLatency": latency_ms, "firstByteLatency": latency_ms}
+
+def _response_headers(model_id, body, latency_ms):
+    if "embedding" in body:
+        input_tokens, output_tokens = body["inputTextTokenCount"], 0
+    else:
+        parsed = get_adapter(model_id).parse_response(body)
+        input_tokens, output_tokens = parsed.input_tokens, parsed.output_tokens
+    return {
+        "x-amzn-bedrock-input-token-count": str(input_tokens),
+        "x-amzn-bedrock-output-token-count": str(output_tokens),
+        "x-amzn-bedrock-invocation-latency": str(latency_ms)
+    }
+
+def converse_response(messages, inference_config, latency_ms=0, system=None, prompt_cache=None):
+    """Return the response the Converse API would send for messages."""
+    request = {
+        "system": system or [],
+        "messages": messages,
+        "inferenceConfig": {"max_new_tokens": (inference_config or {}).get("maxTokens", 100)}
+    }
+    body = response_body("amazon.nova-lite-v1:0", request, prompt_cache)
+    usage = dict(body["usage"])
+    if "cacheReadInputTokenCount" in usage:
+        usage["cacheReadInputTokens"] = usage.pop("cacheReadInputTokenCount")
+        usage["cacheWriteInputTokens"] = usage.pop("cacheWriteInputTokenCount")
+    return {
+        "output": body["output"],
+        "stopReason": body["stopReason"],
+        "usage": usage,
+        "metrics": {"latencyMs": latency_ms}
+    }
+
+def converse_stream_events(messages, inference_config, latency_ms=0, system=None, prompt_cache=None):
+    """Return the (event type, event) pairs the ConverseStream API would send for messages."""
+    response = converse_response(messages, inference_config, latency_ms, system, prompt_cache)
+    return [
+        ("messageStart", {"role": "assistant"}),
+        *(("contentBlockDelta", {"delta": {"text": chunk}, "contentBlockIndex": 0})
+          for chunk in _chunks(response["output"]["message"]["content"][0]["text"])),
+        ("contentBlockStop", {"contentBlockIndex": 0}),
+        ("messageStop", {"stopReason": response["stopReason"]}),
+        ("metadata", {"usage": response["usage"], "metrics": response["metrics"]})
+    ]
+
+class FakeBedrockClient:
+    """An in-process bedrock-runtime client that answers from the stand-in model.
+
+    latency is the delay before the response headers. token_latency is the
+    delay between stream chunks. throttle_rate is the fraction of calls that
+    fail with a ThrottlingException. prompt_cache holds, per model ID, the
+    prefixes written at prompt-cache checkpoints, so one model never reads
+    another's; entries never expire. Safe to share between threads.
+    """
+
+    def __init__(self, latency=None, token_latency=None, throttle_rate=0.0, region_name="us-east-1", seed=None):
+        self.latency = latency or LatencyModel()
+        self.token_latency = token_latency or LatencyModel()
+        self.throttle_rate = throttle_rate
+        self.region_name = region_name
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.prompt_cache = {}
+        self.lock = threading.Lock()
+
+    def cache_for(self, model_id):
+        """Return the set of prompt-cache prefixes model_id has written."""
+        with self.lock:
+            return self.prompt_cache.setdefault(model_id, set())
+
+    def _begin(self):
+        """Count a call and return its simulated delay in seconds and whether it is throttled."""
+        with self.lock:
+            self.calls += 1
+            throttled = self.throttle_rate and self.random.random() < self.throttle_rate
+        return self.latency.sample(), throttled
+
+    def _start(self, operation_name):
+        """Wait out the simulated delay and return it in milliseconds, or raise a throttle."""
+        delay, throttled = self._begin()
+        if delay:
+            time.sleep(delay)
+        if throttled:
+            raise _throttle_error(operation_name)
+        return round(delay * 1000)
+
+    def _pause(self):
+        delay = self.token_latency.sample()
+        if delay:
+            time.sleep(delay)
+
+    def invoke_model(self, modelId, body, **kwargs):
+        latency_ms = self._start("InvokeModel")
+        return self._invoke_response(modelId, body, latency_ms, io.BytesIO)
+
+    def _invoke_response(self, model_id, body, latency_ms, body_type):
+        result = response_body(model_id, json.loads(body), self.cache_for(model_id))
+        return {
+            "body": body_type(json.dumps(result).encode("utf-8")),
+            "contentType": "application/json",
+            "ResponseMetadata": {"HTTPStatusCode": 200, "HTTPHeaders": _response_headers(model_id, result, latency_ms)}
+        }
+
+    def invoke_model_with_response_stream(self, modelId, body, **kwargs):
+        latency_ms = self._start("InvokeModelWithResponseStream")
+        return self._stream_response(modelId, body, latency_ms, self._stream)
+
+    def _stream_response(self, model_id, body, latency_ms, stream):
+        events = stream_events(model_id, json.loads(body), latency_ms, self.cache_for(model_id))
+        return {
+            "body": stream({"chunk": {"bytes": json.dumps(event).encode("utf-8")}} for event in events),
+            "contentType": "application/json",
+            "ResponseMetadata": {"HTTPStatusCode": 200, "HTTPHeaders": {}}
+        }
+
+    def converse(self, modelId, messages, inferenceConfig=None, system=None, **kwargs):
+        latency_ms = self._start("Converse")
+        return dict(converse_response(messages, inferenceConfig, latency_ms, system, self.cache_for(modelId)),
+                    ResponseMetadata={"HTTPStatusCode": 200, "HTTPHeaders": {}})
+
+    def converse_stream(self, modelId, messages, inferenceConfig=None, system=None, **kwargs):
+        latency_ms = self._start("ConverseStream")
+        events = converse_stream_events(messages, inferenceConfig, latency_ms, system, self.cache_for(modelId))
+        return {
+            "stream": self._stream({event_type: event} for event_type, event in events),
+            "ResponseMetadata": {"HTTPStatusCode": 200, "HTTPHeaders": {}}
+        }
+
+    def _stream(self, events):
+        for i, event in enumerate(events):
+            if i:
+                self._pause()
+            yield event
+
+def _throttle_error(operation_name):
+    return ClientError(
+        {"Error": {"Code": "ThrottlingException", "Message": "Too many requests, please wait before trying again."},
+         "ResponseMetadata": {"HTTPStatusCode": 429}},
+        operation_name
+    )
+
+class AsyncFakeBedrockClient(FakeBedrockClient):
+    """The in-process stand-in with coroutine methods, shaped like an aiobotocore client.
+
+    Delays are asyncio sleeps, so one event loop can hold thousands of calls
+    open at once. Bodies are read with await body.read() and streams with
+    async for, as with aiobotocore.
+    """
+
+    async def _astart(self, operation_name):
+        delay, throttled = self._begin()
+        if delay:
+            await asyncio.sleep(delay)
+        if throttled:
+            raise _throttle_error(operation_name)
+        return round(delay * 1000)
+
+    async def invoke_model(self, modelId, body, **kwargs):
+        latency_ms = await self._astart("InvokeModel")
+        return self._invoke_response(modelId, body, latency_ms, _AsyncBody)
+
+    async def invoke_model_with_response_stream(self, modelId, body, **kwargs):
+        latency_ms = await self._astart("InvokeModelWithResponseStream")
+        return self._stream_response(modelId, body, latency_ms, self._astream)
+
+    async def converse(self, modelId, messages, inferenceConfig=None, system=None, **kwargs):
+        latency_ms = await self._astart("Converse")
+        return dict(converse_response(messages, inferenceConfig, latency_ms, system, self.cache_for(modelId)),
+                    ResponseMetadata={"HTTPStatusCode": 200, "HTTPHeaders": {}})
+
+    async def converse_stream(self, modelId, messages, inferenceConfig=None, system=None, **kwargs):
+        latency_ms = await self._astart("ConverseStream")
+        events = converse_stream_events(messages, inferenceConfig, latency_ms, system, self.cache_for(modelId))
+        return {
+            "stream": self._astream({event_type: event} for event_type, event in events),
+            "ResponseMetadata": {"HTTPStatusCode": 200, "HTTPHeaders": {}}
+        }
+
+    def _astream(self, events):
+        return _AsyncEventStream(events, self.token_latency)
+
+class _AsyncBody:
+    """A response body read with await, like aiobotocore's StreamingBody."""
+
+    def __init__(self, data):
+        self.data = data
+
+    async def read(self):
+        return self.data
+
+    def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+class _AsyncEventStream:
+    """Events yielded with async for, a token delay apart, like aiobotocore's event streams."""
+
+    def __init__(self, events, token_latency):
+        self.events = events
+        self.token_latency = token_latency
+
+    async def __aiter__(self):
+        for i, event in enumerate(self.events):
+            if i:
+                delay = self.token_latency.sample()
+                if delay:
+                    await asyncio.sleep(delay)
+            yield event
+
+    def close(self):
+        pass
+
+def encode_event_message(headers, payload):
+    """Encode one message in the AWS event-stream binary format."""
+    encoded_headers = b""
+    for name, value in headers.items():
+        name, value = name.encode("utf-8"), value.encode("utf-8")
+        # Header value type 7 is a string with a 2-byte length.
+        encoded_headers += struct.pack("!B", len(name)) + name + struct.pack("!BH", 7, len(value)) + value
+    total_length = 12 + len(encoded_headers) + len(payload) + 4
+    prelude = struct.pack("!II", total_length, len(encoded_headers))
+    prelude += struct.pack("!I", zlib.crc32(prelude))
+    message = prelude + encoded_headers + payload
+    return message + struct.pack("!I", zlib.crc32(message))
+
+_ROUTE = re.compile(r"^/model/(?P<model_id>[^/]+)/(?P<operation>invoke|invoke-with-response-stream|converse|converse-stream)$")
+_OPERATIONS = {
+    "invoke": "InvokeModel",
+    "invoke-with-response-stream": "InvokeModelWithResponseStream",
+    "converse": "Converse",
+    "converse-stream": "ConverseStream",
+}
+
+def _route(path):
+    """Return (model_id, operation) for a request path, or None if the stand-in does not serve it."""
+    match = _ROUTE.match(path)
+    if match is None:
+        return None
+    return unquote(match["model_id"]), match["operation"]
+
+def _http_response(fake, model_id, operation, request_body, latency_ms):
+    """Return ("json", body, headers) or ("stream", [(event type, event), ...]) for a served request."""
+    request = json.loads(request_body)
+    if operation == "invoke":
+        result = response_body(model_id, request, fake.cache_for(model_id))
+        return "json", result, _response_headers(model_id, result, latency_ms)
+    if operation == "converse":
+        return "json", converse_response(request["messages"], request.get("inferenceConfig"), latency_ms,
+                                         request.get("system"), fake.cache_for(model_id)), {}
+    if operation == "converse-stream":
+        return "stream", converse_stream_events(request["messages"], request.get("inferenceConfig"), latency_ms,
+                                                request.get("system"), fake.cache_for(model_id))
+    return "stream", [
+        ("chunk", {"bytes": base64.b64encode(json.dumps(event).encode("utf-8")).decode("ascii")})
+        for event in stream_events(model_id, request, latency_ms, fake.cache_for(model_id))
+    ]
+
+def _error_response(status, code, message):
+    return status, {"message": message}, {"x-amzn-ErrorType": code}
+
+def _event_chunk(event_type, event):
+    """Return one event-stream message framed as an HTTP chunk."""
+    message = encode_event_message(
+        {":event-type": event_type, ":content-type": "application/json", ":message-type": "event"},
+        json.dumps(event).encode("utf-8")
+    )
+    return f"{len(message):x}\r\n".encode("ascii") + message + b"\r\n"
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out in separate writes. Without this, Nagle's
+        # algorithm holds the body back for a delayed ACK and adds ~40 ms.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):
+        route = _route(self.path)
+        request_body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if route is None:
+            self._send_json(*_error_response(404, "ResourceNotFoundException", f"Unknown path {self.path}"))
+            return
+        fake = self.server.fake
+        model_id, operation = route
+        try:
+            latency_ms = fake._start(_OPERATIONS[operation])
+        except ClientError as e:
+            self._send_json(*_error_response(429, e.response["Error"]["Code"], e.response["Error"]["Message"]))
+            return
+
+        kind, *response = _http_response(fake, model_id, operation, request_body, latency_ms)
+        if kind == "json":
+            self._send_json(200, *response)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.amazon.eventstream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, (event_type, event) in enumerate(response[0]):
+            if i:
+                fake._pause()
+            self.wfile.write(_event_chunk(event_type, event))
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default listen backlog of 5 drops connections when a benchmark
+    # opens many at once.
+    request_queue_size = 1024
+
+def serve(port=0, host="127.0.0.1", fake=None):
+    """Start the stand-in endpoint on a background thread and return the server.
+
+    Point a client at f"http://{host}:{server.server_port}" with endpoint_url,
+    and call server.shutdown() when done. fake supplies the latency and
+    throttle settings and defaults to a FakeBedrockClient with no delay.
+    """
+    server = _Server((host, port), _Handler)
+    server.fake = fake or FakeBedrockClient()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+async def serve_async(port=0, host="127.0.0.1", fake=None):
+    """Start the stand-in endpoint on the running event loop and return the asyncio server.
+
+    It serves the same routes as serve(), but every connection is a
+    coroutine rather than a thread, so one core can hold thousands of calls
+    open. The port is server.sockets[0].getsockname()[1]. Close it with
+    server.close().
+    """
+    fake = fake or FakeBedrockClient()
+    return await asyncio.start_server(lambda reader, writer: _serve_connection(fake, reader, writer), host, port,
+                                      backlog=4096)
+
+async def _serve_connection(fake, reader, writer):
+    writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        # One request after another on a kept-alive connection.
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            path = request_line.decode("latin-1").split(" ")[1]
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            request_body = await reader.readexactly(int(headers.get("content-length", 0)))
+            await _respond(fake, writer, path, request_body)
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def _respond(fake, writer, path, request_body):
+    route = _route(path)
+    if route is None:
+        writer.write(_json_message(*_error_response(404, "ResourceNotFoundException", f"Unknown path {path}")))
+        await writer.drain()
+        return
+    model_id, operation = route
+    delay, throttled = fake._begin()
+    if delay:
+        await asyncio.sleep(delay)
+    if throttled:
+        error = _throttle_error(_OPERATIONS[operation]).response["Error"]
+        writer.write(_json_message(*_error_response(429, error["Code"], error["Message"])))
+        await writer.drain()
+        return
+
+    kind, *response = _http_response(fake, model_id, operation, request_body, round(delay * 1000))
+    if kind == "json":
+        writer.write(_json_message(200, *response))
+        await writer.drain()
+        return
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/vnd.amazon.eventstream\r\n"
+                 b"Transfer-Encoding: chunked\r\n\r\n")
+    for i, (event_type, event) in enumerate(response[0]):
+        if i:
+            delay = fake.token_latency.sample()
+            if delay:
+                await asyncio.sleep(delay)
+        writer.write(_event_chunk(event_type, event))
+        await writer.drain()
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+def _json_message(status, body, headers=None):
+    """Return a complete HTTP/1.1 response carrying body as JSON."""
+    data = json.dumps(body).encode("utf-8")
+    lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}", "Content-Type: application/json",
+             f"Content-Length: {len(data)}"]
+    lines.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + data
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the bedrock-runtime endpoint.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="mean delay before the response, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--distribution", default="lognormal", choices=["fixed", "uniform", "normal", "lognormal"])
+    parser.add_argument("--token-latency", type=float, default=0.0, help="delay between stream chunks, in seconds")
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="serve from one asyncio event loop instead of a thread per connection")
+    args = parser.parse_args()
+
+    fake = FakeBedrockClient(
+        latency=LatencyModel(args.latency, args.jitter, args.distribution, args.seed),
+        token_latency=LatencyModel(args.token_latency),
+        throttle_rate=args.throttle_rate,
+        seed=args.seed
+    )
+    if args.use_async:
+        try:
+            asyncio.run(_serve_forever(args.port, fake))
+        except KeyboardInterrupt:
+            pass
+        return
+    server = serve(args.port, fake=fake)
+    print(f"Serving bedrock-runtime stand-in on http://127.0.0.1:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+async def _serve_forever(port, fake):
+    server = await serve_async(port, fake=fake)
+    print(f"Serving bedrock-runtime stand-in on http://127.0.0.1:{server.sockets[0].getsockname()[1]}")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    main()
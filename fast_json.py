@@ -0,0 +1,86 @@
+"""JSON decoding and encoding through the fastest library installed.
+
+msgspec is used when it is installed, then orjson, then the standard library.
+BACKEND names the one in use. loads() takes bytes or str, so a response body
+is decoded without first being turned into a str. dumps() returns a str and
+sorts no keys; its spacing depends on the backend, so nothing that must match
+byte for byte across installs, such as a cache key, should go through it.
+
+With msgspec, ANTHROPIC_RESPONSE and NOVA_RESPONSE decode an invoke_model
+response body straight into typed structs holding only the fields the
+adapters read: the text blocks, token usage and stop reason. Everything else
+in the body is skipped rather than built into dicts. Without msgspec they
+are None and the adapters decode the whole body with loads().
+"""
+import json
+from typing import List, Optional
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if msgspec is not None:
+    BACKEND = "msgspec"
+    loads = msgspec.json.Decoder().decode
+    _encode = msgspec.json.Encoder().encode
+
+    def dumps(obj):
+        return _encode(obj).decode("utf-8")
+elif orjson is not None:
+    BACKEND = "orjson"
+    loads = orjson.loads
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode("utf-8")
+else:
+    BACKEND = "json"
+    loads = json.loads
+    dumps = json.dumps
+
+ANTHROPIC_RESPONSE = None
+NOVA_RESPONSE = None
+
+if msgspec is not None:
+    class AnthropicBlock(msgspec.Struct):
+        type: str = "text"
+        text: str = ""
+
+    class AnthropicUsage(msgspec.Struct):
+        input_tokens: Optional[int] = None
+        output_tokens: Optional[int] = None
+        cache_read_input_tokens: Optional[int] = None
+        cache_creation_input_tokens: Optional[int] = None
+
+    class AnthropicResponse(msgspec.Struct):
+        content: List[AnthropicBlock] = []
+        usage: AnthropicUsage = msgspec.field(default_factory=AnthropicUsage)
+        stop_reason: Optional[str] = None
+
+    class NovaBlock(msgspec.Struct):
+        text: str = ""
+
+    class NovaMessage(msgspec.Struct):
+        content: List[NovaBlock]
+
+    class NovaOutput(msgspec.Struct):
+        message: NovaMessage
+
+    class NovaUsage(msgspec.Struct, rename="camel"):
+        input_tokens: Optional[int] = None
+        output_tokens: Optional[int] = None
+        cache_read_input_token_count: Optional[int] = None
+        cache_write_input_token_count: Optional[int] = None
+
+    class NovaResponse(msgspec.Struct, rename="camel"):
+        output: NovaOutput
+        usage: NovaUsage = msgspec.field(default_factory=NovaUsage)
+        stop_reason: Optional[str] = None
+
+    ANTHROPIC_RESPONSE = msgspec.json.Decoder(AnthropicResponse)
+    NOVA_RESPONSE = msgspec.json.Decoder(NovaResponse)
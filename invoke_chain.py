@@ -0,0 +1,82 @@
+"""Build the invoke function a run calls, with its caching, routing, retries and rate limits around it.
+
+compose_invoke() stacks the optional layers around a backend's invoke
+function in one fixed order, so batch_runner.py and pipeline.PromptPipeline
+make their calls the same way. TokenBucket is the per-model rate limit.
+"""
+import threading
+import time
+from functools import partial
+
+from bedrock_invoke import cache_key, get_invoke_function
+from usage import DEFAULT_PRICE_TABLE
+
+class TokenBucket:
+    """Block callers so that at most `rate` calls per second go through, with bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError(f"rate must be positive, got {rate!r}")
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            # Sleep outside the lock so other threads can refill and check too.
+            time.sleep(wait)
+
+def compose_invoke(backend="invoke_model", cache=None, recorder=None, router=None, prices=DEFAULT_PRICE_TABLE,
+                   resilience=None, single_flight=None, telemetry=None, semantic_cache=None, rate_limits=None,
+                   burst=None, max_tokens=100):
+    """Return invoke_model(client, model_id, prompt), a backend's invoke function with the given layers around it.
+
+    The arguments are those of batch_runner.run_matrix(), which calls through
+    this. The layers, from the inside out: telemetry, the cache and routing,
+    the rate limits, resilience, single flight and the semantic cache.
+    max_tokens caps every answer.
+    """
+    invoke = get_invoke_function(backend)
+    if telemetry is not None:
+        # Under the retries and routing, so each attempt in each region gets its own span.
+        invoke = telemetry.wrap(invoke)
+    buckets = {model_id: TokenBucket(rate, burst) for model_id, rate in (rate_limits or {}).items()}
+
+    def invoke_model(client, model_id, prompt, **options):
+        # Under the retries, so every retry and hedge pays for a token, and
+        # callers sharing another's call through SingleFlight pay nothing.
+        # Calls the ResponseCache answers send nothing, so they skip it too.
+        bucket = buckets.get(model_id)
+        if bucket is not None and not _is_cached(cache, model_id, prompt, backend, options["max_tokens"]):
+            bucket.acquire()
+        kwargs = dict(options, cache=cache, recorder=recorder, prices=prices)
+        if router is None:
+            return invoke(client, model_id, prompt, **kwargs)
+        result, region = router.invoke(model_id, prompt, invoke=invoke, **kwargs)
+        result.region = region
+        return result
+
+    if resilience is not None:
+        invoke_model = resilience.wrap(invoke_model)
+    if single_flight is not None:
+        invoke_model = single_flight.wrap(invoke_model)
+    if semantic_cache is not None:
+        invoke_model = semantic_cache.wrap(invoke_model)
+    # Passed as an argument rather than fixed inside, so a SemanticCache
+    # shared with other chains keys its answers on it.
+    return partial(invoke_model, max_tokens=max_tokens)
+
+def _is_cached(cache, model_id, prompt, backend, max_tokens=100):
+    if cache is None:
+        return False
+    return cache.contains(cache_key(cache, model_id, prompt, backend, max_tokens))
@@ -0,0 +1,159 @@
+"""Per-phase latency timing and percentile histograms for Bedrock calls.
+
+A PhaseTimer splits one call into phases on the monotonic perf_counter_ns
+clock. A LatencyRecorder folds many timers into one histogram per model and
+phase, and reports p50/p90/p99/max.
+
+The phases of an invoke_model call are:
+    serialize   building the request body
+    cache       looking the request up in a ResponseCache, when one is used
+    sign        botocore parameter handling and SigV4 signing, up to the send
+    retry       failed attempts and botocore's backoff before the last send
+    first_byte  from the send until the response headers arrive
+    read        reading the response body
+    parse       decoding the body and extracting the text
+"""
+import math
+import threading
+import time
+from contextvars import ContextVar
+
+PHASES = ["serialize", "cache", "sign", "retry", "first_byte", "read", "parse"]
+# A streamed call ends with the wait for the first token and then the rest of
+# the stream, in place of read and parse.
+STREAM_PHASES = ["serialize", "cache", "sign", "retry", "first_byte", "first_token", "stream"]
+
+# The timer of the call in progress. A context variable rather than a
+# thread-local, so that asyncio tasks sharing one thread each see their own.
+_current = ContextVar("latency_timer", default=None)
+
+class PhaseTimer:
+    """Times consecutive phases of one call, in nanoseconds."""
+
+    def __init__(self):
+        self.start = time.perf_counter_ns()
+        self.last = self.start
+        self.phases = {}
+
+    def mark(self, phase):
+        """End the current phase and record it under the given name."""
+        now = time.perf_counter_ns()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self.last
+        self.last = now
+
+    @property
+    def total_ns(self):
+        return self.last - self.start
+
+    @property
+    def total(self):
+        """Total time in seconds up to the last mark."""
+        return self.total_ns / 1e9
+
+def instrument_client(client):
+    """Hook client so that the moment a request goes on the wire ends the "sign" phase.
+
+    Safe to call more than once on the same client. Clients without botocore
+    events, such as test stand-ins, are left alone and their signing time is
+    counted in "first_byte".
+    """
+    meta = getattr(client, "meta", None)
+    if meta is not None:
+        meta.events.register("before-send.bedrock-runtime", _mark_sent, unique_id="latency-phase-timer")
+
+def _mark_sent(**kwargs):
+    timer = _current.get()
+    if timer is not None:
+        # botocore sends again after a throttle or a dropped connection.
+        timer.mark("retry" if "sign" in timer.phases else "sign")
+    # Returning None lets botocore go on and send the request.
+
+def start_call(client):
+    """Start timing a call made from this thread or task and return its PhaseTimer."""
+    instrument_client(client)
+    timer = PhaseTimer()
+    _current.set(timer)
+    return timer
+
+def end_call():
+    _current.set(None)
+
+class Histogram:
+    """A log-bucketed histogram of nanosecond durations.
+
+    Buckets grow by 2% each, so percentiles are accurate to within 2% and
+    memory stays bounded however many samples are added. max is exact.
+    """
+
+    GROWTH = 1.02
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.max = 0
+        self._log_growth = math.log(self.GROWTH)
+
+    def add(self, value_ns):
+        index = int(math.log(value_ns) / self._log_growth) if value_ns > 0 else 0
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.max = max(self.max, value_ns)
+
+    def percentile(self, p):
+        """Return the p-th percentile (0-100) in nanoseconds, or None if empty."""
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(self.count * p / 100))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                # Report the bucket's upper edge, but never more than the max.
+                return min(self.GROWTH ** (index + 1), self.max) if index else 0
+        return self.max
+
+class LatencyRecorder:
+    """Collects PhaseTimers from many calls into per-model, per-phase histograms."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def record(self, model_id, timer):
+        with self.lock:
+            by_phase = self.histograms.setdefault(model_id, {})
+            for phase, value_ns in timer.phases.items():
+                by_phase.setdefault(phase, Histogram()).add(value_ns)
+            by_phase.setdefault("total", Histogram()).add(timer.total_ns)
+
+    def summary(self):
+        """Return {model_id: {phase: {"count", "p50", "p90", "p99", "max"}}} with times in seconds."""
+        with self.lock:
+            return {
+                model_id: {
+                    phase: {
+                        "count": histogram.count,
+                        "p50": histogram.percentile(50) / 1e9,
+                        "p90": histogram.percentile(90) / 1e9,
+                        "p99": histogram.percentile(99) / 1e9,
+                        "max": histogram.max / 1e9
+                    }
+                    for phase, histogram in by_phase.items()
+                }
+                for model_id, by_phase in self.histograms.items()
+            }
+
+    def report(self):
+        """Return the summary as a text table, one block per model."""
+        lines = []
+        for model_id, by_phase in self.summary().items():
+            lines.append(f"Model: {model_id}")
+            lines.append(f"  {'phase':<12}{'n':>6}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}")
+            order = [phase for phase in PHASES + STREAM_PHASES + ["total"] if phase in by_phase]
+            for phase in dict.fromkeys(order):
+                stats = by_phase[phase]
+                lines.append(
+                    f"  {phase:<12}{stats['count']:>6}"
+                    f"{stats['p50']:>10.4f}{stats['p90']:>10.4f}{stats['p99']:>10.4f}{stats['max']:>10.4f}"
+                )
+        return "\n".join(lines)
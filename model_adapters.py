@@ -0,0 +1,409 @@
+"""Request and response formats for the model families on Amazon Bedrock.
+
+Each family gets one adapter that builds the invoke_model request body and
+pulls the text, token usage and stop reason out of the response. Adapters are
+looked up once per model ID and cached, so repeated calls do no string
+matching on the model ID.
+"""
+import json
+from collections import namedtuple
+
+import fast_json
+
+# input_tokens counts only the input the model processed; tokens read from or
+# written to the prompt cache are counted apart, where the family reports them.
+ParsedResponse = namedtuple(
+    "ParsedResponse", ["text", "input_tokens", "output_tokens", "stop_reason", "cache_read_tokens", "cache_write_tokens"],
+    defaults=(None, None)
+)
+
+# Stands in for the prompt while a body template is compiled. No real prompt
+# contains it, so the serialized template can be split around it.
+_PROMPT_MARKER = "\u0000prompt\u0000"
+
+def params_key(params):
+    """Return a hashable key for a dict of payload parameters.
+
+    Values may be lists or dicts, such as stop_sequences, so the parameters
+    are frozen as sorted JSON rather than as a tuple of items.
+    """
+    return json.dumps(params, sort_keys=True) if params else ""
+
+class ModelAdapter:
+    """Base class for a model family. Subclasses describe the payload and response shapes."""
+
+    family = None
+
+    def __init__(self):
+        self._templates = {}
+
+    def build_payload(self, prompt, max_tokens=100, **params):
+        """Return the request payload as a dict."""
+        raise NotImplementedError
+
+    def build_body(self, prompt, max_tokens=100, **params):
+        """Return the serialized request body.
+
+        The payload for each set of parameters is serialized once. After that,
+        a call only splices the JSON-encoded prompt into the cached template.
+        """
+        prefix, suffix = self.body_template(max_tokens, **params)
+        # Drop the quotes so the prompt can also sit inside a longer string.
+        return prefix + json.dumps(prompt)[1:-1] + suffix
+
+    def body_template(self, max_tokens=100, **params):
+        """Return the (prefix, suffix) of the serialized body that go around the JSON-escaped prompt.
+
+        Compiled once for each set of parameters and cached.
+        """
+        template = self._templates.get((max_tokens, params_key(params)))
+        if template is None:
+            template = self._compile(max_tokens, params)
+        return template
+
+    def _compile(self, max_tokens, params):
+        body = json.dumps(self.build_payload(_PROMPT_MARKER, max_tokens, **params))
+        marker = json.dumps(_PROMPT_MARKER)[1:-1]
+        if body.count(marker) != 1:
+            raise ValueError(f"{type(self).__name__} payload must contain the prompt exactly once")
+        template = tuple(body.split(marker))
+        self._templates[(max_tokens, params_key(params))] = template
+        return template
+
+    def message(self, role, text, cache_checkpoint=False):
+        """Return one chat message in the family's format.
+
+        cache_checkpoint marks the end of a prefix for Bedrock prompt caching.
+        Families without a messages API raise NotImplementedError.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not take a message history")
+
+    def build_chat_payload(self, messages, max_tokens=100, system=None, **params):
+        """Return the request payload for a list of messages from message()."""
+        raise NotImplementedError(f"{type(self).__name__} does not take a message history")
+
+    def chat_template(self, max_tokens=100, system=None, **params):
+        """Return the (prefix, suffix) that go around the serialized messages array of a chat body."""
+        body = json.dumps(self.build_chat_payload(_PROMPT_MARKER, max_tokens, system, **params))
+        marker = json.dumps(_PROMPT_MARKER)
+        if body.count(marker) != 1:
+            raise ValueError(f"{type(self).__name__} chat payload must contain the messages exactly once")
+        prefix, _, suffix = body.partition(marker)
+        return prefix, suffix
+
+    def parse_response(self, result):
+        """Return a ParsedResponse for a decoded invoke_model response body."""
+        raise NotImplementedError
+
+    def decode_response(self, raw_body):
+        """Return a ParsedResponse for a raw invoke_model response body, in bytes.
+
+        Decodes with fast_json. Families with a typed decoder override this to
+        decode only the fields they read when msgspec is installed.
+        """
+        return self.parse_response(fast_json.loads(raw_body))
+
+    def stream_text(self, event):
+        """Return the text carried by one decoded response-stream event, or None."""
+        raise NotImplementedError
+
+    def stream_info(self, event, info):
+        """Copy any token usage or stop reason carried by a response-stream event into info.
+
+        Bedrock adds invocation metrics with the token counts and its own
+        latency to the last event of every model's stream. Subclasses also
+        pick up the stop reason.
+        """
+        metrics = event.get("amazon-bedrock-invocationMetrics")
+        if metrics is not None:
+            info["input_tokens"] = metrics.get("inputTokenCount")
+            info["output_tokens"] = metrics.get("outputTokenCount")
+            if metrics.get("invocationLatency") is not None:
+                info["server_latency"] = metrics["invocationLatency"] / 1000
+
+class AnthropicAdapter(ModelAdapter):
+    """Anthropic Claude models, using the Messages API."""
+
+    family = "anthropic"
+
+    def build_payload(self, prompt, max_tokens=100, **params):
+        return self.build_chat_payload([self.message("user", prompt)], max_tokens, **params)
+
+    def message(self, role, text, cache_checkpoint=False):
+        block = {"type": "text", "text": text}
+        if cache_checkpoint:
+            block["cache_control"] = {"type": "ephemeral"}
+        return {"role": role, "content": [block]}
+
+    def build_chat_payload(self, messages, max_tokens=100, system=None, **params):
+        payload = {"anthropic_version": "bedrock-2023-05-31", "max_tokens": max_tokens, **params}
+        if system is not None:
+            payload["system"] = system
+        payload["messages"] = messages
+        return payload
+
+    def parse_response(self, result):
+        usage = result.get("usage", {})
+        content = result.get("content", [])
+        if len(content) == 1:
+            # The usual single text block: take its string rather than build a list to join.
+            text = content[0]["text"] if content[0].get("type", "text") == "text" else ""
+        else:
+            text = "".join([output["text"] for output in content if output.get("type", "text") == "text"])
+        return ParsedResponse(
+            text,
+            usage.get("input_tokens"),
+            usage.get("output_tokens"),
+            result.get("stop_reason"),
+            usage.get("cache_read_input_tokens"),
+            usage.get("cache_creation_input_tokens")
+        )
+
+    def decode_response(self, raw_body):
+        if fast_json.ANTHROPIC_RESPONSE is None:
+            return super().decode_response(raw_body)
+        result = fast_json.ANTHROPIC_RESPONSE.decode(raw_body)
+        usage = result.usage
+        content = result.content
+        if len(content) == 1:
+            text = content[0].text if content[0].type == "text" else ""
+        else:
+            text = "".join([output.text for output in content if output.type == "text"])
+        return ParsedResponse(
+            text,
+            usage.input_tokens,
+            usage.output_tokens,
+            result.stop_reason,
+            usage.cache_read_input_tokens,
+            usage.cache_creation_input_tokens
+        )
+
+    def stream_text(self, event):
+        # Anthropic sends message_start, content_block_delta, ..., message_stop
+        if event.get("type") == "content_block_delta":
+            return event["delta"].get("text")
+        return None
+
+    def stream_info(self, event, info):
+        if event.get("type") == "message_start":
+            info["input_tokens"] = event["message"].get("usage", {}).get("input_tokens")
+        elif event.get("type") == "message_delta":
+            info["stop_reason"] = event["delta"].get("stop_reason")
+            info["output_tokens"] = event.get("usage", {}).get("output_tokens")
+        super().stream_info(event, info)
+
+class NovaAdapter(ModelAdapter):
+    """Amazon Nova models."""
+
+    family = "nova"
+
+    def build_payload(self, prompt, max_tokens=100, **params):
+        return self.build_chat_payload([self.message("user", prompt)], max_tokens, **params)
+
+    def message(self, role, text, cache_checkpoint=False):
+        content = [{"text": text}]
+        if cache_checkpoint:
+            content.append({"cachePoint": {"type": "default"}})
+        return {"role": role, "content": content}
+
+    def build_chat_payload(self, messages, max_tokens=100, system=None, **params):
+        payload = {"inferenceConfig": {"max_new_tokens": max_tokens, **params}}
+        if system is not None:
+            payload["system"] = [{"text": system}]
+        payload["messages"] = messages
+        return payload
+
+    def parse_response(self, result):
+        usage = result.get("usage", {})
+        content = result["output"]["message"]["content"]
+        if len(content) == 1:
+            text = content[0].get("text", "")
+        else:
+            text = "".join([output.get("text", "") for output in content])
+        return ParsedResponse(
+            text,
+            usage.get("inputTokens"),
+            usage.get("outputTokens"),
+            result.get("stopReason"),
+            usage.get("cacheReadInputTokenCount"),
+            usage.get("cacheWriteInputTokenCount")
+        )
+
+    def decode_response(self, raw_body):
+        if fast_json.NOVA_RESPONSE is None:
+            return super().decode_response(raw_body)
+        result = fast_json.NOVA_RESPONSE.decode(raw_body)
+        usage = result.usage
+        content = result.output.message.content
+        return ParsedResponse(
+            content[0].text if len(content) == 1 else "".join([output.text for output in content]),
+            usage.input_tokens,
+            usage.output_tokens,
+            result.stop_reason,
+            usage.cache_read_input_token_count,
+            usage.cache_write_input_token_count
+        )
+
+    def stream_text(self, event):
+        # Nova sends messageStart, contentBlockDelta, ..., messageStop, metadata
+        delta = event.get("contentBlockDelta")
+        if delta is not None:
+            return delta["delta"].get("text")
+        return None
+
+    def stream_info(self, event, info):
+        if "messageStop" in event:
+            info["stop_reason"] = event["messageStop"].get("stopReason")
+        elif "metadata" in event:
+            usage = event["metadata"].get("usage", {})
+            info["input_tokens"] = usage.get("inputTokens")
+            info["output_tokens"] = usage.get("outputTokens")
+        super().stream_info(event, info)
+
+class TitanAdapter(ModelAdapter):
+    """Amazon Titan Text models."""
+
+    family = "titan"
+
+    def build_payload(self, prompt, max_tokens=100, **params):
+        return {
+            "inputText": prompt,
+            "textGenerationConfig": {"maxTokenCount": max_tokens, **params}
+        }
+
+    def parse_response(self, result):
+        results = result.get("results", [])
+        return ParsedResponse(
+            "".join(output["outputText"] for output in results),
+            result.get("inputTextTokenCount"),
+            sum(output.get("tokenCount", 0) for output in results) if results else None,
+            results[-1].get("completionReason") if results else None
+        )
+
+    def stream_text(self, event):
+        return event.get("outputText")
+
+    def stream_info(self, event, info):
+        if event.get("completionReason"):
+            info["stop_reason"] = event["completionReason"]
+        super().stream_info(event, info)
+
+class LlamaAdapter(ModelAdapter):
+    """Meta Llama models."""
+
+    family = "llama"
+
+    def build_payload(self, prompt, max_tokens=100, **params):
+        return {"prompt": prompt, "max_gen_len": max_tokens, **params}
+
+    def parse_response(self, result):
+        return ParsedResponse(
+            result.get("generation", ""),
+            result.get("prompt_token_count"),
+            result.get("generation_token_count"),
+            result.get("stop_reason")
+        )
+
+    def stream_text(self, event):
+        return event.get("generation")
+
+    def stream_info(self, event, info):
+        if event.get("stop_reason"):
+            info["stop_reason"] = event["stop_reason"]
+        super().stream_info(event, info)
+
+class MistralAdapter(ModelAdapter):
+    """Mistral AI models, using the text completion format."""
+
+    family = "mistral"
+
+    def build_payload(self, prompt, max_tokens=100, **params):
+        # Mistral expects the instruction tags around the prompt text itself.
+        return {"prompt": f"<s>[INST] {prompt} [/INST]", "max_tokens": max_tokens, **params}
+
+    def parse_response(self, result):
+        outputs = result.get("outputs", [])
+        # Mistral does not report token usage in the body.
+        return ParsedResponse(
+            "".join(output["text"] for output in outputs),
+            None,
+            None,
+            outputs[-1].get("stop_reason") if outputs else None
+        )
+
+    def stream_text(self, event):
+        outputs = event.get("outputs")
+        return outputs[0].get("text") if outputs else None
+
+    def stream_info(self, event, info):
+        outputs = event.get("outputs")
+        if outputs and outputs[0].get("stop_reason"):
+            info["stop_reason"] = outputs[0]["stop_reason"]
+        super().stream_info(event, info)
+
+class CohereAdapter(ModelAdapter):
+    """Cohere Command R models."""
+
+    family = "cohere"
+
+    def build_payload(self, prompt, max_tokens=100, **params):
+        return {"message": prompt, "max_tokens": max_tokens, **params}
+
+    def parse_response(self, result):
+        # Command R does not report token usage in the body.
+        return ParsedResponse(result.get("text", ""), None, None, result.get("finish_reason"))
+
+    def stream_text(self, event):
+        if event.get("event_type") == "text-generation":
+            return event.get("text")
+        return None
+
+    def stream_info(self, event, info):
+        if event.get("event_type") == "stream-end":
+            info["stop_reason"] = event.get("finish_reason")
+        super().stream_info(event, info)
+
+# Checked in order against the model ID with any cross-region inference
+# profile prefix ("us.", "eu.", ...) removed, so more specific prefixes go first.
+_REGISTRY = [
+    ("anthropic.", AnthropicAdapter()),
+    ("amazon.nova-", NovaAdapter()),
+    ("amazon.titan-text-", TitanAdapter()),
+    ("meta.llama", LlamaAdapter()),
+    ("mistral.", MistralAdapter()),
+    ("cohere.command-r", CohereAdapter()),
+]
+_resolved = {}
+
+# Geography prefixes used by cross-region inference profile IDs.
+_PROFILE_PREFIXES = {"us", "us-gov", "eu", "apac", "jp", "au", "ca", "global"}
+
+def register_adapter(prefix, adapter):
+    """Use adapter for every model ID that starts with prefix, ahead of the built-in adapters."""
+    _REGISTRY.insert(0, (prefix, adapter))
+    _resolved.clear()
+
+def base_model_id(model_id):
+    """Return the foundation model ID behind an inference profile ID or ARN.
+
+    For example "us.anthropic.claude-3-5-sonnet-20240620-v1:0" becomes
+    "anthropic.claude-3-5-sonnet-20240620-v1:0". Plain model IDs are returned as is.
+    """
+    base_id = model_id.rpartition("/")[2]
+    profile_prefix, _, rest = base_id.partition(".")
+    if profile_prefix in _PROFILE_PREFIXES:
+        return rest
+    return base_id
+
+def get_adapter(model_id):
+    """Return the adapter for model_id. Raises ValueError for an unknown model family."""
+    adapter = _resolved.get(model_id)
+    if adapter is not None:
+        return adapter
+
+    base_id = base_model_id(model_id)
+    for prefix, adapter in _REGISTRY:
+        if base_id.startswith(prefix):
+            _resolved[model_id] = adapter
+            return adapter
+    raise ValueError(f"No model adapter registered for {model_id!r}")
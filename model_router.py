@@ -0,0 +1,213 @@
+"""Pick the model for each prompt from live latency, error, cost and quality statistics.
+
+A ModelRouter keeps rolling statistics per model: the latencies of its last
+`window` calls, for percentiles, and recent error rate, cost per 1,000 tokens
+and quality score as EWMAs. They are fed by the calls it routes and by result
+records from anywhere else, such as the comparison runs stored by
+3_comparing_model.py; from_results() starts a router from a results directory.
+
+Each prompt goes to the cheapest model whose latency percentile is within the
+SLO, whose error rate is under max_error_rate and, when min_quality is set,
+whose quality score is at least that. A model with fewer than min_samples
+calls gets the next prompt before any choice is made, and a share explore_rate of prompts
+go to a random other model so that stale statistics get refreshed. When no
+model meets the SLO, the fastest is used.
+"""
+import math
+import os
+import random
+import threading
+from collections import deque
+
+from bedrock_invoke import invoke_bedrock_model
+from result_sink import JSONL_NAME, iter_records
+
+DEFAULT_WINDOW = 200
+
+class ModelStats:
+    """Rolling latency, error rate, cost and quality for one model."""
+
+    def __init__(self, window):
+        self.latencies = deque(maxlen=window)
+        self.error_rate = 0.0
+        self.cost_per_1k_tokens = None
+        self.quality = None
+        self.samples = 0
+        self.errors = 0
+        self.routed = 0
+        self.explored = 0
+
+    def latency_percentile(self, p):
+        """Return the p-th percentile (0-100) of the latencies in the window, in seconds, or None."""
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[max(1, math.ceil(len(ordered) * p / 100)) - 1]
+
+class ModelRouter:
+    """Routes each prompt to the cheapest model that meets a latency SLO, exploring now and then.
+
+    slo is in seconds, at slo_percentile of slo_metric: "latency" for the
+    whole call or "time_to_first_token" for streamed calls. alpha weighs the
+    newest sample in the EWMAs. Safe to share between threads.
+    """
+
+    def __init__(self, model_ids, slo, slo_percentile=95, slo_metric="latency", max_error_rate=0.1,
+                 min_quality=None, explore_rate=0.05, min_samples=5, window=DEFAULT_WINDOW, alpha=0.1, seed=None):
+        self.model_ids = list(model_ids)
+        self.slo = slo
+        self.slo_percentile = slo_percentile
+        self.slo_metric = slo_metric
+        self.max_error_rate = max_error_rate
+        self.min_quality = min_quality
+        self.explore_rate = explore_rate
+        self.min_samples = min_samples
+        self.alpha = alpha
+        self.stats = {model_id: ModelStats(window) for model_id in self.model_ids}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_results(cls, directory, model_ids, run_id=None, **kwargs):
+        """Return a router whose statistics start from the records stored in a results directory.
+
+        Only run_id's records are used when it is given. A directory with no
+        results yet gives a router with no statistics.
+        """
+        router = cls(model_ids, **kwargs)
+        if not os.path.exists(os.path.join(directory, JSONL_NAME)):
+            return router
+        columns = ["model_id", "run_id", "latency", "time_to_first_token", "input_tokens", "output_tokens", "cost",
+                   "cached", "coalesced", "error", "quality"]
+        # The JSONL file keeps every field of a record; Parquet only the common columns.
+        for record in iter_records(directory, columns, source="jsonl"):
+            if run_id is None or record["run_id"] == run_id:
+                router.observe(record["model_id"], record)
+        return router
+
+    def observe(self, model_id, record):
+        """Fold one result record, as written by InvocationResult.to_dict() or a ResultSink, into the statistics.
+
+        Records of other models, cached and coalesced results say nothing
+        about the model and are ignored. A record with "error" counts as a
+        failure. A "quality" score, from 0 to 1, is used when present.
+        """
+        stats = self.stats.get(model_id)
+        if stats is None or record.get("cached") or record.get("coalesced"):
+            return
+        with self.lock:
+            failed = record.get("error") is not None
+            stats.error_rate += self.alpha * (float(failed) - stats.error_rate)
+            if failed:
+                stats.errors += 1
+                return
+            latency = record.get(self.slo_metric)
+            if latency is None:
+                return
+            stats.samples += 1
+            stats.latencies.append(latency)
+            tokens = (record.get("input_tokens") or 0) + (record.get("output_tokens") or 0)
+            if record.get("cost") is not None and tokens:
+                stats.cost_per_1k_tokens = self._ewma(stats.cost_per_1k_tokens, record["cost"] / tokens * 1000)
+            if record.get("quality") is not None:
+                stats.quality = self._ewma(stats.quality, record["quality"])
+
+    def _ewma(self, average, value):
+        return value if average is None else average + self.alpha * (value - average)
+
+    def _meets_slo(self, stats):
+        latency = stats.latency_percentile(self.slo_percentile)
+        return (latency is not None and latency <= self.slo and stats.error_rate <= self.max_error_rate
+                and (self.min_quality is None or (stats.quality is not None and stats.quality >= self.min_quality)))
+
+    def choose(self):
+        """Return (model_id, reason) for the next prompt.
+
+        reason is "warmup" for a model still short of min_samples, "explore"
+        for a random pick, "slo" for the cheapest model meeting the SLO, and
+        "fallback" for the fastest model when none does.
+        """
+        with self.lock:
+            warming = [model_id for model_id in self.model_ids if self._calls(model_id) < self.min_samples]
+            if warming:
+                # Counting calls routed but not yet answered spreads concurrent warmup calls.
+                model_id = min(warming, key=lambda model_id: (self._calls(model_id), self.stats[model_id].routed))
+                reason = "warmup"
+            else:
+                eligible = [model_id for model_id in self.model_ids if self._meets_slo(self.stats[model_id])]
+                if eligible:
+                    # A model with no known price sorts after every priced one.
+                    model_id, reason = min(eligible, key=self._cost_key), "slo"
+                else:
+                    model_id, reason = min(self.model_ids, key=self._latency_key), "fallback"
+                others = [other for other in self.model_ids if other != model_id]
+                if others and self.random.random() < self.explore_rate:
+                    model_id, reason = self.random.choice(others), "explore"
+            stats = self.stats[model_id]
+            stats.routed += 1
+            if reason == "explore":
+                stats.explored += 1
+            return model_id, reason
+
+    def _calls(self, model_id):
+        stats = self.stats[model_id]
+        return stats.samples + stats.errors
+
+    def _cost_key(self, model_id):
+        cost = self.stats[model_id].cost_per_1k_tokens
+        return (cost is None, cost or 0.0, self._latency_key(model_id))
+
+    def _latency_key(self, model_id):
+        stats = self.stats[model_id]
+        latency = stats.latency_percentile(self.slo_percentile)
+        return (stats.error_rate > self.max_error_rate, latency if latency is not None else math.inf)
+
+    def invoke(self, client, prompt, invoke=invoke_bedrock_model, **kwargs):
+        """Call invoke(client, model_id, prompt, **kwargs) with the model chosen for prompt.
+
+        Returns (invoke's result, model_id, reason). The outcome is folded
+        into the statistics; an error is recorded and raised.
+        """
+        model_id, reason = self.choose()
+        try:
+            result = invoke(client, model_id, prompt, **kwargs)
+        except Exception as e:
+            self.observe(model_id, {"error": f"{type(e).__name__}: {e}"})
+            raise
+        self.observe(model_id, result.to_dict())
+        return result, model_id, reason
+
+    def summary(self):
+        """Return {model_id: statistics}, with latencies in seconds and whether the model meets the SLO."""
+        with self.lock:
+            return {
+                model_id: {
+                    "samples": stats.samples,
+                    "errors": stats.errors,
+                    "error_rate": stats.error_rate,
+                    "latency_p50": stats.latency_percentile(50),
+                    f"latency_p{self.slo_percentile}": stats.latency_percentile(self.slo_percentile),
+                    "cost_per_1k_tokens": stats.cost_per_1k_tokens,
+                    "quality": stats.quality,
+                    "meets_slo": self._meets_slo(stats),
+                    "routed": stats.routed,
+                    "explored": stats.explored
+                }
+                for model_id, stats in self.stats.items()
+            }
+
+    def report(self):
+        """Return the summary as a text table, one row per model."""
+        slo_column = f"p{self.slo_percentile}"
+        lines = [f"{'model':<45}{'samples':>8}{'errors':>8}{'p50':>9}{slo_column:>9}{'$/1k tok':>11}{'quality':>9}"
+                 f"{'SLO':>5}{'routed':>8}{'explored':>10}"]
+        for model_id, stats in self.summary().items():
+            p50, p_slo = ("-" if value is None else f"{value:.4f}"
+                          for value in (stats["latency_p50"], stats[f"latency_{slo_column}"]))
+            cost = f"{stats['cost_per_1k_tokens']:.6f}" if stats["cost_per_1k_tokens"] is not None else "-"
+            quality = f"{stats['quality']:.3f}" if stats["quality"] is not None else "-"
+            lines.append(
+                f"{model_id:<45}{stats['samples']:>8}{stats['errors']:>8}{p50:>9}{p_slo:>9}{cost:>11}{quality:>9}"
+                f"{'yes' if stats['meets_slo'] else 'no':>5}{stats['routed']:>8}{stats['explored']:>10}"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,223 @@
+"""Run a stream of prompts through Bedrock models in bounded, concurrent stages.
+
+A PromptPipeline splits each (prompt, model) call into stages, each with its
+own threads:
+    invoke  make the call through invoke_chain.compose_invoke(), so with the
+            cache, routing, retries and rate limits batch_runner.py uses;
+            `concurrency` threads
+    score   score the record with an Evaluator, when one is given
+    sink    hand the record to the caller's write function, in one thread
+
+Stages are joined by queues holding at most queue_size items. A stage that
+falls behind fills the queue in front of it, which blocks the stage before,
+back to the thread reading prompts. Only a bounded number of prompts are in
+memory however large the input is.
+
+read_prompts() reads a JSONL or CSV prompt file, and read_prompt_sources()
+turns files, globs and stdin into the lazy (prompt_id, prompt) stream the
+pipeline reads.
+"""
+import csv
+import glob
+import json
+import queue
+import sys
+import threading
+import time
+
+from invoke_chain import compose_invoke
+from usage import DEFAULT_PRICE_TABLE
+
+_DONE = object()
+
+def read_prompts(path):
+    """Yield (prompt_id, prompt) pairs from a JSONL or CSV file without loading it whole."""
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            for line_number, row in enumerate(csv.DictReader(f), start=1):
+                yield row.get("id") or str(line_number), row["prompt"]
+            return
+
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if isinstance(record, str):
+                yield str(line_number), record
+            else:
+                yield str(record.get("id", line_number)), record["prompt"]
+
+def read_prompt_sources(sources):
+    """Yield (prompt_id, prompt, source) for every prompt in sources, reading one line at a time.
+
+    Each source is "-" for stdin, a file or a glob. .jsonl, .json and .csv
+    files are read by read_prompts(); any other file, and stdin, hold one
+    prompt per non-empty line. Prompt IDs are line numbers
+    unless the file gives its own.
+    """
+    for source in sources:
+        if source == "-":
+            yield from _read_lines(sys.stdin, "stdin")
+            continue
+        paths = sorted(glob.glob(source)) if glob.has_magic(source) else [source]
+        if not paths:
+            raise FileNotFoundError(f"No prompt files match {source!r}")
+        for path in paths:
+            if path.endswith((".jsonl", ".json", ".csv")):
+                for prompt_id, prompt in read_prompts(path):
+                    yield prompt_id, prompt, path
+            else:
+                with open(path, encoding="utf-8") as f:
+                    yield from _read_lines(f, path)
+
+def _read_lines(lines, source):
+    for line_number, line in enumerate(lines, start=1):
+        prompt = line.rstrip("\r\n")
+        if prompt.strip():
+            yield str(line_number), prompt, source
+
+class StageStats:
+    """Items handled, items that failed in the stage, time spent working and time blocked on a full queue."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.items = 0
+        self.errors = 0
+        self.busy_ns = 0
+        self.blocked_ns = 0
+
+class PromptPipeline:
+    """Calls every model for every prompt through the invoke, score and sink stages.
+
+    write(record) gets one record per call, with prompt_id, source, model_id,
+    prompt and backend plus the InvocationResult fields, or "error" when the
+    call failed. backend is "invoke_model" or "converse". queue_size
+    defaults to twice the concurrency. cache, recorder, router, prices,
+    resilience, single_flight, telemetry, semantic_cache, rate_limits and
+    burst work as for batch_runner.run_matrix(), and a UsageTotals adds up
+    the calls; an Evaluator scores records in a stage of score_workers
+    threads.
+    """
+
+    def __init__(self, client, model_ids, write, max_tokens=100, backend="invoke_model", concurrency=8,
+                 queue_size=None, recorder=None, usage=None, prices=DEFAULT_PRICE_TABLE, evaluator=None,
+                 score_workers=2, cache=None, router=None, resilience=None, single_flight=None, telemetry=None,
+                 semantic_cache=None, rate_limits=None, burst=None):
+        self.client = client
+        self.model_ids = list(model_ids)
+        self.write = write
+        self.backend = backend
+        self.invoke = compose_invoke(backend, cache, recorder, router, prices, resilience, single_flight, telemetry,
+                                     semantic_cache, rate_limits, burst, max_tokens)
+        self.queue_size = queue_size or concurrency * 2
+        self.usage = usage
+        self.evaluator = evaluator
+        self.workers = {"invoke": concurrency, "score": score_workers, "sink": 1}
+        if evaluator is None:
+            del self.workers["score"]
+        self.stats = {name: StageStats(workers) for name, workers in self.workers.items()}
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def run(self, prompts):
+        """Run every (prompt_id, prompt) or (prompt_id, prompt, source) in prompts and return counts.
+
+        prompts is read lazily on the calling thread, which waits whenever the
+        invoke stage's queue is full. Returns once every record is written.
+        """
+        names = list(self.workers)
+        # The sink stage is the end of the line and has no queue after it.
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in names] + [None]
+        threads = []
+        for index, name in enumerate(names):
+            # Each stage's last worker to finish passes the end marker on.
+            remaining = [self.workers[name]]
+            for worker in range(self.workers[name]):
+                thread = threading.Thread(target=self._work, name=f"pipeline-{name}-{worker}", daemon=True,
+                                          args=(name, getattr(self, f"_{name}"), queues[index], queues[index + 1],
+                                                remaining))
+                thread.start()
+                threads.append(thread)
+
+        counts = {"prompts": 0, "calls": 0}
+        try:
+            for item in prompts:
+                prompt_id, prompt, source = item if len(item) == 3 else (*item, None)
+                counts["prompts"] += 1
+                for model_id in self.model_ids:
+                    counts["calls"] += 1
+                    queues[0].put({"prompt_id": prompt_id, "source": source, "model_id": model_id, "prompt": prompt,
+                                   "backend": self.backend})
+        finally:
+            queues[0].put(_DONE)
+            for thread in threads:
+                thread.join()
+        counts["failed"] = self.failed
+        counts["succeeded"] = self.stats["sink"].items - self.failed
+        return counts
+
+    def _work(self, name, step, inbox, outbox, remaining):
+        stats = self.stats[name]
+        while True:
+            job = inbox.get()
+            if job is _DONE:
+                # Leave the marker for this stage's other workers.
+                inbox.put(_DONE)
+                with self.lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last and outbox is not None:
+                    outbox.put(_DONE)
+                return
+            start_time = time.perf_counter_ns()
+            failed = False
+            # A failed call skips the remaining stages on its way to the sink.
+            if "error" not in job or name == "sink":
+                try:
+                    step(job)
+                except Exception as e:
+                    job["error"] = f"{type(e).__name__}: {e}"
+                    failed = True
+            done_time = time.perf_counter_ns()
+            if outbox is not None:
+                outbox.put(job)
+            with self.lock:
+                stats.items += 1
+                stats.errors += failed
+                stats.busy_ns += done_time - start_time
+                stats.blocked_ns += time.perf_counter_ns() - done_time
+
+    def _invoke(self, job):
+        result = self.invoke(self.client, job["model_id"], job["prompt"])
+        if self.usage is not None:
+            self.usage.add(job["model_id"], result)
+        job.update(result.to_dict())
+
+    def _score(self, job):
+        self.evaluator.score(job)
+
+    def _sink(self, job):
+        if "error" in job:
+            with self.lock:
+                self.failed += 1
+        self.write(job)
+
+    def summary(self):
+        """Return {stage: {"workers", "items", "errors", "busy", "blocked"}}, with times in seconds.
+
+        busy is time spent working on items, summed over the stage's workers;
+        blocked is time spent waiting for room in the next stage's queue.
+        """
+        with self.lock:
+            return {name: {"workers": stats.workers, "items": stats.items, "errors": stats.errors,
+                           "busy": stats.busy_ns / 1e9, "blocked": stats.blocked_ns / 1e9}
+                    for name, stats in self.stats.items()}
+
+    def report(self):
+        """Return the summary as a text table, one row per stage."""
+        lines = [f"{'stage':<8}{'workers':>8}{'items':>8}{'errors':>8}{'busy':>10}{'blocked':>10}"]
+        for name, stats in self.summary().items():
+            lines.append(f"{name:<8}{stats['workers']:>8}{stats['items']:>8}{stats['errors']:>8}"
+                         f"{stats['busy']:>10.4f}{stats['blocked']:>10.4f}")
+        return "\n".join(lines)
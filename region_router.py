@@ -0,0 +1,207 @@
+"""Spread Bedrock calls over several regions, with failover and optional hedging.
+
+The router holds one client per region. For each call it ranks the regions
+that serve the model by recent latency (an EWMA) and recent error rate. It
+tries them in that order, moving on when a region throttles, is unavailable
+or times out. A region that throttles is rested for a cooldown period.
+
+With hedge_after set, a call still running after that many seconds gets a
+duplicate in the next region, and whichever answers first wins.
+"""
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextvars import ContextVar
+
+from bedrock_client import get_client
+from bedrock_invoke import invoke_bedrock_model
+
+DEFAULT_REGIONS = ["us-east-1", "us-west-2", "eu-central-1"]
+
+# Errors that say "try somewhere else" rather than "this request is wrong".
+RETRYABLE_ERROR_CODES = {
+    "ThrottlingException",
+    "ServiceUnavailableException",
+    "ServiceQuotaExceededException",
+    "ModelNotReadyException",
+    "InternalServerException",
+    "ModelTimeoutException",
+}
+# botocore's connection-level errors, matched by name so botocore stays optional.
+RETRYABLE_EXCEPTIONS = {"ReadTimeoutError", "ConnectTimeoutError", "EndpointConnectionError", "ConnectionClosedError"}
+# The latency, in seconds, charged to a region that has only failed while no
+# region has served the model yet.
+UNSAMPLED_LATENCY = 1.0
+
+# The region a router is calling in, for the invoke function it calls to read.
+_current_region = ContextVar("routed_region", default=None)
+
+def routed_region():
+    """Return the region the RegionRouter call in progress on this thread or task went to, or None."""
+    return _current_region.get()
+
+def error_code(error):
+    """Return the AWS error code of a botocore ClientError, or None."""
+    return getattr(error, "response", {}).get("Error", {}).get("Code")
+
+def is_retryable(error):
+    return error_code(error) in RETRYABLE_ERROR_CODES or type(error).__name__ in RETRYABLE_EXCEPTIONS
+
+class RegionStats:
+    """Recent latency and error rate for one model in one region."""
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.cooldown_until = 0.0
+        self.served = 0
+        self.failed = 0
+
+class RegionRouter:
+    """Routes each call to the best region for the model and fails over on regional trouble.
+
+    model_ids maps a region to {model_id: regional_model_id} for regions that
+    need a different ID, such as a cross-region inference profile. A region
+    whose mapping has the model set to None does not serve it. clients maps a
+    region to a ready client; regions without one get a client from
+    get_client(). max_workers sizes the thread pool hedged calls run on;
+    each hedged call can hold one thread per region.
+    """
+
+    def __init__(self, regions=None, model_ids=None, clients=None, alpha=0.2, error_penalty=4.0, cooldown=5.0,
+                 hedge_after=None, max_workers=32):
+        self.regions = list(regions or DEFAULT_REGIONS)
+        self.model_ids = model_ids or {}
+        self.clients = {region: (clients or {}).get(region) or get_client(region=region) for region in self.regions}
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self.cooldown = cooldown
+        self.hedge_after = hedge_after
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_workers) if hedge_after is not None else None
+
+    def regional_model_id(self, region, model_id):
+        return self.model_ids.get(region, {}).get(model_id, model_id)
+
+    def _stats(self, region, model_id):
+        key = (region, model_id)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = RegionStats()
+        return stats
+
+    def rank(self, model_id):
+        """Return the regions that serve model_id, best first."""
+        now = time.monotonic()
+        with self.lock:
+            serving = [(order, region) for order, region in enumerate(self.regions)
+                       if self.regional_model_id(region, model_id) is not None]
+            stats_by_region = {region: self._stats(region, model_id) for _, region in serving}
+            sampled = [stats.latency for stats in stats_by_region.values() if stats.latency is not None]
+            worst = max(sampled, default=UNSAMPLED_LATENCY)
+            candidates = []
+            for order, region in serving:
+                stats = stats_by_region[region]
+                resting = stats.cooldown_until > now
+                # A region not yet tried scores 0, so each gets tried early. One
+                # that has only failed is charged the worst latency seen, so its
+                # error rate still counts against it.
+                latency = stats.latency if stats.latency is not None else (worst if stats.failed else 0.0)
+                score = latency * (1 + self.error_penalty * stats.error_rate)
+                candidates.append((resting, score, order, region))
+        if not candidates:
+            raise ValueError(f"No configured region serves {model_id!r}")
+        return [region for _, _, _, region in sorted(candidates)]
+
+    def _record(self, region, model_id, latency=None, error=None):
+        with self.lock:
+            stats = self._stats(region, model_id)
+            failed = error is not None
+            stats.error_rate += self.alpha * (float(failed) - stats.error_rate)
+            if failed:
+                stats.failed += 1
+                if error_code(error) in ("ThrottlingException", "ServiceQuotaExceededException"):
+                    stats.cooldown_until = time.monotonic() + self.cooldown
+            else:
+                stats.served += 1
+                stats.latency = latency if stats.latency is None else stats.latency + self.alpha * (latency - stats.latency)
+
+    def _call(self, region, model_id, prompt, invoke, kwargs):
+        start_time = time.perf_counter()
+        token = _current_region.set(region)
+        try:
+            result = invoke(self.clients[region], self.regional_model_id(region, model_id), prompt, **kwargs)
+        except Exception as e:
+            self._record(region, model_id, error=e)
+            raise
+        finally:
+            _current_region.reset(token)
+        self._record(region, model_id, latency=time.perf_counter() - start_time)
+        return result, region
+
+    def invoke(self, model_id, prompt, invoke=invoke_bedrock_model, **kwargs):
+        """Call invoke(client, regional_model_id, prompt, **kwargs) in the best region.
+
+        Returns (invoke's result, region that served it). Errors that are not
+        regional, such as a validation error, are raised at once. If every
+        region fails, the last error is raised.
+        """
+        regions = self.rank(model_id)
+        if self.hedge_after is not None and len(regions) > 1:
+            return self._invoke_hedged(regions, model_id, prompt, invoke, kwargs)
+
+        last_error = None
+        for region in regions:
+            try:
+                return self._call(region, model_id, prompt, invoke, kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                last_error = e
+        raise last_error
+
+    def _invoke_hedged(self, regions, model_id, prompt, invoke, kwargs):
+        remaining = list(regions)
+        pending = {self.executor.submit(self._call, remaining.pop(0), model_id, prompt, invoke, kwargs)}
+        primary = next(iter(pending))
+        last_error = None
+        while pending:
+            # Wait for the hedge delay while a call is running and another region is left to try.
+            timeout = self.hedge_after if remaining else None
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if not is_retryable(e):
+                        raise
+                    last_error = e
+                    continue
+                if future is not primary:
+                    with self.lock:
+                        self.hedge_wins += 1
+                # Losing calls run to completion in the background; their stats still count.
+                return result
+            if remaining and (not done or not pending):
+                # Either the hedge delay passed or every running call failed.
+                if not done:
+                    with self.lock:
+                        self.hedges += 1
+                pending.add(self.executor.submit(self._call, remaining.pop(0), model_id, prompt, invoke, kwargs))
+        raise last_error
+
+    def report(self):
+        """Return {region: {model_id: {"served", "failed", "latency", "error_rate"}}} plus hedge counts."""
+        with self.lock:
+            regions = {}
+            for (region, model_id), stats in self.stats.items():
+                regions.setdefault(region, {})[model_id] = {
+                    "served": stats.served,
+                    "failed": stats.failed,
+                    "latency": stats.latency,
+                    "error_rate": stats.error_rate
+                }
+            return {"regions": regions, "hedges": self.hedges, "hedge_wins": self.hedge_wins}
@@ -0,0 +1,264 @@
+"""Retries, deadlines, a circuit breaker and hedging around Bedrock calls.
+
+A ResilientInvoker wraps any invoke function, such as invoke_bedrock_model.
+Each call then gets:
+    retries     throttling and other retryable errors are retried with
+                jittered exponential backoff ("full jitter": a random sleep up
+                to base_delay * 2**attempt, capped at max_delay)
+    a deadline  the whole call, retries included, raises DeadlineExceeded once
+                it has run this many seconds; the abandoned attempt finishes
+                in the background
+    a breaker   after failure_threshold retryable failures in a row, a model's
+                calls fail at once with CircuitOpenError for reset_timeout
+                seconds, then a single trial call decides whether it closes
+    hedging     with hedge_percentile set, an attempt still running after that
+                percentile of the model's observed latency gets a duplicate,
+                and whichever answers first wins
+
+botocore retries on its own too. Pair the invoker with a client from
+get_client(max_attempts=1) so that attempts are not multiplied.
+
+Every attempt's own latency is recorded, including attempts that lost a hedge
+and finished later. The summary sets their p99 against the p99 callers saw,
+next to the share of extra calls hedging cost.
+"""
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+
+from latency import Histogram
+from region_router import is_retryable
+
+# Below this many samples a model's percentile is too noisy to hedge on.
+MIN_HEDGE_SAMPLES = 20
+
+class DeadlineExceeded(TimeoutError):
+    """A call ran past its deadline."""
+
+class CircuitOpenError(Exception):
+    """A call was refused because the model's circuit breaker is open."""
+
+class CircuitBreaker:
+    """Tracks consecutive failures for one model: closed, open, or half open with one trial call out."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow(self, now):
+        """Return whether a call may go out now. An open breaker past its timeout lets exactly one through."""
+        if self.state == "closed":
+            return True
+        if self.state == "open" and now - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            return True
+        return False
+
+    def success(self):
+        self.state = "closed"
+        self.failures = 0
+
+    def failure(self, now):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = now
+
+class ResilienceStats:
+    """Counters and latency histograms for one model."""
+
+    def __init__(self, breaker):
+        self.breaker = breaker
+        self.calls = 0
+        self.attempts = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.deadline_exceeded = 0
+        self.rejected = 0
+        # Each attempt on its own, as if never hedged, and each attempt as the caller saw it.
+        self.unhedged = Histogram()
+        self.observed = Histogram()
+
+class ResilientInvoker:
+    """Applies retries, a deadline, a per-model circuit breaker and optional hedging to invoke calls.
+
+    Use call(invoke, client, model_id, prompt, **kwargs) for one call, or
+    wrap(invoke) for a function with invoke's own signature. deadline and the
+    delays are in seconds; deadline=None waits as long as the call takes.
+    hedge_percentile, such as 95, turns hedging on.
+    """
+
+    def __init__(self, max_attempts=4, base_delay=0.2, max_delay=10.0, deadline=None, failure_threshold=5,
+                 reset_timeout=30.0, hedge_percentile=None, max_workers=32):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hedge_percentile = hedge_percentile
+        self.stats = {}
+        self.lock = threading.Lock()
+        needs_executor = deadline is not None or hedge_percentile is not None
+        self.executor = ThreadPoolExecutor(max_workers=max_workers) if needs_executor else None
+
+    def wrap(self, invoke):
+        """Return invoke with this invoker's policy applied."""
+        return partial(self.call, invoke)
+
+    def _stats(self, model_id):
+        stats = self.stats.get(model_id)
+        if stats is None:
+            stats = self.stats[model_id] = ResilienceStats(CircuitBreaker(self.failure_threshold, self.reset_timeout))
+        return stats
+
+    def call(self, invoke, client, model_id, prompt, **kwargs):
+        """Call invoke(client, model_id, prompt, **kwargs) under the policy and return its result.
+
+        Raises CircuitOpenError without calling when the model's breaker is
+        open, DeadlineExceeded when the deadline passes, and otherwise the
+        last error once the attempts are used up or an error is not retryable.
+        """
+        deadline_at = time.monotonic() + self.deadline if self.deadline is not None else None
+        with self.lock:
+            stats = self._stats(model_id)
+            stats.calls += 1
+            if not stats.breaker.allow(time.monotonic()):
+                stats.rejected += 1
+                raise CircuitOpenError(f"Circuit breaker for {model_id!r} is open after repeated failures")
+
+        attempt = 0
+        while True:
+            try:
+                result = self._attempt(invoke, client, model_id, prompt, kwargs, deadline_at, stats)
+            except Exception as e:
+                retryable = is_retryable(e) or isinstance(e, DeadlineExceeded)
+                with self.lock:
+                    if isinstance(e, DeadlineExceeded):
+                        stats.deadline_exceeded += 1
+                    if retryable:
+                        stats.breaker.failure(time.monotonic())
+                    else:
+                        # The model answered, if only to refuse the request.
+                        stats.breaker.success()
+                    give_up = stats.breaker.state == "open"
+                attempt += 1
+                if not retryable or isinstance(e, DeadlineExceeded) or give_up or attempt >= self.max_attempts:
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+                if deadline_at is not None and time.monotonic() + delay >= deadline_at:
+                    raise
+                with self.lock:
+                    stats.retries += 1
+                time.sleep(delay)
+                continue
+            with self.lock:
+                stats.breaker.success()
+            return result
+
+    def _hedge_delay(self, stats):
+        if self.hedge_percentile is None:
+            return None
+        with self.lock:
+            if stats.unhedged.count < MIN_HEDGE_SAMPLES:
+                return None
+            return stats.unhedged.percentile(self.hedge_percentile) / 1e9
+
+    def _timed(self, invoke, client, model_id, prompt, kwargs, stats):
+        start_time = time.perf_counter_ns()
+        result = invoke(client, model_id, prompt, **kwargs)
+        with self.lock:
+            stats.unhedged.add(time.perf_counter_ns() - start_time)
+        return result
+
+    def _attempt(self, invoke, client, model_id, prompt, kwargs, deadline_at, stats):
+        with self.lock:
+            stats.attempts += 1
+        start_time = time.perf_counter_ns()
+        hedge_delay = self._hedge_delay(stats)
+        if deadline_at is None and hedge_delay is None:
+            result = self._timed(invoke, client, model_id, prompt, kwargs, stats)
+        else:
+            result = self._attempt_waiting(invoke, client, model_id, prompt, kwargs, deadline_at, hedge_delay, stats)
+        with self.lock:
+            stats.observed.add(time.perf_counter_ns() - start_time)
+        return result
+
+    def _attempt_waiting(self, invoke, client, model_id, prompt, kwargs, deadline_at, hedge_delay, stats):
+        submit = partial(self.executor.submit, self._timed, invoke, client, model_id, prompt, kwargs, stats)
+        primary = submit()
+        pending = {primary}
+        hedge_at = time.monotonic() + hedge_delay if hedge_delay is not None else None
+        last_error = None
+        while pending:
+            now = time.monotonic()
+            waits = [moment - now for moment in (hedge_at, deadline_at) if moment is not None]
+            done, pending = wait(pending, timeout=max(0.0, min(waits)) if waits else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    last_error = e
+                    continue
+                if future is not primary:
+                    with self.lock:
+                        stats.hedge_wins += 1
+                # The losing call runs to completion in the background; its latency still counts.
+                return result
+            if last_error is not None and not is_retryable(last_error):
+                raise last_error
+            if deadline_at is not None and time.monotonic() >= deadline_at:
+                raise DeadlineExceeded(f"{model_id!r} did not answer within {self.deadline} seconds")
+            if hedge_at is not None and time.monotonic() >= hedge_at:
+                hedge_at = None
+                with self.lock:
+                    stats.hedges += 1
+                pending.add(submit())
+        raise last_error
+
+    def summary(self):
+        """Return {model_id: counters}, with p99 latencies in seconds with and without hedging.
+
+        extra_call_rate is hedges per attempt: the share of calls spent to buy
+        the p99_saved.
+        """
+        with self.lock:
+            summary = {}
+            for model_id, stats in self.stats.items():
+                unhedged = stats.unhedged.percentile(99)
+                observed = stats.observed.percentile(99)
+                summary[model_id] = {
+                    "calls": stats.calls,
+                    "attempts": stats.attempts,
+                    "retries": stats.retries,
+                    "hedges": stats.hedges,
+                    "hedge_wins": stats.hedge_wins,
+                    "deadline_exceeded": stats.deadline_exceeded,
+                    "rejected": stats.rejected,
+                    "circuit": stats.breaker.state,
+                    "p99_unhedged": unhedged / 1e9 if unhedged is not None else None,
+                    "p99": observed / 1e9 if observed is not None else None,
+                    "p99_saved": (unhedged - observed) / 1e9 if unhedged is not None and observed is not None else None,
+                    "extra_call_rate": stats.hedges / stats.attempts if stats.attempts else 0.0
+                }
+            return summary
+
+    def report(self):
+        """Return the summary as a text table, one row per model."""
+        lines = [f"{'model':<45}{'calls':>7}{'retries':>9}{'hedges':>8}{'wins':>6}{'deadline':>10}{'rejected':>10}"
+                 f"{'p99 raw':>9}{'p99':>9}{'extra':>7}"]
+        for model_id, stats in self.summary().items():
+            p99_unhedged, p99 = ("-" if value is None else f"{value:.4f}" for value in (stats["p99_unhedged"],
+                                                                                       stats["p99"]))
+            lines.append(
+                f"{model_id:<45}{stats['calls']:>7}{stats['retries']:>9}{stats['hedges']:>8}{stats['hedge_wins']:>6}"
+                f"{stats['deadline_exceeded']:>10}{stats['rejected']:>10}{p99_unhedged:>9}{p99:>9}"
+                f"{stats['extra_call_rate']:>7.1%}"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,131 @@
+"""Content-addressed cache for Amazon Bedrock responses.
+
+Entries are keyed on a hash of the model ID and the serialized request body,
+so any change to the prompt or the parameters is a different entry. The
+in-memory tier is an LRU with a time-to-live. An optional SQLite file adds a
+persistent tier that several processes can share.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+class CacheHit:
+    """Marks a response served from the cache rather than by the model.
+
+    lookup_time is how long the cache took to answer, in seconds.
+    original_latency and original_cost are those of the call that filled the
+    entry. A SemanticCache hit also carries the similarity of the two
+    prompts and the prompt that was matched.
+    """
+
+    def __init__(self, lookup_time, original_latency=None, original_cost=None, similarity=None, matched_prompt=None):
+        self.lookup_time = lookup_time
+        self.original_latency = original_latency
+        self.original_cost = original_cost
+        self.similarity = similarity
+        self.matched_prompt = matched_prompt
+
+class ResponseCache:
+    """An LRU cache with a TTL, optionally backed by a SQLite file.
+
+    ttl is in seconds; None keeps entries until they are evicted. max_entries
+    bounds the in-memory tier only. Safe to share between threads.
+    """
+
+    def __init__(self, max_entries=1024, ttl=None, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+        self.db = None
+        if path is not None:
+            # One connection shared by every thread, serialized by self.lock.
+            # WAL mode lets other processes read while this one writes.
+            self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+            self.db.commit()
+
+    @staticmethod
+    def key(model_id, body):
+        """Return the cache key for a model ID and a serialized request body."""
+        digest = hashlib.sha256(model_id.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(body.encode("utf-8") if isinstance(body, str) else body)
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the cached value for key, or None on a miss."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > now:
+                    self.entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    return value
+                del self.entries[key]
+                self.counters["expirations"] += 1
+
+            if self.db is not None:
+                row = self.db.execute("SELECT value, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value, expires_at = json.loads(row[0]), row[1]
+                    if expires_at is None or expires_at > now:
+                        self._remember(key, value, expires_at)
+                        self.counters["disk_hits"] += 1
+                        return value
+                    self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self.db.commit()
+                    self.counters["expirations"] += 1
+
+            self.counters["misses"] += 1
+            return None
+
+    def contains(self, key):
+        """Return whether key has a live entry, without touching the counters or the LRU order."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                return True
+            if self.db is not None:
+                row = self.db.execute("SELECT expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+                return row is not None and (row[0] is None or row[0] > now)
+            return False
+
+    def put(self, key, value):
+        """Store a JSON-serializable value under key."""
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self._remember(key, value, expires_at)
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), expires_at)
+                )
+                self.db.commit()
+
+    def _remember(self, key, value, expires_at):
+        self.entries[key] = (value, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def stats(self):
+        """Return a copy of the hit, miss and eviction counters."""
+        with self.lock:
+            return dict(self.counters, size=len(self.entries))
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
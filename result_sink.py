@@ -0,0 +1,404 @@
+"""Append-only storage for run results, written as they complete.
+
+A ResultSink takes one record per call, a dict like the ones batch_runner.py
+writes, and hands it to a background writer thread through a bounded queue.
+The caller never waits on the disk unless the writer falls that far behind,
+and memory stays bounded however long the run. The writer appends every
+record to results.jsonl, which can be tailed while a run is going, and with
+pyarrow installed also writes the records in Parquet, a part file every
+row_group_rows records. A run that ends with fewer than min_part_rows
+records left over writes no part for them, so short runs do not litter the
+directory with tiny files. compact() merges the parts into one file, along
+with the records only the JSONL file has.
+
+query() computes per-model aggregates from the files a batch at a time,
+without loading whole runs. The Parquet files are read, then whatever the
+JSONL file holds beyond them: runs from before pyarrow was installed, short
+runs' leftovers and records a crash kept out of a part.
+
+    python result_sink.py report results/
+    python result_sink.py report results/ --by backend --run 20250101-120000-1a2b
+    python result_sink.py compact results/
+"""
+import argparse
+import glob
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+from latency import Histogram
+
+JSONL_NAME = "results.jsonl"
+# The columns kept in Parquet. Other fields of a record only go to the JSONL file.
+COLUMNS = [
+    ("run_id", "string"),
+    ("time", "float64"),
+    ("prompt_id", "string"),
+    ("model_id", "string"),
+    ("backend", "string"),
+    ("region", "string"),
+    ("prompt", "string"),
+    ("response", "string"),
+    ("latency", "float64"),
+    ("input_tokens", "int64"),
+    ("output_tokens", "int64"),
+    ("stop_reason", "string"),
+    ("cost", "float64"),
+    ("cached", "bool_"),
+    ("error", "string"),
+    ("quality", "float64"),
+]
+GROUP_COLUMNS = ["model_id", "backend", "region", "run_id", "prompt_id"]
+
+_CLOSE = object()
+
+def _pyarrow():
+    import pyarrow
+    import pyarrow.parquet
+    return pyarrow, pyarrow.parquet
+
+def have_pyarrow():
+    try:
+        _pyarrow()
+    except ImportError:
+        return False
+    return True
+
+def schema():
+    """Return the pyarrow schema of the Parquet files. Needs pyarrow."""
+    pa, _ = _pyarrow()
+    return pa.schema([(name, getattr(pa, type_name)()) for name, type_name in COLUMNS])
+
+class ResultSink:
+    """Streams result records to directory from a background thread.
+
+    Each record gets run_id and the time it was written. parquet=None
+    writes Parquet when pyarrow is installed. write() blocks only once
+    max_pending records are waiting. If the writer thread fails, write() and
+    close() raise its error. Use as a context manager, or call close() to
+    write out what is left.
+    """
+
+    def __init__(self, directory, parquet=None, run_id=None, row_group_rows=10000, max_pending=10000,
+                 flush_interval=1.0, min_part_rows=1000):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.parquet = have_pyarrow() if parquet is None else parquet
+        self.run_id = run_id or f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:4]}"
+        self.row_group_rows = row_group_rows
+        self.min_part_rows = min_part_rows
+        self.flush_interval = flush_interval
+        self.schema = schema() if self.parquet else None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.rows = []
+        self.parts = 0
+        self.written = 0
+        self.error = None
+        self.closed = False
+        self.jsonl = open(os.path.join(directory, JSONL_NAME), "a", encoding="utf-8")
+        self.thread = threading.Thread(target=self._run, name="result-sink", daemon=True)
+        self.thread.start()
+
+    def write(self, record):
+        """Queue one record for writing."""
+        if self.closed:
+            raise ValueError("write to a closed ResultSink")
+        self._put(record)
+
+    def _put(self, item):
+        # Waits in flush_interval steps, so a writer that has died is noticed
+        # rather than waited on for good.
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.queue.put(item, timeout=self.flush_interval)
+                return
+            except queue.Full:
+                if not self.thread.is_alive():
+                    raise self.error or RuntimeError("the ResultSink writer thread has stopped")
+
+    def _run(self):
+        try:
+            while True:
+                try:
+                    record = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    self.jsonl.flush()
+                    continue
+                if record is _CLOSE:
+                    break
+                self._write(record)
+                # Flushing once the queue drains keeps the file tail current
+                # without a flush per record under load.
+                if self.queue.empty():
+                    self.jsonl.flush()
+            # A short remainder stays in the JSONL file only; readers and compact() pick it up there.
+            if len(self.rows) >= self.min_part_rows:
+                self._write_part()
+            self.jsonl.flush()
+        except Exception as e:
+            self.error = e
+
+    def _write(self, record):
+        record = {"run_id": self.run_id, "time": time.time(), **record}
+        self.jsonl.write(json.dumps(record) + "\n")
+        self.written += 1
+        if self.parquet:
+            self.rows.append(record)
+            if len(self.rows) >= self.row_group_rows:
+                self._write_part()
+
+    def _write_part(self):
+        pa, pq = _pyarrow()
+        path = os.path.join(self.directory, f"part-{self.run_id}-{self.parts:05d}.parquet")
+        # Written aside and renamed, so a reader never sees half a file.
+        pq.write_table(pa.Table.from_pylist(self.rows, schema=self.schema), path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self.parts += 1
+        self.rows = []
+
+    def close(self):
+        """Write out every queued record and stop the writer thread."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._put(_CLOSE)
+        finally:
+            self.thread.join()
+            self.jsonl.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def parquet_files(directory):
+    return sorted(glob.glob(os.path.join(directory, "*.parquet")))
+
+def compact(directory, row_group_rows=100000):
+    """Merge every Parquet file in directory, and the records only the JSONL file has, into one file.
+
+    The originals are removed. Reads a batch at a time, so memory stays at
+    about one row group. Returns the new file's path, or None when there was
+    nothing to merge.
+    """
+    pa, pq = _pyarrow()
+    parts = parquet_files(directory)
+    covered = _covered_runs(directory)
+    if not _jsonl_tail(directory, [name for name, _ in COLUMNS], covered, peek=True) and len(parts) < 2:
+        return None
+    path = os.path.join(directory, f"compacted-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:4]}.parquet")
+    target = schema()
+    batches = []
+    rows = 0
+    with pq.ParquetWriter(path + ".tmp", target) as writer:
+        for batch in _compact_batches(pa, pq, directory, parts, covered, target, row_group_rows):
+            batches.append(batch)
+            rows += batch.num_rows
+            if rows >= row_group_rows:
+                writer.write_table(pa.Table.from_batches(batches))
+                batches, rows = [], 0
+        if batches:
+            writer.write_table(pa.Table.from_batches(batches))
+    os.replace(path + ".tmp", path)
+    for part in parts:
+        os.remove(part)
+    return path
+
+def _compact_batches(pa, pq, directory, parts, covered, target, row_group_rows):
+    for part in parts:
+        for batch in pq.ParquetFile(part).iter_batches(batch_size=row_group_rows):
+            yield _conform(pa, batch, target)
+    rows = []
+    for record in _jsonl_tail(directory, [name for name, _ in COLUMNS], covered):
+        rows.append(record)
+        if len(rows) >= row_group_rows:
+            yield pa.RecordBatch.from_pylist(rows, schema=target)
+            rows = []
+    if rows:
+        yield pa.RecordBatch.from_pylist(rows, schema=target)
+
+def _conform(pa, batch, target):
+    """Return batch with target's columns, in order; columns from before a schema change are null."""
+    arrays = [batch.column(field.name) if field.name in batch.schema.names else pa.nulls(batch.num_rows, field.type)
+              for field in target]
+    return pa.RecordBatch.from_arrays(arrays, schema=target)
+
+def iter_records(directory, columns, source=None):
+    """Yield records as dicts holding the given columns, a batch at a time.
+
+    source is "parquet" or "jsonl" to read only those files. By default the
+    Parquet files are read, when there are any and pyarrow is installed, and
+    then the JSONL records they do not hold. A column a file does not have,
+    such as one added since it was written, reads as None.
+    """
+    if source is None:
+        if not (parquet_files(directory) and have_pyarrow()):
+            yield from _jsonl_records(directory, columns)
+            return
+        covered = {}
+        yield from _parquet_records(directory, columns, covered)
+        yield from _jsonl_tail(directory, columns, covered)
+    elif source == "parquet":
+        yield from _parquet_records(directory, columns)
+    else:
+        yield from _jsonl_records(directory, columns)
+
+def _parquet_records(directory, columns, covered=None):
+    """Yield records from the Parquet files, counting each run's rows into covered when it is given."""
+    _, pq = _pyarrow()
+    for path in parquet_files(directory):
+        parquet_file = pq.ParquetFile(path)
+        present = [column for column in columns if column in parquet_file.schema_arrow.names]
+        missing = dict.fromkeys(column for column in columns if column not in present)
+        read = present if covered is None or "run_id" in present else present + ["run_id"]
+        for batch in parquet_file.iter_batches(columns=read):
+            values = batch.to_pydict()
+            if covered is not None:
+                for run_id in values["run_id"]:
+                    covered[run_id] = covered.get(run_id, 0) + 1
+            for row in zip(*(values[column] for column in present)):
+                yield {**dict(zip(present, row)), **missing}
+
+def _covered_runs(directory):
+    """Return {run_id: rows} for the rows the Parquet files hold."""
+    _, pq = _pyarrow()
+    covered = {}
+    for path in parquet_files(directory):
+        for batch in pq.ParquetFile(path).iter_batches(columns=["run_id"]):
+            for run_id in batch.column("run_id").to_pylist():
+                covered[run_id] = covered.get(run_id, 0) + 1
+    return covered
+
+def _jsonl_records(directory, columns):
+    path = os.path.join(directory, JSONL_NAME)
+    if not os.path.exists(path):
+        return
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A torn final line from a crash.
+                continue
+            yield {column: record.get(column) for column in columns}
+
+def _jsonl_tail(directory, columns, covered, peek=False):
+    """Yield the JSONL records beyond the first covered[run_id] of each run, which the Parquet files hold.
+
+    A sink writes a run's records to both in the same order, so its Parquet
+    rows are the first ones of the run in the JSONL file. With peek, return
+    whether there is any such record instead.
+    """
+    seen = {}
+    records = _jsonl_records(directory, columns if "run_id" in columns else columns + ["run_id"])
+    tail = (record for record in records if _beyond(record["run_id"], covered, seen))
+    if peek:
+        return next(tail, None) is not None
+    return ({column: record[column] for column in columns} for record in tail)
+
+def _beyond(run_id, covered, seen):
+    seen[run_id] = seen.get(run_id, 0) + 1
+    return seen[run_id] > covered.get(run_id, 0)
+
+def query(directory, by="model_id", run_id=None, source=None):
+    """Return {group: aggregates} over every record in directory, grouped by the column `by`.
+
+    Aggregates are record, error and cached counts, latency p50/p90/p99 and
+    mean in seconds, token totals, total cost, output tokens per second and
+    the mean quality score of the scored records. Only run_id's records are
+    counted when it is given.
+    """
+    if by not in GROUP_COLUMNS:
+        raise ValueError(f"Cannot group by {by!r}; expected one of {GROUP_COLUMNS}")
+    columns = list(dict.fromkeys([by, "run_id", "latency", "input_tokens", "output_tokens", "cost", "cached",
+                                  "error", "quality"]))
+    groups = {}
+    for record in iter_records(directory, columns, source):
+        if run_id is not None and record["run_id"] != run_id:
+            continue
+        group = groups.get(record[by])
+        if group is None:
+            group = groups[record[by]] = {"records": 0, "errors": 0, "cached": 0, "input_tokens": 0,
+                                          "output_tokens": 0, "cost": 0.0, "latency_total": 0.0,
+                                          "scored": 0, "quality_total": 0.0, "histogram": Histogram()}
+        group["records"] += 1
+        if record["error"] is not None:
+            group["errors"] += 1
+            continue
+        if record["quality"] is not None:
+            group["scored"] += 1
+            group["quality_total"] += record["quality"]
+        if record["cached"]:
+            group["cached"] += 1
+            continue
+        group["input_tokens"] += record["input_tokens"] or 0
+        group["output_tokens"] += record["output_tokens"] or 0
+        group["cost"] += record["cost"] or 0.0
+        if record["latency"] is not None:
+            group["latency_total"] += record["latency"]
+            group["histogram"].add(int(record["latency"] * 1e9))
+
+    results = {}
+    for key, group in groups.items():
+        histogram = group.pop("histogram")
+        latency_total = group.pop("latency_total")
+        quality_total = group.pop("quality_total")
+        percentile = {p: histogram.percentile(p) for p in (50, 90, 99)}
+        results[key] = {
+            **group,
+            "latency_p50": percentile[50] / 1e9 if histogram.count else None,
+            "latency_p90": percentile[90] / 1e9 if histogram.count else None,
+            "latency_p99": percentile[99] / 1e9 if histogram.count else None,
+            "latency_mean": latency_total / histogram.count if histogram.count else None,
+            "tokens_per_second": group["output_tokens"] / latency_total if latency_total else None,
+            "quality": quality_total / group["scored"] if group["scored"] else None
+        }
+    return results
+
+def report(results, by="model_id"):
+    """Return query() results as a text table."""
+    lines = [f"{by:<45}{'records':>8}{'errors':>7}{'cached':>7}{'p50':>9}{'p90':>9}{'p99':>9}{'out tok':>9}"
+             f"{'tok/s':>9}{'$ total':>11}{'quality':>9}"]
+    for key, stats in results.items():
+        p50, p90, p99 = ("-" if value is None else f"{value:.4f}"
+                         for value in (stats["latency_p50"], stats["latency_p90"], stats["latency_p99"]))
+        tokens_per_second = f"{stats['tokens_per_second']:.1f}" if stats["tokens_per_second"] else "-"
+        quality = f"{stats['quality']:.3f}" if stats["quality"] is not None else "-"
+        lines.append(
+            f"{str(key):<45}{stats['records']:>8}{stats['errors']:>7}{stats['cached']:>7}{p50:>9}{p90:>9}{p99:>9}"
+            f"{stats['output_tokens']:>9}{tokens_per_second:>9}{stats['cost']:>11.6f}{quality:>9}"
+        )
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Report on or compact a results directory.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    report_parser = commands.add_parser("report", help="per-model aggregates, read a batch at a time")
+    report_parser.add_argument("directory")
+    report_parser.add_argument("--by", choices=GROUP_COLUMNS, default="model_id")
+    report_parser.add_argument("--run", help="only count this run ID")
+    report_parser.add_argument("--source", choices=["parquet", "jsonl"],
+                               help="read only these files; by default Parquet and the JSONL records it lacks")
+    report_parser.add_argument("--json", action="store_true", help="print JSON instead of a table")
+    compact_parser = commands.add_parser("compact", help="merge the Parquet part files into one")
+    compact_parser.add_argument("directory")
+    args = parser.parse_args()
+
+    if args.command == "compact":
+        path = compact(args.directory)
+        print(path or "Nothing to compact")
+        return
+    results = query(args.directory, args.by, args.run, args.source)
+    print(json.dumps(results) if args.json else report(results, args.by))
+
+if __name__ == "__main__":
+    main()
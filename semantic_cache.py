@@ -0,0 +1,250 @@
+"""Reuse answers for prompts that mean the same as one already answered.
+
+A SemanticCache sits in front of an invoke function. It embeds each prompt
+and searches the unit vectors of the prompts it has seen for the same model.
+When the closest one's cosine similarity is at least threshold, its stored
+answer comes back without a call, marked cached, with the similarity and the
+prompt that matched. Otherwise the call goes out and its answer is stored.
+
+Each model's vectors sit in one numpy matrix, so a search is a single
+matrix-vector product over every entry: exact, not approximate, and a
+fraction of a millisecond at the default max_entries. Calls with different
+request options, such as max_tokens, get separate matrices, so an answer is
+only reused for a call asking for the same thing. A full index replaces
+an expired entry if there is one and otherwise the least recently used one.
+
+The embedding decides what counts as the same question:
+    hashed_embedding   a bag of hashed words, from embeddings.py; no model
+                       and no call, but only prompts sharing words are close
+    bedrock_embedder   Amazon Titan Text Embeddings, one Bedrock call per
+                       prompt; fake_bedrock.py answers it offline
+    local_embedder     a local sentence-transformers model, from embeddings.py
+
+Every lookup pays for an embedding and a search, hits or not. The summary
+sets the latency and cost the hits saved against that time.
+"""
+import json
+import threading
+import time
+from functools import partial
+
+import fast_json
+from bedrock_invoke import InvocationResult
+from embeddings import hashed_embedding
+from model_adapters import params_key
+from response_cache import CacheHit
+
+DEFAULT_EMBEDDING_MODEL = "amazon.titan-embed-text-v2:0"
+DEFAULT_THRESHOLD = 0.9
+# Keyword arguments of the invoke functions that do not change the answer.
+_NON_REQUEST_KWARGS = {"cache", "recorder", "prices", "timeout"}
+
+def _numpy():
+    import numpy
+    return numpy
+
+def bedrock_embedder(client, model_id=DEFAULT_EMBEDDING_MODEL, dimensions=256):
+    """Return an embed function that calls a Titan Text Embeddings model. dimensions is 256, 512 or 1024."""
+
+    def embed(text):
+        body = json.dumps({"inputText": text, "dimensions": dimensions, "normalize": True})
+        response = client.invoke_model(modelId=model_id, body=body)
+        return fast_json.loads(response["body"].read())["embedding"]
+    return embed
+
+class VectorIndex:
+    """The unit vectors of one model's cached prompts, with their answers. Needs numpy.
+
+    Not thread-safe; the SemanticCache holding it takes its lock.
+    """
+
+    def __init__(self, dimensions, max_entries, ttl=None):
+        np = _numpy()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # Grown by doubling up to max_entries, so a small cache stays small.
+        capacity = min(max_entries, 64)
+        self.vectors = np.zeros((capacity, dimensions), dtype=np.float32)
+        self.last_used = np.zeros(capacity, dtype=np.int64)
+        self.stored_at = np.zeros(capacity, dtype=np.float64)
+        self.values = [None] * capacity
+        self.size = 0
+        self.clock = 0
+
+    def search(self, vector, now):
+        """Return (slot, similarity) of the closest live entry, or (None, None) when there is none."""
+        if not self.size:
+            return None, None
+        np = _numpy()
+        similarities = self.vectors[:self.size] @ vector
+        if self.ttl is not None:
+            similarities[self.stored_at[:self.size] < now - self.ttl] = -np.inf
+        slot = int(similarities.argmax())
+        if similarities[slot] == -np.inf:
+            return None, None
+        return slot, float(similarities[slot])
+
+    def touch(self, slot):
+        self.clock += 1
+        self.last_used[slot] = self.clock
+
+    def add(self, vector, value, now):
+        """Store vector and value and return "evicted", "expired" or None for what made room."""
+        replaced = None
+        if self.size < len(self.values):
+            slot = self.size
+            self.size += 1
+        elif self.size < self.max_entries:
+            self._grow()
+            slot = self.size
+            self.size += 1
+        else:
+            expired = self.stored_at < now - self.ttl if self.ttl is not None else None
+            if expired is not None and expired.any():
+                slot, replaced = int(expired.argmax()), "expired"
+            else:
+                slot, replaced = int(self.last_used.argmin()), "evicted"
+        self.vectors[slot] = vector
+        self.stored_at[slot] = now
+        self.values[slot] = value
+        self.touch(slot)
+        return replaced
+
+    def _grow(self):
+        np = _numpy()
+        capacity = min(self.max_entries, len(self.values) * 2)
+        extra = capacity - len(self.values)
+        self.vectors = np.vstack([self.vectors, np.zeros((extra, self.vectors.shape[1]), dtype=np.float32)])
+        self.last_used = np.concatenate([self.last_used, np.zeros(extra, dtype=np.int64)])
+        self.stored_at = np.concatenate([self.stored_at, np.zeros(extra, dtype=np.float64)])
+        self.values.extend([None] * extra)
+
+class SemanticCache:
+    """Answers a prompt from the stored answer to a similar enough earlier prompt to the same model.
+
+    Use call(invoke, client, model_id, prompt, **kwargs) for one call, or
+    wrap(invoke) for a function with invoke's own signature. prompt must be
+    text. Calls whose other kwargs, such as max_tokens, differ never share an
+    answer. embed turns a text into a vector. threshold is the cosine
+    similarity a match needs, from 0 to 1; raise it when prompts that differ
+    in a detail, such as a region or a date, should not share an answer.
+    max_entries bounds each index; ttl, in seconds, ages entries out.
+    Needs numpy. Safe to share between threads.
+    """
+
+    def __init__(self, embed=hashed_embedding, threshold=DEFAULT_THRESHOLD, max_entries=10000, ttl=None):
+        self.embed = embed
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.indexes = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+        _numpy()
+
+    def wrap(self, invoke):
+        """Return invoke with answers to similar prompts reused."""
+        return partial(self.call, invoke)
+
+    def _stats(self, model_id):
+        stats = self.stats.get(model_id)
+        if stats is None:
+            stats = self.stats[model_id] = {"lookups": 0, "hits": 0, "evictions": 0, "expirations": 0,
+                                            "lookup_time": 0.0, "saved_latency": 0.0, "saved_cost": 0.0}
+        return stats
+
+    def vector(self, text):
+        """Return text's embedding as a unit float32 vector, or None if it has no direction."""
+        np = _numpy()
+        vector = np.asarray(self.embed(text), dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else None
+
+    def call(self, invoke, client, model_id, prompt, **kwargs):
+        """Return the stored answer to a prompt similar to prompt, or invoke(client, model_id, prompt, **kwargs)."""
+        try:
+            options = params_key({name: value for name, value in kwargs.items() if name not in _NON_REQUEST_KWARGS})
+        except TypeError:
+            # Options that cannot be compared are not cached.
+            return invoke(client, model_id, prompt, **kwargs)
+        start_time = time.perf_counter()
+        vector = self.vector(prompt)
+        hit = self.lookup(model_id, vector, start_time, options)
+        if hit is not None:
+            return hit
+        result = invoke(client, model_id, prompt, **kwargs)
+        # A copy of another caller's answer is stored by that caller.
+        if vector is not None and result.cache_hit is None and not result.coalesced:
+            self.store(model_id, prompt, vector, result, options)
+        return result
+
+    def lookup(self, model_id, vector, start_time, options=""):
+        """Return a cached InvocationResult for the closest prompt meeting the threshold, or None.
+
+        start_time, from time.perf_counter(), is when the lookup began,
+        embedding included. options, from params_key(), are the request
+        options the answer must have been given for.
+        """
+        with self.lock:
+            stats = self._stats(model_id)
+            stats["lookups"] += 1
+            index = self.indexes.get((model_id, options))
+            slot, similarity = (None, None) if index is None or vector is None else index.search(vector, time.time())
+            matched = slot is not None and similarity >= self.threshold
+            if matched:
+                index.touch(slot)
+                value = index.values[slot]
+                stats["hits"] += 1
+                stats["saved_latency"] += value["latency"] or 0.0
+                stats["saved_cost"] += value["cost"] or 0.0
+            lookup_time = time.perf_counter() - start_time
+            stats["lookup_time"] += lookup_time
+        if not matched:
+            return None
+        hit = CacheHit(lookup_time, value["latency"], value["cost"], similarity, value["prompt"])
+        # Nothing is billed for a cached answer.
+        return InvocationResult(
+            model_id, value["text"], None, value["input_tokens"], value["output_tokens"], value["stop_reason"], 0.0,
+            cache_hit=hit, backend=value["backend"]
+        )
+
+    def store(self, model_id, prompt, vector, result, options=""):
+        """Store result as the answer to prompt with these request options, whose unit vector is vector."""
+        value = {"prompt": prompt, "text": result.text, "latency": result.latency,
+                 "input_tokens": result.input_tokens, "output_tokens": result.output_tokens,
+                 "stop_reason": result.stop_reason, "cost": result.cost, "backend": result.backend}
+        with self.lock:
+            index = self.indexes.get((model_id, options))
+            if index is None:
+                index = self.indexes[(model_id, options)] = VectorIndex(len(vector), self.max_entries, self.ttl)
+            replaced = index.add(vector, value, time.time())
+            if replaced == "evicted":
+                self._stats(model_id)["evictions"] += 1
+            elif replaced == "expired":
+                self._stats(model_id)["expirations"] += 1
+
+    def summary(self):
+        """Return {model_id: counters}, with hit_rate, entries and net_saved_latency: seconds saved less lookup time."""
+        with self.lock:
+            summary = {}
+            for model_id, stats in self.stats.items():
+                summary[model_id] = dict(
+                    stats,
+                    entries=sum(index.size for (indexed, _), index in self.indexes.items() if indexed == model_id),
+                    hit_rate=stats["hits"] / stats["lookups"] if stats["lookups"] else 0.0,
+                    net_saved_latency=stats["saved_latency"] - stats["lookup_time"]
+                )
+            return summary
+
+    def report(self):
+        """Return the summary as a text table, one row per model."""
+        lines = [f"{'model':<45}{'entries':>8}{'lookups':>9}{'hits':>7}{'hit rate':>10}{'evicted':>9}"
+                 f"{'lookup ms':>11}{'saved s':>10}{'net s':>10}{'saved $':>11}"]
+        for model_id, stats in self.summary().items():
+            lookup_ms = stats["lookup_time"] / stats["lookups"] * 1000 if stats["lookups"] else 0.0
+            lines.append(
+                f"{model_id:<45}{stats['entries']:>8}{stats['lookups']:>9}{stats['hits']:>7}{stats['hit_rate']:>10.1%}"
+                f"{stats['evictions'] + stats['expirations']:>9}{lookup_ms:>11.3f}{stats['saved_latency']:>10.3f}"
+                f"{stats['net_saved_latency']:>10.3f}{stats['saved_cost']:>11.6f}"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,134 @@
+"""Coalesce identical Bedrock calls and drop duplicate prompts before they are sent.
+
+A SingleFlight sits in front of an invoke function. While a call for a
+(model ID, payload) is in flight, identical calls do not go out: they wait
+for that call and get its result, marked coalesced, or its error. Nothing is
+kept once the call finishes; that is what ResponseCache is for.
+
+dedupe_prompts() is the pre-pass for prompt lists: it finds the prompts that
+repeat an earlier one, so a batch run can send each distinct prompt once and
+copy the answer to the repeats.
+"""
+import asyncio
+import copy
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import Future
+from functools import partial
+
+from response_cache import ResponseCache
+
+def canonical_payload(payload):
+    """Return payload as a string that is equal for equal payloads: str as is, anything else as sorted JSON."""
+    if isinstance(payload, str):
+        return payload
+    return json.dumps(payload, sort_keys=True, separators=(",", ":"))
+
+class SingleFlight:
+    """Lets one of several identical concurrent calls through and shares its outcome with the rest.
+
+    Use call(invoke, client, model_id, payload, **kwargs) for one call, or
+    wrap(invoke) for a function with invoke's own signature; acall() and
+    awrap() are the same for async invoke functions. Calls are identical
+    when they use the same invoke function, model ID and canonical payload.
+    Safe to share between threads.
+    """
+
+    def __init__(self):
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.counters = {"calls": 0, "coalesced": 0, "saved_input_tokens": 0, "saved_output_tokens": 0,
+                         "saved_cost": 0.0}
+
+    def wrap(self, invoke):
+        """Return invoke with identical concurrent calls coalesced."""
+        return partial(self.call, invoke)
+
+    def awrap(self, invoke):
+        """Return the async invoke with identical concurrent calls coalesced."""
+        return partial(self.acall, invoke)
+
+    @staticmethod
+    def _key(invoke, model_id, payload):
+        return invoke, ResponseCache.key(model_id, canonical_payload(payload))
+
+    def call(self, invoke, client, model_id, payload, **kwargs):
+        """Return invoke(client, model_id, payload, **kwargs), or the result of the identical call in flight."""
+        key = self._key(invoke, model_id, payload)
+        start_time = time.perf_counter()
+        with self.lock:
+            self.counters["calls"] += 1
+            leader = self.in_flight.get(key)
+            if leader is None:
+                future = self.in_flight[key] = Future()
+        if leader is not None:
+            return self._follow(leader.result(), start_time)
+
+        try:
+            result = invoke(client, model_id, payload, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    async def acall(self, invoke, client, model_id, payload, **kwargs):
+        """Like call(), for an async invoke function. Cancelling a waiting caller leaves the shared call running."""
+        key = self._key(invoke, model_id, payload)
+        start_time = time.perf_counter()
+        with self.lock:
+            self.counters["calls"] += 1
+            leader = self.in_flight.get(key)
+            if leader is None:
+                leader = self.in_flight[key] = asyncio.ensure_future(invoke(client, model_id, payload, **kwargs))
+                leader.add_done_callback(partial(self._finished, key))
+                follower = False
+            else:
+                follower = True
+        result = await asyncio.shield(leader)
+        return self._follow(result, start_time) if follower else result
+
+    def _finished(self, key, task):
+        with self.lock:
+            del self.in_flight[key]
+        if not task.cancelled():
+            # Marks the error as seen, in case every caller was cancelled.
+            task.exception()
+
+    def _follow(self, result, start_time):
+        """Return a copy of the leader's result for a caller that waited on it, and count what was saved."""
+        with self.lock:
+            self.counters["coalesced"] += 1
+            self.counters["saved_input_tokens"] += result.input_tokens or 0
+            self.counters["saved_output_tokens"] += result.output_tokens or 0
+            self.counters["saved_cost"] += result.cost or 0.0
+        result = copy.copy(result)
+        result.coalesced = True
+        result.latency = time.perf_counter() - start_time
+        return result
+
+    def summary(self):
+        with self.lock:
+            return dict(self.counters)
+
+def dedupe_prompts(prompts):
+    """Return {prompt_id: first_prompt_id} for every prompt whose text repeats an earlier prompt.
+
+    prompts is an iterable of (prompt_id, prompt) pairs, read once. Only a
+    digest of each distinct prompt is kept, so a large file can be scanned
+    without holding its text.
+    """
+    first_ids = {}
+    duplicates = {}
+    for prompt_id, prompt in prompts:
+        digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+        first_id = first_ids.setdefault(digest, prompt_id)
+        if first_id != prompt_id:
+            duplicates[prompt_id] = first_id
+    return duplicates
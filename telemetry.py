@@ -0,0 +1,458 @@
+"""Spans, metrics and a Prometheus endpoint for Bedrock calls.
+
+A Telemetry wraps any invoke function, such as invoke_bedrock_model, as a
+ResilientInvoker does. Each call then gets:
+    a span      named "bedrock.invoke", with the model, region, backend,
+                token counts, cost, cache and prompt-cache attributes and the
+                time spent in each latency phase, under OpenTelemetry's
+                gen_ai.* names where there is one; span() opens a parent span
+                around several calls
+    metrics     counters of calls, errors, throttles, tokens and cost, and
+                histograms of latency, phase times, time to first token and
+                tokens per second, labelled by model
+    a profile   for a share profile_rate of calls, a cProfile (or
+                pyinstrument) dump of the call, named in the span's
+                "profile" attribute next to its phase times
+
+Finished spans go to each exporter, a function taking the span: a
+JsonlSpanExporter, otel_exporter() to hand them to an installed
+OpenTelemetry SDK, or anything else. render() returns the metrics in the
+Prometheus text format, and serve_metrics() serves them at /metrics.
+
+Wrap the invoke function itself rather than a retrying wrapper around it, so
+that every attempt gets its span and every throttle is counted. Pass clients
+built with get_client(max_attempts=1) for the same reason: attempts botocore
+retries on its own only show up as a "retry" phase. A Telemetry made with
+enabled=False hands invoke functions back unwrapped, so turning it off costs
+nothing per call.
+"""
+import json
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from region_router import error_code, routed_region
+
+# Upper bucket edges, in seconds or tokens per second, as Prometheus expects.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+PHASE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+TOKENS_PER_SECOND_BUCKETS = (5, 10, 25, 50, 100, 200, 400, 800)
+
+# The span of the call or block in progress, so that spans opened inside it become its children.
+_current_span = ContextVar("telemetry_span", default=None)
+
+class Span:
+    """One timed operation: a name, IDs linking it into a trace, attributes and an outcome.
+
+    Times are nanoseconds since the epoch, as OpenTelemetry records them.
+    status is "ok" or "error".
+    """
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else f"{random.getrandbits(128):032x}"
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_span_id = parent.span_id if parent is not None else None
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time_ns()
+        self.end_time = None
+        self.status = "ok"
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def fail(self, error):
+        self.status = "error"
+        self.attributes["error.type"] = error_code(error) or type(error).__name__
+        self.attributes["error.message"] = str(error)
+
+    @property
+    def duration(self):
+        """Seconds from start to end, or None while the span is open."""
+        return (self.end_time - self.start_time) / 1e9 if self.end_time is not None else None
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "start_time_unix_nano": self.start_time,
+            "end_time_unix_nano": self.end_time,
+            "status": self.status,
+            "attributes": self.attributes
+        }
+
+class JsonlSpanExporter:
+    """Appends each finished span to a file as one JSON line. Safe to share between threads."""
+
+    def __init__(self, path):
+        self.file = open(path, "a", encoding="utf-8")
+        self.lock = threading.Lock()
+
+    def __call__(self, span):
+        line = json.dumps(span.to_dict()) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def otel_exporter(tracer_name="bedrock"):
+    """Return an exporter that replays each finished span through OpenTelemetry. Needs opentelemetry-api.
+
+    The spans go to whatever tracer provider and exporters the OpenTelemetry
+    SDK is set up with. They keep their times and attributes; OpenTelemetry
+    gives them its own IDs.
+    """
+    from opentelemetry import trace
+    from opentelemetry.trace import Status, StatusCode
+    tracer = trace.get_tracer(tracer_name)
+
+    def export(span):
+        attributes = {name: value for name, value in span.attributes.items() if value is not None}
+        otel_span = tracer.start_span(span.name, start_time=span.start_time, attributes=attributes)
+        if span.status == "error":
+            otel_span.set_status(Status(StatusCode.ERROR, span.attributes.get("error.message")))
+        otel_span.end(end_time=span.end_time)
+    return export
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _labels(names, values):
+    # A label with no value, such as an unknown region, is written as empty.
+    pairs = [f'{name}="{_escape(value) if value is not None else ""}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class CounterMetric:
+    """A Prometheus counter: a running total per combination of label values."""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}
+
+    def inc(self, labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield f"{self.name}{_labels(self.label_names, labels)} {value}"
+
+class HistogramMetric:
+    """A Prometheus histogram: cumulative bucket counts, a sum and a count per combination of label values."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, labels, value):
+        series = self.values.get(labels)
+        if series is None:
+            # One count per bucket, then +Inf, then the sum.
+            series = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        # The first bucket whose edge is at least value; past the last edge is +Inf.
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        for labels, series in self.values.items():
+            seen = 0
+            for edge, count in zip(self.buckets + ("+Inf",), series):
+                seen += count
+                yield f"{self.name}_bucket{_labels(self.label_names + ('le',), labels + (edge,))} {seen}"
+            yield f"{self.name}_sum{_labels(self.label_names, labels)} {series[-1]}"
+            yield f"{self.name}_count{_labels(self.label_names, labels)} {seen}"
+
+class _PhaseRecorder:
+    """Stands in for the caller's LatencyRecorder so that a call's phase times also reach its span and metrics."""
+
+    def __init__(self, telemetry, span, recorder):
+        self.telemetry = telemetry
+        self.span = span
+        self.recorder = recorder
+
+    def record(self, model_id, timer):
+        if self.recorder is not None:
+            self.recorder.record(model_id, timer)
+        self.telemetry._record_phases(self.span, model_id, timer)
+
+class Telemetry:
+    """Traces and measures every call of the invoke functions it wraps. Safe to share between threads.
+
+    Use call(invoke, client, model_id, prompt, **kwargs) for one call, or
+    wrap(invoke) for a function with invoke's own signature; acall() and
+    awrap() are the same for async invoke functions. invoke must take a
+    recorder argument, as every invoke function here does. exporters get each
+    finished span, for a share sample_rate of calls; the metrics count every
+    call. max_spans finished spans are kept in spans for inspection.
+    profiler is "cprofile" or "pyinstrument"; profiles of synchronous calls
+    only are written to profile_dir, one call at a time.
+    """
+
+    def __init__(self, enabled=True, exporters=(), sample_rate=1.0, max_spans=1000, profile_rate=0.0,
+                 profile_dir="profiles", profiler="cprofile", seed=None):
+        if profiler not in ("cprofile", "pyinstrument"):
+            raise ValueError(f"Unknown profiler {profiler!r}; expected 'cprofile' or 'pyinstrument'")
+        self.enabled = enabled
+        self.exporters = list(exporters)
+        self.sample_rate = sample_rate
+        self.spans = deque(maxlen=max_spans)
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+        self.profiler = profiler
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # cProfile and pyinstrument each profile one thing at a time per process.
+        self.profile_lock = threading.Lock()
+        self.metrics = {}
+        self.calls = self._metric(CounterMetric, "bedrock_calls_total", "Bedrock calls by outcome: ok, cached or error",
+                                  ("model_id", "region", "backend", "outcome"))
+        self.errors = self._metric(CounterMetric, "bedrock_errors_total", "Failed Bedrock calls by error code",
+                                   ("model_id", "region", "code"))
+        self.throttles = self._metric(CounterMetric, "bedrock_throttles_total", "Bedrock calls refused as throttled",
+                                      ("model_id", "region"))
+        self.tokens = self._metric(CounterMetric, "bedrock_tokens_total",
+                                   "Tokens by kind: input, output, cache_read or cache_write", ("model_id", "kind"))
+        self.cost = self._metric(CounterMetric, "bedrock_cost_usd_total", "Cost of the calls in USD", ("model_id",))
+        self.latency = self._metric(HistogramMetric, "bedrock_call_duration_seconds", "Latency of uncached calls",
+                                    ("model_id", "backend"), LATENCY_BUCKETS)
+        self.phases = self._metric(HistogramMetric, "bedrock_phase_duration_seconds", "Time spent in each latency phase",
+                                   ("model_id", "phase"), PHASE_BUCKETS)
+        self.first_token = self._metric(HistogramMetric, "bedrock_time_to_first_token_seconds",
+                                        "Time to the first token of streamed calls", ("model_id",), LATENCY_BUCKETS)
+        self.throughput = self._metric(HistogramMetric, "bedrock_output_tokens_per_second",
+                                       "Output tokens per second of uncached calls", ("model_id",),
+                                       TOKENS_PER_SECOND_BUCKETS)
+
+    def _metric(self, metric_type, name, *args):
+        metric = self.metrics[name] = metric_type(name, *args)
+        return metric
+
+    def wrap(self, invoke):
+        """Return invoke with every call traced and measured, or invoke itself when disabled."""
+        return partial(self.call, invoke) if self.enabled else invoke
+
+    def awrap(self, invoke):
+        """Return the async invoke with every call traced and measured, or invoke itself when disabled."""
+        return partial(self.acall, invoke) if self.enabled else invoke
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Open a span around a block; spans of the calls made inside it become its children.
+
+        Calls made on other threads, such as an executor's, are children only
+        when the context is carried over with contextvars.copy_context().
+        """
+        span = Span(name, _current_span.get(), attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.fail(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            self._finish(span)
+
+    def _start(self, client, model_id, kwargs):
+        # Under a RegionRouter the router names the region, whatever the client reports.
+        region = routed_region() or getattr(getattr(client, "meta", None), "region_name", None)
+        span = Span("bedrock.invoke", _current_span.get(),
+                    {"gen_ai.system": "aws.bedrock", "gen_ai.request.model": model_id, "cloud.region": region})
+        kwargs["recorder"] = _PhaseRecorder(self, span, kwargs.get("recorder"))
+        return span, _current_span.set(span)
+
+    def call(self, invoke, client, model_id, prompt, **kwargs):
+        """Return invoke(client, model_id, prompt, **kwargs), traced and measured."""
+        span, token = self._start(client, model_id, kwargs)
+        profile = self.profile_rate and self._sampled(self.profile_rate) and self.profile_lock.acquire(blocking=False)
+        try:
+            if profile:
+                try:
+                    result = self._profiled(span, partial(invoke, client, model_id, prompt, **kwargs))
+                finally:
+                    self.profile_lock.release()
+            else:
+                result = invoke(client, model_id, prompt, **kwargs)
+        except BaseException as e:
+            self._failed(span, model_id, e)
+            raise
+        finally:
+            _current_span.reset(token)
+        self._succeeded(span, model_id, result)
+        return result
+
+    async def acall(self, invoke, client, model_id, prompt, **kwargs):
+        """Like call(), for an async invoke function. Async calls are never profiled."""
+        span, token = self._start(client, model_id, kwargs)
+        try:
+            result = await invoke(client, model_id, prompt, **kwargs)
+        except BaseException as e:
+            self._failed(span, model_id, e)
+            raise
+        finally:
+            _current_span.reset(token)
+        self._succeeded(span, model_id, result)
+        return result
+
+    def _sampled(self, rate):
+        if rate >= 1:
+            return True
+        with self.lock:
+            return self.random.random() < rate
+
+    def _profiled(self, span, call):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"{span.span_id}.{'prof' if self.profiler == 'cprofile' else 'txt'}")
+        if self.profiler == "cprofile":
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(call)
+            finally:
+                profiler.dump_stats(path)
+                span.set(profile=path)
+        from pyinstrument import Profiler
+        profiler = Profiler(async_mode="disabled")
+        profiler.start()
+        try:
+            return call()
+        finally:
+            profiler.stop()
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(profiler.output_text())
+            span.set(profile=path)
+
+    def _record_phases(self, span, model_id, timer):
+        span.set(**{f"bedrock.phase.{phase}": value_ns / 1e9 for phase, value_ns in timer.phases.items()})
+        with self.lock:
+            for phase, value_ns in timer.phases.items():
+                self.phases.observe((model_id, phase), value_ns / 1e9)
+
+    def _succeeded(self, span, model_id, result):
+        region = result.region or span.attributes["cloud.region"]
+        cached = result.cache_hit is not None
+        span.set(**{
+            "cloud.region": region,
+            "bedrock.backend": result.backend,
+            "bedrock.cached": cached,
+            "bedrock.coalesced": result.coalesced,
+            "gen_ai.usage.input_tokens": result.input_tokens,
+            "gen_ai.usage.output_tokens": result.output_tokens,
+            "gen_ai.response.finish_reasons": [result.stop_reason] if result.stop_reason else None,
+            "bedrock.cache_read_tokens": result.cache_read_tokens,
+            "bedrock.cache_write_tokens": result.cache_write_tokens,
+            "bedrock.cost_usd": result.cost,
+            "bedrock.latency": result.latency,
+            "bedrock.server_latency": result.server_latency
+        })
+        with self.lock:
+            self.calls.inc((model_id, region, result.backend, "cached" if cached else "ok"))
+            for kind, count in (("input", result.input_tokens), ("output", result.output_tokens),
+                                ("cache_read", result.cache_read_tokens), ("cache_write", result.cache_write_tokens)):
+                if count:
+                    self.tokens.inc((model_id, kind), count)
+            if result.cost:
+                self.cost.inc((model_id,), result.cost)
+            # A cached or coalesced answer took no time of the model's.
+            if result.latency is not None and not cached and not result.coalesced:
+                self.latency.observe((model_id, result.backend), result.latency)
+                if result.tokens_per_second is not None:
+                    self.throughput.observe((model_id,), result.tokens_per_second)
+                if result.stream_timings is not None:
+                    self.first_token.observe((model_id,), result.stream_timings.time_to_first_token)
+        self._finish(span)
+
+    def _failed(self, span, model_id, error):
+        span.fail(error)
+        region = span.attributes["cloud.region"]
+        code = span.attributes["error.type"]
+        with self.lock:
+            self.calls.inc((model_id, region, None, "error"))
+            self.errors.inc((model_id, region, code))
+            if code == "ThrottlingException":
+                self.throttles.inc((model_id, region))
+        self._finish(span)
+
+    def _finish(self, span):
+        span.end_time = time.time_ns()
+        with self.lock:
+            self.spans.append(span)
+        if self.exporters and self._sampled(self.sample_rate):
+            for export in self.exporters:
+                export(span)
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for metric in self.metrics.values():
+                lines.append(f"# HELP {metric.name} {metric.help_text}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+                lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Return {model_id: {"calls", "cached", "errors", "throttles", "cost"}} summed over regions and backends."""
+        with self.lock:
+            models = {}
+            for (model_id, _, _, outcome), count in self.calls.values.items():
+                totals = models.setdefault(model_id, {"calls": 0, "cached": 0, "errors": 0, "throttles": 0,
+                                                      "cost": 0.0})
+                totals["calls"] += count
+                if outcome == "cached":
+                    totals["cached"] += count
+                elif outcome == "error":
+                    totals["errors"] += count
+            for (model_id, _), count in self.throttles.values.items():
+                models[model_id]["throttles"] += count
+            for (model_id,), cost in self.cost.values.items():
+                models[model_id]["cost"] += cost
+            return models
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = self.server.telemetry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class _MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+def serve_metrics(telemetry, port=9464, host="127.0.0.1"):
+    """Serve telemetry's metrics at http://host:port/metrics on a background thread and return the server.
+
+    9464 is the port OpenTelemetry's Prometheus exporter uses; port=0 picks a
+    free one, found in server.server_port. Call server.shutdown() when done.
+    """
+    server = _MetricsServer((host, port), _MetricsHandler)
+    server.telemetry = telemetry
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,147 @@
+"""Prompt templates compiled once into ready-to-send request bodies.
+
+A PromptTemplate is a str.format-style template, such as
+"Summarize {document} in {words} words". It is parsed and checked once, into
+a %-format string. For each model family and set of parameters it is then
+compiled into that family's serialized request body, split around the
+prompt and encoded ahead of time. body(model_id, variables) fills the
+variables in with one % substitution, JSON-escapes the prompt in one call
+and puts the ready bytes around it: no payload dict and no json.dumps.
+
+A rendered body is byte for byte the body build_body() makes for the
+rendered prompt, so ResponseCache entries are shared with every other call
+path. A TemplateLibrary holds named templates, loaded from a JSON file;
+compile_template() caches templates by their source text.
+
+The payload suite of benchmark.py times body() against formatting the
+prompt and calling build_body(), and against building the payload dict and
+serializing it.
+"""
+import json
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
+from operator import itemgetter
+from string import Formatter
+
+from bedrock_invoke import invoke_bedrock_body
+from model_adapters import get_adapter, params_key
+
+_FORMATTER = Formatter()
+
+class CompiledBody:
+    """A template compiled for one model family: the encoded request body before and after the prompt."""
+
+    def __init__(self, template, prefix, suffix):
+        self.template = template
+        self.prefix = prefix.encode("utf-8")
+        self.suffix = suffix.encode("utf-8")
+
+    def render(self, variables):
+        """Return the request body, in bytes, with variables filled in."""
+        # json.dumps escapes a str the same way; the quotes come off so the prompt can sit inside a longer string.
+        escaped = encode_basestring_ascii(self.template.render(variables))[1:-1]
+        return self.prefix + escaped.encode("ascii") + self.suffix
+
+class PromptTemplate:
+    """A str.format-style prompt template with named fields, parsed once.
+
+    Values are filled in as str() gives them, or through format() for a
+    field with a conversion or format spec, such as {score:.2f}. Positional
+    fields and attribute or index lookups are refused, since every value
+    comes from a dict of variables. A missing variable raises KeyError;
+    extra variables are ignored. Safe to share between threads.
+    """
+
+    def __init__(self, source, name=None):
+        self.source = source
+        self.name = name
+        # The text before each field, then the text after the last one.
+        literals = []
+        self.fields = []
+        text = ""
+        for literal, field_name, format_spec, conversion in _FORMATTER.parse(source):
+            text += literal
+            if field_name is None:
+                # Text up to an escaped brace, or the end.
+                continue
+            if not field_name.isidentifier():
+                raise ValueError(f"Template {name or source!r}: field {{{field_name}}} must be a plain name")
+            if conversion not in (None, "r", "s", "a") or "{" in format_spec:
+                raise ValueError(f"Template {name or source!r}: field {{{field_name}}} has an unsupported "
+                                 f"conversion or a nested field in its format spec")
+            literals.append(text)
+            self.fields.append((field_name, format_spec, conversion))
+            text = ""
+        literals.append(text)
+        self.text = "%s".join(literal.replace("%", "%%") for literal in literals)
+        self.variables = sorted({field_name for field_name, _, _ in self.fields})
+        names = [field_name for field_name, _, _ in self.fields]
+        if any(format_spec or conversion for _, format_spec, conversion in self.fields):
+            self._values = self._formatted_values
+        elif len(names) > 1:
+            self._values = itemgetter(*names)
+        else:
+            # itemgetter of one name returns the value rather than a tuple.
+            self._values = lambda variables: tuple(variables[name] for name in names)
+        self.compiled = {}
+
+    def _formatted_values(self, variables):
+        return tuple(_FORMATTER.format_field(_FORMATTER.convert_field(variables[field_name], conversion), format_spec)
+                     for field_name, format_spec, conversion in self.fields)
+
+    def render(self, variables):
+        """Return the prompt text with variables filled in."""
+        return self.text % self._values(variables)
+
+    def compile(self, model_id, max_tokens=100, **params):
+        """Return the CompiledBody for model_id with these parameters, compiling it on first use."""
+        key = (model_id, max_tokens, params_key(params))
+        compiled = self.compiled.get(key)
+        if compiled is None:
+            compiled = self.compiled[key] = CompiledBody(self, *get_adapter(model_id).body_template(max_tokens,
+                                                                                                   **params))
+        return compiled
+
+    def body(self, model_id, variables, max_tokens=100, **params):
+        """Return the invoke_model request body, in bytes, for this template filled in with variables."""
+        return self.compile(model_id, max_tokens, **params).render(variables)
+
+    def invoke(self, client, model_id, variables, max_tokens=100, **kwargs):
+        """Call model_id with this template filled in with variables and return an InvocationResult.
+
+        kwargs go to invoke_bedrock_body: cache, recorder and prices.
+        """
+        return invoke_bedrock_body(client, model_id, self.body(model_id, variables, max_tokens), **kwargs)
+
+@lru_cache(maxsize=1024)
+def compile_template(source):
+    """Return the PromptTemplate for source, parsing it only the first time it is seen."""
+    return PromptTemplate(source)
+
+class TemplateLibrary:
+    """Named PromptTemplates, each parsed once, with their compiled bodies kept for reuse."""
+
+    def __init__(self, templates=None):
+        self.templates = {}
+        for name, source in (templates or {}).items():
+            self.add(name, source)
+
+    @classmethod
+    def from_file(cls, path):
+        """Load a library from a JSON file of {name: template source}. Every template is checked as it loads."""
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def add(self, name, source):
+        self.templates[name] = PromptTemplate(source, name)
+        return self.templates[name]
+
+    def __getitem__(self, name):
+        return self.templates[name]
+
+    def __contains__(self, name):
+        return name in self.templates
+
+    def body(self, name, model_id, variables, max_tokens=100, **params):
+        """Return the request body for the named template filled in with variables."""
+        return self.templates[name].body(model_id, variables, max_tokens, **params)
@@ -0,0 +1,136 @@
+"""Token usage, cost and throughput accounting for Bedrock calls.
+
+PriceTable turns token counts into dollars. The built-in prices are Bedrock's
+on-demand list prices in us-east-1, in USD per 1,000 tokens, and can be
+replaced from a JSON file of the same shape:
+
+    {"amazon.nova-lite-v1:0": {"input": 0.00006, "output": 0.00024}}
+
+An entry may also price prompt-cache reads and writes with "cache_read" and
+"cache_write"; without them they cost CACHE_READ_RATE and CACHE_WRITE_RATE
+times the input price, Anthropic's rates on Bedrock. Batch inference jobs
+cost BATCH_RATE times the on-demand price.
+
+UsageTotals adds results up per model, for throughput, cost per prompt and
+cost per model across a run.
+"""
+import json
+import threading
+
+from model_adapters import base_model_id
+
+DEFAULT_PRICES = {
+    "amazon.nova-micro-v1:0": {"input": 0.000035, "output": 0.00014, "cache_read": 0.00000875, "cache_write": 0.000035},
+    "amazon.nova-lite-v1:0": {"input": 0.00006, "output": 0.00024, "cache_read": 0.000015, "cache_write": 0.00006},
+    "amazon.nova-pro-v1:0": {"input": 0.0008, "output": 0.0032, "cache_read": 0.0002, "cache_write": 0.0008},
+    "amazon.titan-text-express-v1": {"input": 0.0002, "output": 0.0006},
+    "anthropic.claude-3-haiku-20240307-v1:0": {"input": 0.00025, "output": 0.00125},
+    "anthropic.claude-3-sonnet-20240229-v1:0": {"input": 0.003, "output": 0.015},
+    "anthropic.claude-3-5-sonnet-20240620-v1:0": {"input": 0.003, "output": 0.015},
+    "anthropic.claude-3-5-haiku-20241022-v1:0": {"input": 0.0008, "output": 0.004},
+    "anthropic.claude-3-7-sonnet-20250219-v1:0": {"input": 0.003, "output": 0.015},
+    "anthropic.claude-3-opus-20240229-v1:0": {"input": 0.015, "output": 0.075},
+    "meta.llama3-8b-instruct-v1:0": {"input": 0.0003, "output": 0.0006},
+    "meta.llama3-70b-instruct-v1:0": {"input": 0.00265, "output": 0.0035},
+    "mistral.mistral-7b-instruct-v0:2": {"input": 0.00015, "output": 0.0002},
+    "cohere.command-r-v1:0": {"input": 0.0005, "output": 0.0015},
+}
+CACHE_READ_RATE = 0.1
+CACHE_WRITE_RATE = 1.25
+BATCH_RATE = 0.5
+
+class PriceTable:
+    """Per-model token prices in USD per 1,000 tokens."""
+
+    def __init__(self, prices=None):
+        self.prices = dict(DEFAULT_PRICES if prices is None else prices)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def cost(self, model_id, input_tokens, output_tokens, cache_read_tokens=None, cache_write_tokens=None, batch=False):
+        """Return the cost of a call in USD, or None if the model or the token counts are unknown.
+
+        batch prices the call as one record of a batch inference job.
+        """
+        price = self.prices.get(model_id) or self.prices.get(base_model_id(model_id))
+        if price is None or input_tokens is None or output_tokens is None:
+            return None
+        total = input_tokens * price["input"] + output_tokens * price["output"]
+        if cache_read_tokens:
+            total += cache_read_tokens * price.get("cache_read", price["input"] * CACHE_READ_RATE)
+        if cache_write_tokens:
+            total += cache_write_tokens * price.get("cache_write", price["input"] * CACHE_WRITE_RATE)
+        if batch:
+            total *= BATCH_RATE
+        return total / 1000
+
+DEFAULT_PRICE_TABLE = PriceTable()
+
+class UsageTotals:
+    """Adds up InvocationResults per model. Safe to share between threads.
+
+    Cached and coalesced results are counted apart: they cost nothing and say
+    nothing about throughput, so only the cost they saved is recorded.
+    """
+
+    def __init__(self):
+        self.models = {}
+        self.lock = threading.Lock()
+
+    def add(self, model_id, result):
+        with self.lock:
+            totals = self.models.get(model_id)
+            if totals is None:
+                totals = self.models[model_id] = {
+                    "calls": 0, "cached": 0, "coalesced": 0, "input_tokens": 0, "output_tokens": 0,
+                    "cost": 0.0, "saved_cost": 0.0, "latency": 0.0, "unpriced": 0
+                }
+            if result.cache_hit is not None:
+                totals["cached"] += 1
+                totals["saved_cost"] += result.cache_hit.original_cost or 0.0
+                return
+            if result.coalesced:
+                totals["coalesced"] += 1
+                totals["saved_cost"] += result.cost or 0.0
+                return
+            totals["calls"] += 1
+            totals["input_tokens"] += result.input_tokens or 0
+            totals["output_tokens"] += result.output_tokens or 0
+            # Batch inference records have no latency of their own.
+            totals["latency"] += result.latency or 0.0
+            if result.cost is None:
+                totals["unpriced"] += 1
+            else:
+                totals["cost"] += result.cost
+
+    def summary(self):
+        """Return per-model totals plus tokens per second and cost per call, and a run-wide "total"."""
+        with self.lock:
+            models = {model_id: dict(totals) for model_id, totals in self.models.items()}
+        run = {"calls": 0, "cached": 0, "coalesced": 0, "input_tokens": 0, "output_tokens": 0, "cost": 0.0,
+               "saved_cost": 0.0, "latency": 0.0, "unpriced": 0}
+        for totals in models.values():
+            for name in run:
+                run[name] += totals[name]
+        for totals in list(models.values()) + [run]:
+            # Output tokens over the time spent waiting on the model; with
+            # concurrent calls the run finishes faster than this suggests.
+            totals["tokens_per_second"] = totals["output_tokens"] / totals["latency"] if totals["latency"] else None
+            totals["cost_per_call"] = totals["cost"] / totals["calls"] if totals["calls"] else None
+        return {"models": models, "total": run}
+
+    def report(self):
+        """Return the summary as a text table, one line per model."""
+        summary = self.summary()
+        lines = [f"{'model':<45}{'calls':>6}{'in tok':>9}{'out tok':>9}{'tok/s':>9}{'$/call':>11}{'$ total':>11}"]
+        for model_id, totals in list(summary["models"].items()) + [("total", summary["total"])]:
+            tokens_per_second = f"{totals['tokens_per_second']:.1f}" if totals["tokens_per_second"] else "-"
+            cost_per_call = f"{totals['cost_per_call']:.6f}" if totals["cost_per_call"] is not None else "-"
+            lines.append(
+                f"{model_id:<45}{totals['calls']:>6}{totals['input_tokens']:>9}{totals['output_tokens']:>9}"
+                f"{tokens_per_second:>9}{cost_per_call:>11}{totals['cost']:>11.6f}"
+            )
+        return "\n".join(lines)